@@ -0,0 +1,16 @@
+-- Outbox of channel dispatches (OUTBOX_ENABLED), see src/models/outbox.py.
+-- Apply before enabling the outbox or starting the outbox relay.
+CREATE TABLE IF NOT EXISTS incoming_sms_outbox (
+    id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    incoming_sms_id BIGINT NOT NULL,
+    account_id INT NOT NULL,
+    worker VARCHAR(64) NOT NULL,
+    arg VARCHAR(16) NOT NULL,
+    payload MEDIUMTEXT NOT NULL,
+    request_id VARCHAR(64) NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',
+    attempts INT NOT NULL DEFAULT 0,
+    created_on DATETIME NOT NULL,
+    sent_on DATETIME NULL,
+    KEY idx_status_id (status, id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -0,0 +1,4 @@
+-- Backoff of outbox entries: the relay claims an entry again only once
+-- next_attempt_at has passed. Apply before deploying the relay using it.
+ALTER TABLE incoming_sms_outbox
+    ADD COLUMN next_attempt_at DATETIME NULL AFTER attempts;
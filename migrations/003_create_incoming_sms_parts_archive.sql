@@ -0,0 +1,3 @@
+-- Archive of pruned incoming_sms_parts rows (PARTS_ARCHIVE_TABLE), see
+-- src/functionality/parts_pruner.py. Apply before enabling the pruner.
+CREATE TABLE IF NOT EXISTS incoming_sms_parts_archive LIKE incoming_sms_parts;
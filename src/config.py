@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+from functools import lru_cache
 from pathlib import Path
 
 from dotenv import load_dotenv
@@ -11,6 +12,8 @@ env_path = f'{curr_dir}/../env/{os.environ.get("ENVIRONMENT")}.env'
 load_dotenv(dotenv_path=Path(env_path))
 
 
+# Read from environment once per worker; callers must not mutate the result
+@lru_cache(maxsize=None)
 def get_worker_config(worker):
     return {
         'worker_name': os.environ.get(f'{worker}_TASK_NAME'),
@@ -25,6 +28,45 @@ APP_NAME = 'IncomingSMSHandler'
 # Redis Configurations
 SERVICE_REDIS_CLUSTER_HOST = os.environ.get("SERVICE_REDIS_CLUSTER_HOST")
 SERVICE_REDIS_CLUSTER_PORT = os.environ.get("SERVICE_REDIS_CLUSTER_PORT")
+# Deadline of a Redis command in milliseconds, retries included, overridden
+# per command by REDIS_COMMAND_DEADLINES, e.g. "get:50,incr:50,eval:200".
+REDIS_DEADLINE_MS = int(os.environ.get('REDIS_DEADLINE_MS', 10000))
+REDIS_COMMAND_DEADLINES = {
+    command: int(ms) for command, ms in (
+        item.split(':') for item in
+        os.environ.get('REDIS_COMMAND_DEADLINES', '').split(',') if item)}
+REDIS_CONNECT_TIMEOUT_MS = int(os.environ.get('REDIS_CONNECT_TIMEOUT_MS',
+                                              REDIS_DEADLINE_MS))
+# Connections per pool (per node for the cluster). 0 keeps the client default.
+# Each process has two pools: one for decoded replies and one for the binary
+# magic_cache values.
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 0))
+# Tries of a command on the cluster (redirects and reconnects included)
+REDIS_CLUSTER_REQUEST_TTL = int(os.environ.get('REDIS_CLUSTER_REQUEST_TTL',
+                                               3))
+# After this many consecutive connection errors / timeouts, Redis commands
+# return None (callers use the database) without calling Redis, and a PING
+# is tried every REDIS_FAST_FAIL_SECONDS. 0 disables.
+REDIS_FAST_FAIL_THRESHOLD = int(os.environ.get('REDIS_FAST_FAIL_THRESHOLD', 0))
+REDIS_FAST_FAIL_SECONDS = float(os.environ.get('REDIS_FAST_FAIL_SECONDS', 5))
+
+# magic_cache value format. Keep 'json' until every worker runs a build which
+# can read the versioned binary format, then switch to 'msgpack' or 'orjson'.
+CACHE_SERIALIZER = os.environ.get('CACHE_SERIALIZER', 'json')
+# Binary cache values of at least this many bytes are compressed. 0 disables.
+CACHE_COMPRESS_THRESHOLD = int(os.environ.get('CACHE_COMPRESS_THRESHOLD', 1024))
+# Seconds for which a missing inbound number / incoming config is remembered,
+# so junk traffic to unprovisioned numbers does not reach MySQL. 0 disables.
+NEGATIVE_CACHE_EXPIRY = int(os.environ.get('NEGATIVE_CACHE_EXPIRY', 60))
+# Seconds for which the latest WhatsApp keyword mapping of a shared number and
+# mobile number is cached. Written through on every new mapping. 0 disables.
+WA_MAPPING_CACHE_EXPIRY = int(os.environ.get('WA_MAPPING_CACHE_EXPIRY', 3600))
+# Per message idempotency keys. The in-progress lock must expire before the
+# task retries (2 x 30s) run out, so a crashed worker does not lose the message.
+# It is extended at each processing stage, so it only needs to outlast the
+# slowest single stage.
+IDEMPOTENCY_LOCK_EXPIRY = int(os.environ.get('IDEMPOTENCY_LOCK_EXPIRY', 45))
+IDEMPOTENCY_EXPIRY = int(os.environ.get('IDEMPOTENCY_EXPIRY', 3600 * 24))
 
 SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
 SQLALCHEMY_ECHO = False
@@ -57,5 +99,125 @@ METERING = os.environ.get('METERING', False)
 
 JSON_LOG_FILE_PATH = os.environ.get('JSON_LOG_FILE_PATH')
 
-INTERVAL_QUERY = "select id from incoming_sms_parts where createdOn > " \
-                 "now() - interval 1 day limit 1;"
+# All parts of a multipart message are expected within this many seconds
+PARTS_WINDOW = 3600 * 24
+# How long the incoming_sms_parts id watermark is used before it is moved
+PARTS_WATERMARK_EXPIRY = int(os.environ.get('PARTS_WATERMARK_EXPIRY', 3600))
+
+# Pruning of incoming_sms_parts older than PARTS_WINDOW, run by celery beat
+# every PARTS_PRUNE_INTERVAL seconds. 0 disables. Rows are copied to
+# PARTS_ARCHIVE_TABLE (same columns, incoming_sms_parts_archive from the
+# migrations) before deletion; without an archive table nothing is pruned, as
+# parts are kept for audit.
+PARTS_PRUNE_INTERVAL = int(os.environ.get('PARTS_PRUNE_INTERVAL', 0))
+PARTS_PRUNE_CHUNK_SIZE = int(os.environ.get('PARTS_PRUNE_CHUNK_SIZE', 1000))
+PARTS_PRUNE_MAX_CHUNKS = int(os.environ.get('PARTS_PRUNE_MAX_CHUNKS', 100))
+PARTS_ARCHIVE_TABLE = os.environ.get('PARTS_ARCHIVE_TABLE')
+
+# Multipart messages still incomplete MULTIPART_DEADLINE seconds after their
+# first part are either delivered with the parts received so far ('deliver')
+# or expired ('expire') by a sweeper run by celery beat every
+# MULTIPART_SWEEP_INTERVAL seconds. 0 disables; only set it where the beat
+# program runs. Parts arriving after the deadline are no longer assembled with
+# the others, so it shortens PARTS_WINDOW.
+MULTIPART_DEADLINE = int(os.environ.get('MULTIPART_DEADLINE', 900))
+MULTIPART_DEADLINE_ACTION = os.environ.get('MULTIPART_DEADLINE_ACTION',
+                                           'deliver')
+MULTIPART_SWEEP_INTERVAL = int(os.environ.get('MULTIPART_SWEEP_INTERVAL', 0))
+MULTIPART_SWEEP_BATCH = int(os.environ.get('MULTIPART_SWEEP_BATCH', 100))
+
+# Parts of a multipart message are forwarded to one of MULTIPART_PARTITIONS
+# queues by consistent hash on (shortcode, mobile number, reference id). Each
+# partition queue has a single consumer which assembles parts in memory,
+# keeping at most MULTIPART_BUFFER_SIZE messages. 0 disables. Must match
+# numprocs of the partition consumers in supervisor.
+MULTIPART_PARTITIONS = int(os.environ.get('MULTIPART_PARTITIONS', 0))
+MULTIPART_BUFFER_SIZE = int(os.environ.get('MULTIPART_BUFFER_SIZE', 10000))
+
+# Fair share of the incoming queues: each shortcode may start FAIR_SHARE_RATE
+# tasks per second with bursts up to FAIR_SHARE_BURST. Tasks over the share are
+# moved to the overflow queue so they do not hold the worker pool. 0 disables.
+FAIR_SHARE_RATE = float(os.environ.get('FAIR_SHARE_RATE', 0))
+FAIR_SHARE_BURST = int(os.environ.get('FAIR_SHARE_BURST', 100))
+
+# Adaptive concurrency of the worker pool (needs --autoscale). Every
+# ADAPTIVE_INTERVAL seconds the limit is halved if tasks took longer than
+# ADAPTIVE_TARGET_LATENCY seconds on average or failed more often than
+# ADAPTIVE_MAX_ERROR_RATE, otherwise raised by one. Degraded at the minimum
+# limit, queues are not consumed for ADAPTIVE_PAUSE seconds.
+ADAPTIVE_CONCURRENCY = int(os.environ.get('ADAPTIVE_CONCURRENCY', 0))
+ADAPTIVE_TARGET_LATENCY = float(os.environ.get('ADAPTIVE_TARGET_LATENCY', 2))
+ADAPTIVE_MAX_ERROR_RATE = float(os.environ.get('ADAPTIVE_MAX_ERROR_RATE', 0.2))
+ADAPTIVE_INTERVAL = int(os.environ.get('ADAPTIVE_INTERVAL', 5))
+ADAPTIVE_PAUSE = int(os.environ.get('ADAPTIVE_PAUSE', 30))
+
+# Circuit breakers of media upload and channel dispatch
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_FAILURE_WINDOW = int(os.environ.get('CIRCUIT_FAILURE_WINDOW', 60))
+CIRCUIT_RESET_TIMEOUT = int(os.environ.get('CIRCUIT_RESET_TIMEOUT', 30))
+CIRCUIT_OPEN_EXPIRY = int(os.environ.get('CIRCUIT_OPEN_EXPIRY', 3600))
+MEDIA_UPLOAD_TIMEOUT = int(os.environ.get('MEDIA_UPLOAD_TIMEOUT', 30))
+
+# Digest mode of push to email: messages are buffered per account and sent
+# as one email every EMAIL_DIGEST_WINDOW seconds. 0 disables. Applies only to
+# the accounts in EMAIL_DIGEST_ACCOUNTS (comma separated ids). The email uses
+# EMAIL_DIGEST_TEMPLATE_TYPE, a template rendering `messages` (the fields of
+# each message) and `count`; the mode is off until it is set. Not applied in
+# outbox mode.
+EMAIL_DIGEST_WINDOW = int(os.environ.get('EMAIL_DIGEST_WINDOW', 0))
+EMAIL_DIGEST_ACCOUNTS = set(
+    filter(None, os.environ.get('EMAIL_DIGEST_ACCOUNTS', '').split(',')))
+EMAIL_DIGEST_TEMPLATE_TYPE = int(os.environ.get('EMAIL_DIGEST_TEMPLATE_TYPE',
+                                                0))
+
+# Micro-batching of CRM dispatches: payloads of the CRM_BATCH_CHANNELS workers
+# are sent per account and channel in batches of up to CRM_BATCH_SIZE, at
+# most CRM_BATCH_WINDOW_MS after the first payload. 0 disables. The CRM
+# workers must accept batch payloads. Not applied in outbox mode. Payloads of
+# a failed batch are dropped after CRM_BATCH_MAX_ATTEMPTS sends.
+CRM_BATCH_WINDOW_MS = int(os.environ.get('CRM_BATCH_WINDOW_MS', 0))
+CRM_BATCH_SIZE = int(os.environ.get('CRM_BATCH_SIZE', 50))
+CRM_BATCH_MAX_ATTEMPTS = int(os.environ.get('CRM_BATCH_MAX_ATTEMPTS', 5))
+# Workers opted in, e.g. PUSH_TO_BULLHORN (its payload already holds a list)
+CRM_BATCH_CHANNELS = set(filter(None, os.environ.get(
+    'CRM_BATCH_CHANNELS', '').split(',')))
+
+# Transactional outbox of channel dispatches. When enabled, dispatches are
+# saved with the message and published by the outbox relay
+# (python -m src.functionality.outbox_relay), OUTBOX_BATCH_SIZE at a time,
+# polling every OUTBOX_POLL_INTERVAL seconds when idle. A failed entry is
+# retried after OUTBOX_RETRY_BACKOFF seconds, doubled on each attempt up to
+# OUTBOX_RETRY_MAX_BACKOFF, and marked failed after OUTBOX_MAX_ATTEMPTS.
+# Entries of an exchange whose circuit is open wait CIRCUIT_RESET_TIMEOUT
+# without using an attempt. Sent entries are deleted OUTBOX_RETENTION seconds
+# after being sent (0 keeps them).
+OUTBOX_ENABLED = int(os.environ.get('OUTBOX_ENABLED', 0))
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 100))
+OUTBOX_POLL_INTERVAL = float(os.environ.get('OUTBOX_POLL_INTERVAL', 0.5))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 5))
+OUTBOX_RETRY_BACKOFF = int(os.environ.get('OUTBOX_RETRY_BACKOFF', 30))
+OUTBOX_RETRY_MAX_BACKOFF = int(os.environ.get('OUTBOX_RETRY_MAX_BACKOFF',
+                                              3600))
+OUTBOX_RETENTION = int(os.environ.get('OUTBOX_RETENTION', 7 * 24 * 3600))
+
+# Memory profiling of worker processes: RSS growth per task, and every
+# MEMORY_REPORT_EVERY tasks a report of allocation growth by call site and
+# SQLAlchemy object counts in MEMORY_REPORT_DIR. 0 disables.
+MEMORY_PROFILE = int(os.environ.get('MEMORY_PROFILE', 0))
+MEMORY_REPORT_EVERY = int(os.environ.get('MEMORY_REPORT_EVERY', 100))
+MEMORY_REPORT_DIR = os.environ.get('MEMORY_REPORT_DIR', '/tmp/incoming_memory')
+
+# SQL statements, rows and database time per task in the JSON log, with
+# statements run SQL_REPEAT_THRESHOLD times or more in one task flagged.
+# SQL_QUERY_BUDGET is the default budget of query_budget() in tests.
+SQL_INSTRUMENTATION = int(os.environ.get('SQL_INSTRUMENTATION', 0))
+SQL_REPEAT_THRESHOLD = int(os.environ.get('SQL_REPEAT_THRESHOLD', 3))
+SQL_QUERY_BUDGET = int(os.environ.get('SQL_QUERY_BUDGET', 0))
+
+# Counters and histograms of all worker processes, written to memory mapped
+# files in METRICS_DIR and served by the main worker process in the
+# Prometheus text format on METRICS_PORT (0: not served). Each worker program
+# on a host has its own port, set in its supervisor environment.
+METRICS_ENABLED = int(os.environ.get('METRICS_ENABLED', 0))
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+METRICS_DIR = os.environ.get('METRICS_DIR', '/tmp/incoming_metrics')
@@ -0,0 +1,54 @@
+"""
+Digest mode of push to email.
+
+Messages of digest accounts are buffered per account in a Redis list instead
+of being emailed one by one. The first message of a window schedules a flush
+task EMAIL_DIGEST_WINDOW seconds later, which takes the whole buffer and
+sends it as one email (one email log row, one PUSH_TO_EMAIL task) of the
+EMAIL_DIGEST_TEMPLATE_TYPE template.
+
+The buffer is a micro batch (see micro_batch) without size limit.
+"""
+from src import config
+from src.functionality.micro_batch import batch_keys, add, take, \
+    schedule_flush
+from src.utils.config_loggers import log, log_json
+from src.utils.constants import FLUSH_EMAIL_DIGEST_TASK_NAME
+
+
+def is_digest_account(account_id):
+    return bool(config.EMAIL_DIGEST_WINDOW and
+                config.EMAIL_DIGEST_TEMPLATE_TYPE) and \
+        str(account_id) in config.EMAIL_DIGEST_ACCOUNTS
+
+
+def buffer_message(account_id, content):
+    """
+    Adds the email content of a message to the digest of the account.
+    Returns False when it could not be buffered; it is then sent on its own.
+    """
+    keys = batch_keys('EMAIL_DIGEST', account_id)
+    window_ms = config.EMAIL_DIGEST_WINDOW * 1000
+    added = add(keys, content, window_ms)
+    if added is None:
+        return False
+    if added[1]:
+        schedule_flush(keys, FLUSH_EMAIL_DIGEST_TASK_NAME, [account_id],
+                       window_ms)
+        log.info(f'Email digest window opened for account {account_id}')
+    return True
+
+
+def take_messages(account_id):
+    messages = take(batch_keys('EMAIL_DIGEST', account_id))
+    log_json.info('Email digest taken.', extra={
+        'account_id': account_id, 'messages': len(messages)})
+    return messages
+
+
+def restore_messages(account_id, messages):
+    """Buffers messages of a failed flush again, for the next window"""
+    for content in messages:
+        if not buffer_message(account_id, content):
+            log.error(f'Email digest message {content.get("sms_id")} of '
+                      f'account {account_id} could not be buffered again')
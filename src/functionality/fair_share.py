@@ -0,0 +1,95 @@
+"""
+Fair share of the incoming queues between tenants.
+
+Every shortcode has a token bucket in Redis refilled at FAIR_SHARE_RATE tokens
+per second, holding at most FAIR_SHARE_BURST. A task which finds the bucket of
+its shortcode empty is moved to the overflow queue, so a burst of one tenant
+waits there instead of holding the worker pool for everyone else.
+"""
+import json
+from time import time
+
+from celery import current_task
+
+from src import config
+from src.functionality.multipart_affinity import is_partitioned
+from src.utils.celery_app import app
+from src.utils.config_loggers import log, log_json
+from src.utils.constants import OVERFLOW_QUEUE
+from src.utils.redis_cache import redis_cache
+
+BUCKET_KEY = f'{config.APP_NAME}:FAIR_SHARE:{{}}'
+
+# Refills the bucket for the time passed and takes a token if there is one.
+# Time is the clock of Redis, so clock skew between workers does not change
+# the refill. ARGV: rate, burst. Returns 1 if a token was taken.
+TAKE_TOKEN_SCRIPT = """
+redis.replicate_commands()
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local taken = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    taken = 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return taken
+"""
+
+
+def _shortcode(payload):
+    return str(payload.get('shortCode', '')).lstrip('+')
+
+
+def take_token(shortcode):
+    """Fails open: True when Redis is not reachable"""
+    taken = redis_cache.eval(TAKE_TOKEN_SCRIPT, 1, BUCKET_KEY.format(shortcode),
+                             config.FAIR_SHARE_RATE, config.FAIR_SHARE_BURST)
+    return taken is None or bool(taken)
+
+
+def admit(payload, task_name):
+    """
+    Returns True when the task may run now. A task over the share of its
+    shortcode is sent to the overflow queue and False is returned.
+    """
+    # Deferred tasks already waited their turn; partitioned parts must stay on
+    # their partition consumer
+    if not config.FAIR_SHARE_RATE or payload.get('deferred') or \
+            is_partitioned(payload):
+        return True
+    shortcode = _shortcode(payload)
+    if take_token(shortcode):
+        return True
+
+    app.send_task(task_name, args=[json.dumps(dict(payload, deferred=True,
+                                                   queuedAt=time()))],
+                  queue=OVERFLOW_QUEUE)
+    log.info(f'Shortcode {shortcode} over its share, task deferred')
+    log_json.info('Incoming message deferred to overflow queue.',
+                  extra={'shortcode': shortcode, 'queue': OVERFLOW_QUEUE})
+    return False
+
+
+def log_queue_time(payload):
+    """
+    Logs time spent in queue by shortcode. Every task published through the
+    Celery app is stamped with a queuedAt header (see celery_app); producers
+    outside it may set queuedAt in the payload instead.
+    """
+    queued_at = payload.get('queuedAt') or \
+        (current_task and current_task.request.get('queuedAt'))
+    if not queued_at:
+        return
+    log_json.info('Incoming message queue time.', extra={
+        'shortcode': _shortcode(payload),
+        'queue_time': round(time() - float(queued_at), 3),
+        'deferred': bool(payload.get('deferred')),
+        'partition': payload.get('partition')
+    })
@@ -3,13 +3,44 @@ import sys
 from celery import current_task
 from sm_models.inbound_numbers import InboundNumber, MultichannelInboundNumber
 
-from src.config import METERING
-from src.functionality.media import upload_media
+from src.config import METERING, OUTBOX_ENABLED
+from src.functionality.media import upload_media, CircuitOpenError
 from src.functionality.metering import Metering
+from src.functionality.multipart_affinity import is_partitioned, add_part, \
+    pop_buffered_message
+from src.functionality.multipart_deadline import schedule_deadline, \
+    cancel_deadline
 from src.functionality.sync import IncomingSMSSync
+from src.models.incoming_message import IncomingMessage
 from src.models.incoming_sms import *
 from src.utils.config_loggers import log, log_json
 from src.utils.constants import SF_STORAGE
+from src.utils.helper import byte_to_str
+from src.utils.idempotency import MessageIdempotency, MESSAGE_STATE_SAVED, \
+    MESSAGE_STATE_DONE, MESSAGE_STATE_COMPLETED
+from src.utils.stage_journal import StageJournal, StageRetryError, \
+    STAGE_LOOKUP, STAGE_PART, STAGE_MULTIPART, STAGE_MEDIA, STAGE_SAVE, \
+    STAGE_METERING, STAGE_CHANNELS, STAGE_PARTS_UPDATE
+
+TABLE_SOURCES = {
+    InboundNumber.__name__: InboundNumber,
+    MultichannelInboundNumber.__name__: MultichannelInboundNumber
+}
+
+# Message params and handler attributes produced by each journaled stage.
+# They are restored when a retried task skips the stage.
+STAGE_OUTPUTS = {
+    STAGE_LOOKUP: (('table_source', 'accountId', 'keyword', 'subKeyword'),
+                   ('inbound_number_info', 'incoming_config', 'keyword',
+                    'sub_keyword')),
+    STAGE_MULTIPART: (('message',), ('is_message_complete',)),
+    STAGE_MEDIA: (('mms_urls', 'skip_db_url_storage'), ()),
+    STAGE_SAVE: (('sms_id', 'created_on'), ())
+}
+
+# Stages with side effects outside this task are written to Redis right away.
+# Earlier stages are only worth keeping together with the saved message.
+FLUSHED_STAGES = {STAGE_SAVE, STAGE_METERING, STAGE_CHANNELS}
 
 
 class IncomingSMSHandler(object):
@@ -20,7 +51,8 @@ class IncomingSMSHandler(object):
 
     def __init__(self, params):
         log.info('In constructor of IncomingSMSHandler')
-        self.params = params
+        # Parsed once; the task entry passes the message it already parsed
+        params = self.params = IncomingMessage.parse(params)
         self.shortcode = self._remove_plus(params['shortCode'])
         current_task.request.kwargs['short_code'] = self.shortcode
         self.mobile_number = self._remove_plus(params['mobilenumber'])
@@ -36,6 +68,8 @@ class IncomingSMSHandler(object):
         self.incoming_config = {}
         self.is_message_complete = True
         self.error = None
+        # Set when a lookup was rejected from the negative cache
+        self.rejected = False
         # If any exception happens, we don't want any partial database
         # transactions to be happened. Commit only when it is in consistent
         # stage.
@@ -51,29 +85,33 @@ class IncomingSMSHandler(object):
         self.params["keyword"] = self.keyword
         self.params["subKeyword"] = self.sub_keyword
         self.params['totalParts'] = self._total_parts(params.get('totalParts'))
+        self.idempotency = MessageIdempotency(self.params)
+        self.journal = StageJournal(self.entry_id or self.idempotency.key)
+        # Set when a stage after save failed and the task should be retried
+        self.resumable = False
 
     def process(self):
-        try:
-            # Update CeleryTask to 'STARTED' status
-            self._start_celery_task()
-
-            # From short-code, get inbound number.
-            self._get_inbound_number()
-
-            # If inbound number is shared between accounts, parse the message
-            # and get keyword and sub-keyword.Add keywords to the message params
-            self._handle_shared_number()
-
-            # Based on inbound number and keywords, find account-id. Add account
-            # id to the message params
-            self._get_incoming_config()
+        # Retried or redelivered message which was already handled
+        if not self._acquire_message():
+            return
+        if self.idempotency.resumed:
+            self.journal.load()
 
-            # Updates the Duplicate Incoming Check For Account. By updating the
-            # ttl expiry of the redis key for incoming messages.
-            self._update_duplicate_incoming_redis_key()
+        try:
+            self._run_stage(STAGE_LOOKUP,
+                            # From short-code, get inbound number
+                            self._get_inbound_number,
+                            # Shared number: keyword and sub-keyword
+                            self._handle_shared_number,
+                            # Account id for the number and keywords
+                            self._get_incoming_config,
+                            # 'STARTED' once known not to be junk
+                            self._start_celery_task,
+                            # Renew the duplicate incoming check key
+                            self._update_duplicate_incoming_redis_key)
 
             # If sms is multipart,
-            self._save_part_of_message()
+            self._run_stage(STAGE_MULTIPART, self._save_part_of_message)
 
             # If all parts of the message are not yet received, defer further
             # process
@@ -82,24 +120,24 @@ class IncomingSMSHandler(object):
                 return
 
             # Handle MMS - Add urls of uploaded media to the message params
-            self._upload_media_data()
+            self._run_stage(STAGE_MEDIA, self._upload_media_data)
 
             # Store incoming SMS to database. Add sms-id to the message params
             log.info("About to save message")
-            self._save_message()
+            self._run_stage(STAGE_SAVE, self._save_message)
             log.info("Processed till save message")
 
             # Commit all the transactions happened to the database
             self.commit = True
             # Process multichannel metering
-            self._metering()
+            self._run_stage(STAGE_METERING, self._metering)
             # Push to channels
-            self._push_to_channels()
+            self._run_stage(STAGE_CHANNELS, self._push_to_channels)
 
             # After multipart message has been assembled, update parts records
             # with final sms-id. All parts are still maintained for audit and
             # debugging purpose.
-            self._update_parts_of_message()
+            self._run_stage(STAGE_PARTS_UPDATE, self._update_parts_of_message)
 
         except Exception as e:
             log.exception(f"Exception occurred while processing incoming "
@@ -107,13 +145,101 @@ class IncomingSMSHandler(object):
             log_json.exception("Exception occurred while processing Incoming "
                                "Message", extra={'error': str(e)})
             self.error = str(e)
+            self.rejected = isinstance(e, NegativelyCachedError)
             db_model.rollback_session()
+            self.resumable = self._can_resume()
         finally:
-            # Complete the CeleryTask
-            if self.error:
-                self._fail_celery_task(error=self.error)
-            else:
-                self._complete_celery_task()
+            try:
+                self._finish()
+            finally:
+                # A retry resumes a SAVED message once the lock is free
+                self.idempotency.unlock()
+
+        if self.resumable:
+            raise StageRetryError(self.error)
+
+    def _run_stage(self, stage, *steps):
+        output = self.journal.output(stage)
+        if output is not None:
+            log.info(f'Stage {stage} restored from journal')
+            self._restore_stage(output)
+            return
+
+        # Keep the message locked while a slow message is still running
+        self.idempotency.extend()
+        for step in steps:
+            step()
+        self.journal.record(stage, self._stage_output(stage),
+                            flush=stage in FLUSHED_STAGES)
+        if stage == STAGE_SAVE:
+            self.idempotency.mark(MESSAGE_STATE_SAVED)
+
+    def _stage_output(self, stage):
+        param_keys, attributes = STAGE_OUTPUTS.get(stage, ((), ()))
+        params = {k: self.params[k] for k in param_keys if k in self.params}
+        if 'table_source' in params:
+            params['table_source'] = params['table_source'].__name__
+        if 'message' in params:
+            params['message'] = byte_to_str(params['message'])
+        return {
+            'params': params,
+            'attributes': {a: getattr(self, a) for a in attributes}
+        }
+
+    def _restore_stage(self, output):
+        params = output.get('params', {})
+        if 'table_source' in params:
+            params['table_source'] = TABLE_SOURCES[params['table_source']]
+        if 'accountId' in params:
+            current_task.request.kwargs['account_id'] = params['accountId']
+        self.params.update(params)
+        for attribute, value in output.get('attributes', {}).items():
+            setattr(self, attribute, value)
+
+    def _can_resume(self):
+        # Failures before the message was saved are final, as they always were
+        if not self.journal.is_done(STAGE_SAVE):
+            return False
+        return current_task.request.retries < current_task.max_retries
+
+    def _is_persisted(self):
+        return self.journal.is_done(STAGE_SAVE) or \
+            self.journal.is_done(STAGE_PART)
+
+    def _finish(self):
+        if self.resumable:
+            # Keep the journal, the retried task resumes from the failed stage
+            self.journal.flush()
+            self.idempotency.mark(MESSAGE_STATE_SAVED)
+            return
+
+        # Nothing was persisted, so a redelivery may process it again
+        if self.error and not self._is_persisted():
+            self.idempotency.release()
+        else:
+            self.idempotency.mark(MESSAGE_STATE_DONE)
+
+        # Complete the CeleryTask
+        if self.rejected:
+            # Junk traffic: one UPDATE, no lookups of the task row
+            reject_celery_task(entry_id=self.entry_id, error=self.error)
+        elif self.error:
+            self._fail_celery_task(error=self.error)
+        else:
+            self._complete_celery_task()
+        if self.idempotency.state == MESSAGE_STATE_DONE:
+            self.idempotency.mark(MESSAGE_STATE_COMPLETED)
+            self.journal.clear()
+
+    def _acquire_message(self):
+        if self.idempotency.acquire():
+            return True
+        # Message was processed but the CeleryTask was not finalized
+        if self.idempotency.state == MESSAGE_STATE_DONE:
+            self._complete_celery_task()
+            self.idempotency.mark(MESSAGE_STATE_COMPLETED)
+        log.info(f'Skipping already processed message: {self.idempotency.key}')
+        return False
 
     def _start_celery_task(self):
         start_celery_task(entry_id=self.entry_id)
@@ -173,7 +299,16 @@ class IncomingSMSHandler(object):
 
         self.is_message_complete = False
         log.debug("Message is a multipart message")
-        parts_count = get_count_of_parts(self.params)
+        saved_part = self.journal.output(STAGE_PART)
+        # Parts routed to their partition consumer are counted in memory
+        partitioned = is_partitioned(self.params)
+        if saved_part:
+            parts_count = saved_part['parts_count']
+        elif partitioned:
+            save_incoming_message_part(self.params)
+            parts_count = add_part(self.params)
+        else:
+            parts_count = get_count_of_parts(self.params)
         log.info(f'Parts received so far: {parts_count}')
         extra = {
             "message_id": self.params.get("messageId", None),
@@ -182,12 +317,24 @@ class IncomingSMSHandler(object):
             'part_number': parts_count
         }
         log_json.debug("Message is a multipart message", extra=extra)
-        save_incoming_message_part(self.params)
+        if not saved_part:
+            if not partitioned:
+                save_incoming_message_part(self.params)
+            self.journal.record(STAGE_PART, {'parts_count': parts_count},
+                                flush=True)
+            self.idempotency.mark(MESSAGE_STATE_SAVED)
+            # First part of the message; deliver or expire it if the rest
+            # never arrives
+            if parts_count == 1:
+                schedule_deadline(self.params)
         if are_all_parts_received(self.params, parts_count):
             log_json.debug("All parts received", extra={
                 'totalParts': self.params.get("totalParts")})
+            if not cancel_deadline(self.params):
+                return
 
-            message = assemble_message(self.params)
+            message = partitioned and pop_buffered_message(self.params) or \
+                assemble_message(self.params)
             if message:
                 self.params["message"] = message
                 self.is_message_complete = True
@@ -208,17 +355,32 @@ class IncomingSMSHandler(object):
                 if storage_setting == SF_STORAGE:
                     self.params['skip_db_url_storage'] = True
                 else:
-                    uploaded_mms_urls = upload_media(self.params["mms_urls"],
-                                                     self.params["accountId"],
-                                                     self.params.get(
-                                                         "providerName"))
+                    try:
+                        uploaded_mms_urls = upload_media(
+                            self.params["mms_urls"], self.params["accountId"],
+                            self.params.get("providerName"))
+                    except CircuitOpenError as e:
+                        # Upload server is failing; keep the provider urls
+                        # instead of holding the message
+                        log_json.warning('MMS not uploaded, original urls '
+                                         'kept.', extra={'error': str(e)})
+                        mms_urls = self.params["mms_urls"]
+                        if not isinstance(mms_urls, list):
+                            mms_urls = [mms_urls]
+                        uploaded_mms_urls = list(filter(None, mms_urls))
                     self.params["mms_urls"] = uploaded_mms_urls
 
     def _save_message(self):
         log.info('Inside function _save_part_of_message')
-        sms_record = save_incoming_sms(self.params)
+        sms_record = save_incoming_sms(self.params, commit=not OUTBOX_ENABLED)
         self.params["sms_id"] = sms_record["id"]
         self.params["created_on"] = sms_record["created_on"]
+        if OUTBOX_ENABLED:
+            # Channel dispatches are written to the outbox in the transaction
+            # of the message and published by the outbox relay
+            IncomingSMSSync(self.params.view(), self.incoming_config,
+                            outbox=True).push()
+            db_model.commit_session()
         log_json.debug(f"Saved message id = {self.params['sms_id']}")
         log.warning(f"Saved message id: {self.params['sms_id']}")
         return sms_record
@@ -231,7 +393,11 @@ class IncomingSMSHandler(object):
 
     def _push_to_channels(self):
         log.info('Inside function _push_to_channels')
-        IncomingSMSSync(self.params, self.incoming_config).push()
+        if OUTBOX_ENABLED:
+            # Dispatches were saved to the outbox with the message
+            return
+        IncomingSMSSync(self.params.view(), self.incoming_config,
+                        journal=self.journal).push()
 
     def _update_parts_of_message(self):
         log.info('Inside function _update_parts_of_message')
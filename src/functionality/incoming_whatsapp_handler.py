@@ -12,7 +12,7 @@ class IncomingWhatsappHandler(IncomingSMSHandler):
 
     def __init__(self, params):
         super(IncomingWhatsappHandler, self).__init__(params)
-        self._handle_mexico_number(params)
+        self._handle_mexico_number(self.params)
 
     def _handle_shared_number(self):
         """
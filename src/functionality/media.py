@@ -6,8 +6,10 @@ from retrying import retry
 from sm_utils.utils import Singleton
 from sm_utils.utils import function_logger
 
-from src.config import attach_media_url, attach_media_url_bandwidth
+from src.config import attach_media_url, attach_media_url_bandwidth, \
+    MEDIA_UPLOAD_TIMEOUT
 from src.models.incoming_sms import get_apikey
+from src.utils.circuit_breaker import get_breaker, CircuitOpenError
 from src.utils.config_loggers import log
 from src.utils.constants import SCREEN_MAGIC_DOMAINS
 
@@ -23,15 +25,30 @@ class Request(object):
 
     def post(self, url, payload):
         log.info('Inside function media.Request.post')
-        response = self.session.post(url, json=payload)
+        response = self.session.post(url, json=payload,
+                                     timeout=MEDIA_UPLOAD_TIMEOUT)
         log.debug(f'media.Request.post response {response.__dict__}')
         response.raise_for_status()
         return response.json()
 
 
-@retry(wait_random_min=1000, wait_random_max=5000, stop_max_attempt_number=3)
+def _is_upstream_failure(e):
+    # Client errors (4xx) are about the request, not the app server
+    response = getattr(e, 'response', None)
+    return response is None or response.status_code >= 500
+
+
+def _is_retryable(e):
+    return not isinstance(e, CircuitOpenError)
+
+
+# Attempts go through the circuit breaker of the upload URL; once it opens
+# the remaining attempts fail fast.
+@retry(wait_random_min=1000, wait_random_max=5000, stop_max_attempt_number=3,
+       retry_on_exception=_is_retryable)
 def _request(url, payload):
-    return Request().post(url, payload)
+    breaker = get_breaker(f'media:{url}', is_failure=_is_upstream_failure)
+    return breaker.call(Request().post, url, payload)
 
 
 # API for uploading attachments for provider 'Bandwidth' is different, because
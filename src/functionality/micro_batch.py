@@ -0,0 +1,215 @@
+"""
+Micro-batching of channel dispatches in Redis lists.
+
+Payloads of a batch are appended to a Redis list. The first payload of a
+window schedules a flush task for the end of the window; the payload which
+fills the batch flushes it at once. Keys of a batch share a hash tag, so the
+scripts are cluster safe. A flush task lost on the way is scheduled again by
+the first payload after the schedule marker expires.
+
+CRM dispatches (CRM_BATCH_CHANNELS) are batched per account, channel and
+payload type for up to CRM_BATCH_SIZE messages or CRM_BATCH_WINDOW_MS, and
+each batch is sent as one task:
+- Bullhorn payloads are merged into one `messages` list
+- other channels get {'batch': True, 'messages': [payload, ...]}
+The task of a batch is logged for each message in it. Payloads of a failed
+batch are put back at the head of the buffer and retried a window later, up
+to CRM_BATCH_MAX_ATTEMPTS times, after which they are dropped and logged.
+While the circuit of the exchange is open they are retried
+CIRCUIT_RESET_TIMEOUT later, without using an attempt.
+"""
+import json
+
+from src import config
+from src.utils.celery_app import app
+from src.utils.circuit_breaker import CircuitOpenError
+from src.utils.config_loggers import log, log_json
+from src.utils.constants import FLUSH_CRM_BATCH_TASK_NAME, TASK_MODULE, \
+    CHANNEL_BULLHORN
+from src.utils.redis_cache import redis_cache
+
+# Appends the item; returns {length, 1 when the window has no flush scheduled}
+# ARGV: item, marker expiry (ms)
+ADD_SCRIPT = """
+local length = redis.call('RPUSH', KEYS[1], ARGV[1])
+local schedule = 0
+if redis.call('SET', KEYS[2], 1, 'NX', 'PX', ARGV[2]) then
+    schedule = 1
+end
+return {length, schedule}
+"""
+
+# Takes up to ARGV[1] items (all for 0); the window ends with the last item
+TAKE_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+redis.call('LTRIM', KEYS[1], #items, -1)
+if redis.call('LLEN', KEYS[1]) == 0 then
+    redis.call('DEL', KEYS[2])
+end
+return items
+"""
+
+# Puts the items (ARGV[2]...) back at the head of the list, in order, and
+# marks a flush as scheduled. ARGV[1]: marker expiry (ms)
+RESTORE_SCRIPT = """
+for i = #ARGV, 2, -1 do
+    redis.call('LPUSH', KEYS[1], ARGV[i])
+end
+redis.call('SET', KEYS[2], 1, 'PX', ARGV[1])
+return 1
+"""
+
+# Failed sends of a buffered payload, kept in the payload while it is buffered
+ATTEMPTS_FIELD = '_batch_attempts'
+
+
+def batch_keys(name, *key_parts):
+    tag = ':'.join(str(part) for part in key_parts)
+    key = f'{config.APP_NAME}:{name}:{{{tag}}}'
+    return key, f'{key}:SCHEDULED'
+
+
+def add(keys, item, window_ms):
+    """Returns (batch length, True when a flush must be scheduled) or None"""
+    result = redis_cache.eval(ADD_SCRIPT, 2, *keys,
+                              json.dumps(item, default=str), window_ms * 3)
+    if not result:
+        return None
+    return result[0], bool(result[1])
+
+
+def take(keys, limit=0):
+    return [json.loads(item) for item in
+            redis_cache.eval(TAKE_SCRIPT, 2, *keys, limit) or []]
+
+
+def restore(keys, items, delay_ms):
+    """
+    Puts items taken from the batch back in front of the newer ones. Returns
+    True when they were restored; a flush must then be scheduled after
+    delay_ms.
+    """
+    return bool(redis_cache.eval(
+        RESTORE_SCRIPT, 2, *keys, delay_ms * 3,
+        *[json.dumps(item, default=str) for item in items]))
+
+
+def schedule_flush(keys, task_name, args, window_ms):
+    try:
+        app.send_task(task_name, args=args, countdown=window_ms / 1000,
+                      queue=TASK_MODULE)
+    except Exception as e:
+        log.exception(f'Error while scheduling flush of {keys[0]}: {e}')
+        # Next item of the batch schedules it
+        redis_cache.delete(keys[1])
+
+
+def is_batched(worker, outbox=False):
+    # Outbox dispatches must stay in the transaction of the message
+    return bool(config.CRM_BATCH_WINDOW_MS) and not outbox and \
+        worker in config.CRM_BATCH_CHANNELS
+
+
+def _group(payload):
+    return payload.get('type') or ''
+
+
+def batch_payload(worker, payloads):
+    if worker == CHANNEL_BULLHORN:
+        return dict(payloads[0], messages=[
+            message for payload in payloads for message in payload['messages']
+        ])
+    return {'batch': True, 'messages': payloads}
+
+
+def batch_sms_ids(worker, payloads):
+    """Ids of the messages in the batch, as named by the channel payloads"""
+    if worker == CHANNEL_BULLHORN:
+        return [message.get('id') for payload in payloads
+                for message in payload['messages']]
+    return [payload.get('incoming_id') or payload.get('sms_id')
+            for payload in payloads]
+
+
+def add_payload(send_sync_task, account_id, worker, payload):
+    """
+    Adds the payload to its batch, sending the batch when it is full.
+    Returns False when Redis is not reachable; the payload is then sent on
+    its own.
+    """
+    group = _group(payload)
+    keys = batch_keys('CRM_BATCH', account_id, worker, group)
+    added = add(keys, payload, config.CRM_BATCH_WINDOW_MS)
+    if added is None:
+        return False
+    length, schedule = added
+    if length >= config.CRM_BATCH_SIZE:
+        try:
+            send_batch(send_sync_task, account_id, worker, group)
+        except Exception as e:
+            # The payload is buffered again, so it is still dispatched
+            log.exception(f'Error while sending batch of {worker} for '
+                          f'account {account_id}: {e}')
+    elif schedule:
+        schedule_flush(keys, FLUSH_CRM_BATCH_TASK_NAME,
+                       [account_id, worker, group], config.CRM_BATCH_WINDOW_MS)
+    return True
+
+
+def send_batch(send_sync_task, account_id, worker, group):
+    keys = batch_keys('CRM_BATCH', account_id, worker, group)
+    payloads = take(keys, config.CRM_BATCH_SIZE)
+    if not payloads:
+        return 0
+    attempts = [payload.pop(ATTEMPTS_FIELD, 0) for payload in payloads]
+    try:
+        send_sync_task.send_with_payload(
+            account_id, worker, batch_payload(worker, payloads),
+            sms_ids=batch_sms_ids(worker, payloads))
+    except CircuitOpenError:
+        # Retried once the circuit may close, without using an attempt
+        for payload, attempt in zip(payloads, attempts):
+            payload[ATTEMPTS_FIELD] = attempt
+        _retry_batch(keys, payloads, [account_id, worker, group],
+                     config.CIRCUIT_RESET_TIMEOUT * 1000)
+        raise
+    except Exception:
+        retried, dropped = [], []
+        for payload, attempt in zip(payloads, attempts):
+            if attempt + 1 >= config.CRM_BATCH_MAX_ATTEMPTS:
+                dropped.append(payload)
+            else:
+                retried.append(dict(payload, **{ATTEMPTS_FIELD: attempt + 1}))
+        if dropped:
+            log.error(f'Dropped {len(dropped)} payloads of {worker} for '
+                      f'account {account_id} after '
+                      f'{config.CRM_BATCH_MAX_ATTEMPTS} attempts')
+            log_json.error('CRM batch payloads dropped.', extra={
+                'account_id': account_id, 'worker': worker,
+                'sms_ids': batch_sms_ids(worker, dropped)})
+        if retried:
+            _retry_batch(keys, retried, [account_id, worker, group],
+                         config.CRM_BATCH_WINDOW_MS)
+        raise
+    log_json.info('CRM batch sent.', extra={
+        'account_id': account_id, 'worker': worker,
+        'messages': len(payloads)})
+    return len(payloads)
+
+
+def _retry_batch(keys, payloads, args, delay_ms):
+    if restore(keys, payloads, delay_ms):
+        schedule_flush(keys, FLUSH_CRM_BATCH_TASK_NAME, args, delay_ms)
+    else:
+        log.error(f'{len(payloads)} payloads of {keys[0]} could not be '
+                  f'buffered again')
+
+
+def flush_batches(send_sync_task, account_id, worker, group):
+    """Sends everything buffered for the batch, CRM_BATCH_SIZE at a time"""
+    total = 0
+    while True:
+        sent = send_batch(send_sync_task, account_id, worker, group)
+        if not sent:
+            return total
+        total += sent
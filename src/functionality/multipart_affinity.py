@@ -0,0 +1,170 @@
+"""
+Multipart affinity: all parts of a multipart message are processed by one
+process, so parts are counted and assembled in memory.
+
+Parts arriving on the main queue are forwarded to one of MULTIPART_PARTITIONS
+queues, picked by jump consistent hash on (shortcode, mobile number, reference
+id). Every partition queue has a single consumer process. Parts are still
+saved to database; the database count and read back are used only for
+messages whose earlier parts may have been handled by another process, i.e.
+after a consumer restart, a change of the partition count or a buffer
+eviction.
+"""
+import json
+from collections import OrderedDict
+from hashlib import md5
+from time import time
+
+from src import config
+from src.functionality.multipart_deadline import is_sweeper_running
+from src.models.database import db_model
+from src.models.incoming_sms import join_parts
+from src.utils.celery_app import app
+from src.utils.config_loggers import log
+from src.utils.constants import MULTIPART_QUEUE_PREFIX, SMS_TASK_NAME
+
+
+def jump_hash(key, buckets):
+    """Jump consistent hash (Lamping, Veach): int key -> [0, buckets)"""
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def partition_of(params, partitions=None):
+    partitions = partitions or config.MULTIPART_PARTITIONS
+    key = ':'.join(str(params.get(k, '')).lstrip('+') for k in
+                   ('shortCode', 'mobilenumber', 'referenceId'))
+    return jump_hash(int.from_bytes(md5(key.encode()).digest()[:8], 'big'),
+                     partitions)
+
+
+def partition_queue(partition):
+    return f'{MULTIPART_QUEUE_PREFIX}.{partition}'
+
+
+def is_partitioned(params):
+    """Part was routed to its partition consumer"""
+    return params.get('partition') is not None
+
+
+def forward_to_partition(payload):
+    """
+    Sends a part received on the main queue to its partition queue. Returns
+    True when the part was forwarded and nothing is left to do here.
+    """
+    if not config.MULTIPART_PARTITIONS or is_partitioned(payload):
+        return False
+    if not payload.get('isMultiPart') or \
+            int(payload.get('totalParts') or 0) <= 1:
+        return False
+
+    partition = partition_of(payload)
+    app.send_task(SMS_TASK_NAME,
+                  args=[json.dumps(dict(payload, partition=partition,
+                                        queuedAt=time()))],
+                  queue=partition_queue(partition))
+    log.info(f'Part {payload.get("referenceId")}:'
+             f'{payload.get("partOrderNumber")} forwarded to partition '
+             f'{partition}')
+    return True
+
+
+class PartBuffer(object):
+    """
+    Parts of multipart messages seen by this process, kept for `ttl` seconds.
+    A message is trusted, i.e. counted and assembled from the buffer, only if
+    its first part arrived after the buffer had seen everything for the last
+    `ttl` seconds: at least `ttl` after start, and `ttl` after the last
+    eviction of an unfinished message.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.groups = OrderedDict()
+        # Every part seen since then is in the buffer, unless expired
+        self.complete_since = time()
+
+    def set_ttl(self, ttl):
+        if ttl > self.ttl:
+            # Groups older than the previous ttl are gone already
+            self.complete_since = max(self.complete_since, time() - self.ttl)
+        self.ttl = ttl
+
+    def add(self, key, part_number, message):
+        now = time()
+        self._expire(now)
+        group = self.groups.get(key)
+        if group is None:
+            trusted = now >= self.complete_since + self.ttl
+            group = self.groups[key] = {'since': now, 'parts': {},
+                                        'trusted': trusted}
+            if len(self.groups) > self.size:
+                evicted, _ = self.groups.popitem(last=False)
+                log.warning(f'Part buffer full, evicted {evicted}')
+                self.complete_since = now
+        group['parts'][part_number] = message
+        return group
+
+    def pop(self, key):
+        return self.groups.pop(key, None)
+
+    def _expire(self, now):
+        while self.groups:
+            key, group = next(iter(self.groups.items()))
+            if group['since'] + self.ttl > now:
+                break
+            del self.groups[key]
+
+
+def buffer_ttl():
+    """
+    Incomplete messages are handed to the deadline sweeper at their deadline,
+    so no earlier part can still be pending a sweep later. Without a running
+    sweeper, parts are assembled for PARTS_WINDOW.
+    """
+    if is_sweeper_running():
+        return config.MULTIPART_DEADLINE + config.MULTIPART_SWEEP_INTERVAL
+    return config.PARTS_WINDOW
+
+
+part_buffer = PartBuffer(config.MULTIPART_BUFFER_SIZE, config.PARTS_WINDOW)
+
+
+def _group_key(params):
+    return db_model.get_part_key(params.get('accountId'),
+                                 params.get('shortCode'),
+                                 params.get('mobilenumber'),
+                                 params.get('referenceId'))
+
+
+def add_part(params):
+    """Buffers the saved part and returns the count of parts received"""
+    part_buffer.set_ttl(buffer_ttl())
+    group = part_buffer.add(_group_key(params),
+                            db_model.get_part_number(params),
+                            params['message'])
+    if group['trusted']:
+        return len(group['parts'])
+    log.info('Part buffer not trusted for this message, counting from db')
+    return db_model.get_parts_count_from_db(params.get('referenceId'),
+                                            params.get('shortCode'),
+                                            params.get('accountId'),
+                                            params.get('mobilenumber'))
+
+
+def pop_buffered_message(params):
+    """
+    Returns the message assembled from buffered parts, or None when it has to
+    be assembled from database.
+    """
+    group = part_buffer.pop(_group_key(params))
+    if not group or not group['trusted'] or \
+            len(group['parts']) < params.get('totalParts'):
+        return None
+    parts = group['parts']
+    return join_parts([parts[n] for n in sorted(parts)])
@@ -0,0 +1,183 @@
+import json
+from time import time, monotonic
+
+from src import config
+from src.models.database import db_model
+from src.models.incoming_sms import assemble_message
+from src.utils.celery_app import app
+from src.utils.config_loggers import log, log_json
+from src.utils.constants import SMS_TASK_NAME, TASK_MODULE
+from src.utils.helper import byte_to_str
+from src.utils.redis_cache import redis_cache
+
+DEADLINES_KEY = f'{config.APP_NAME}:MULTIPART_DEADLINES'
+# Set by every sweep, so workers know the sweeper is running
+SWEEPER_SEEN_KEY = f'{config.APP_NAME}:MULTIPART_SWEEPER_SEEN'
+# Seconds for which a process reuses what it read of SWEEPER_SEEN_KEY
+SWEEPER_CHECK_INTERVAL = 60
+DELIVER, EXPIRE = 'deliver', 'expire'
+
+# Params of the first seen part needed to deliver the group later
+GROUP_PARAMS = ('providerId', 'providerName', 'messageId', 'mobilenumber',
+                'shortCode', 'referenceId', 'totalParts', 'channel_type',
+                'accountId')
+
+# Atomically pops up to ARGV[2] groups whose deadline is before ARGV[1]
+POP_SCRIPT = """
+local groups = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+                          'LIMIT', 0, ARGV[2])
+if #groups > 0 then
+    redis.call('ZREM', KEYS[1], unpack(groups))
+end
+return groups
+"""
+
+# Claims the group for ARGV[1]; the sweeper and the last part race for it.
+# Returns 1 for the owner, also when it claims again on a retry.
+CLAIM_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if not owner then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    return 1
+end
+if owner == ARGV[1] then
+    return 1
+end
+return 0
+"""
+SWEEPER = 'sweeper'
+
+_sweeper_seen = {'running': False, 'checked_at': None}
+
+
+def _group_key(params):
+    return db_model.get_part_key(params.get('accountId'),
+                                 params.get('shortCode'),
+                                 params.get('mobilenumber'),
+                                 params.get('referenceId'))
+
+
+def _params_key(group_key):
+    return f'{group_key}:DEADLINE'
+
+
+def schedule_deadline(params):
+    """Called for the first seen part of a multipart message."""
+    if not config.MULTIPART_SWEEP_INTERVAL:
+        return
+    group_key = _group_key(params)
+    group_params = {k: params[k] for k in GROUP_PARAMS if k in params}
+    redis_cache.set(_params_key(group_key), json.dumps(group_params),
+                    config.PARTS_WINDOW)
+    redis_cache.zadd(DEADLINES_KEY,
+                     **{group_key: time() + config.MULTIPART_DEADLINE})
+    log.info(f'Multipart deadline scheduled for {group_key}')
+
+
+def _claim(group_key, owner):
+    """
+    Only the owner delivers (or expires) the group. Delivered when Redis is
+    not reachable, as before the deadline scheduler.
+    """
+    claimed = redis_cache.eval(CLAIM_SCRIPT, 1, f'{group_key}:CLAIMED', owner,
+                               config.PARTS_WINDOW)
+    return claimed != 0
+
+
+def cancel_deadline(params):
+    """
+    Called once all parts of a multipart message are received. Returns False
+    when the sweeper already handled the group at its deadline, so the
+    message must not be delivered again.
+    """
+    if not config.MULTIPART_SWEEP_INTERVAL:
+        return True
+    group_key = _group_key(params)
+    owner = str(params.get('entry_id') or params.get('messageId') or 'part')
+    if not _claim(group_key, owner):
+        log_json.warning('Multipart message handled at its deadline, last '
+                         'part not delivered again.',
+                         extra={'group_key': group_key})
+        return False
+    redis_cache.zrem(DEADLINES_KEY, group_key)
+    redis_cache.delete(_params_key(group_key))
+    return True
+
+
+def is_sweeper_running():
+    """
+    True when the sweeper ran within the last few sweep intervals. False when
+    Redis is not reachable.
+    """
+    if not config.MULTIPART_SWEEP_INTERVAL:
+        return False
+    checked_at = _sweeper_seen['checked_at']
+    if checked_at is None or \
+            monotonic() - checked_at >= SWEEPER_CHECK_INTERVAL:
+        _sweeper_seen['running'] = bool(redis_cache.get(SWEEPER_SEEN_KEY))
+        _sweeper_seen['checked_at'] = monotonic()
+    return _sweeper_seen['running']
+
+
+def sweep_expired_groups():
+    """
+    Pops multipart groups past their deadline in batches and delivers what has
+    arrived so far, or expires the parts, per MULTIPART_DEADLINE_ACTION.
+    """
+    log.info('Inside function sweep_expired_groups')
+    redis_cache.set(SWEEPER_SEEN_KEY, 1,
+                    config.MULTIPART_SWEEP_INTERVAL * 3 +
+                    SWEEPER_CHECK_INTERVAL)
+    swept = 0
+    while True:
+        groups = redis_cache.eval(POP_SCRIPT, 1, DEADLINES_KEY, time(),
+                                  config.MULTIPART_SWEEP_BATCH) or []
+        for group_key in groups:
+            try:
+                _handle_expired_group(group_key)
+            except Exception as e:
+                log.exception(f'Error while sweeping {group_key}: {e}')
+                log_json.exception('Error while sweeping incomplete multipart '
+                                   'message', extra={'error': str(e)})
+        swept += len(groups)
+        if len(groups) < config.MULTIPART_SWEEP_BATCH:
+            break
+    log.info(f'Swept {swept} incomplete multipart messages')
+    return swept
+
+
+def _handle_expired_group(group_key):
+    if not _claim(group_key, SWEEPER):
+        log.info(f'Multipart {group_key} completed by its last part')
+        return
+    params_json = redis_cache.get(_params_key(group_key))
+    redis_cache.delete(_params_key(group_key))
+    if not params_json:
+        log.warning(f'No params found for expired multipart {group_key}')
+        return
+    params = json.loads(params_json)
+    log_json.warning('Multipart message incomplete at its deadline.',
+                     extra={'group_key': group_key,
+                            'action': config.MULTIPART_DEADLINE_ACTION})
+
+    if config.MULTIPART_DEADLINE_ACTION == DELIVER:
+        _deliver_partial_message(params)
+    else:
+        db_model.expire_parts_of_sms(params['referenceId'],
+                                     params['shortCode'],
+                                     params['accountId'],
+                                     params['mobilenumber'])
+
+
+def _deliver_partial_message(params):
+    message = assemble_message(params)
+    if not message:
+        log.warning(f'No parts left to deliver for {params}')
+        return
+    # Processed as a complete message; parts are linked to the saved sms
+    # afterwards through the isCronRequest branch of the handler.
+    params.update(message=byte_to_str(message), isMultiPart=False,
+                  isCronRequest=True)
+    params.pop('accountId', None)
+    app.send_task(SMS_TASK_NAME, args=[json.dumps(params)], queue=TASK_MODULE)
+    log.info(f'Partial multipart message {params["referenceId"]} queued')
@@ -0,0 +1,127 @@
+"""
+Outbox relay: publishes channel dispatches saved with incoming messages.
+
+Pending entries are claimed in batches (SELECT ... FOR UPDATE SKIP LOCKED, so
+several relays can run side by side), published on one broker connection
+with publisher confirms, and marked with one UPDATE per batch. Delivery is at
+least once: an entry published right before a crash is published again.
+Failed entries are retried with a backoff; entries of an exchange whose
+circuit is open are put off, so they do not hold back the others.
+When idle, relays delete sent entries older than OUTBOX_RETENTION.
+
+    python -m src.functionality.outbox_relay
+"""
+import json
+from time import sleep, time, monotonic
+
+from src import config
+from src.functionality.sync import SendSyncTask
+from src.models.database import db_model
+from src.models.outbox import OUTBOX_ARG_PAYLOAD, OUTBOX_ARG_ENTRY_ID, \
+    OUTBOX_ARG_EVENT
+from src.utils.celery_app import app
+from src.utils.circuit_breaker import CircuitOpenError
+from src.utils.config_loggers import log, log_json
+
+# Publish returns only once the broker has confirmed the message
+CONFIRM_OPTIONS = {'broker_transport_options': {'confirm_publish': True}}
+# Sent entries deleted per statement, and seconds between pruning rounds
+PRUNE_CHUNK_SIZE = 1000
+PRUNE_INTERVAL = 60
+
+
+def publish(send_sync_task, entry):
+    payload = json.loads(entry['payload'])
+    if entry['arg'] == OUTBOX_ARG_PAYLOAD:
+        return send_sync_task.send_with_payload(entry['account_id'],
+                                                entry['worker'], payload)
+    if entry['arg'] == OUTBOX_ARG_ENTRY_ID:
+        return send_sync_task.send_with_entry_id(entry['worker'], payload)
+    if entry['arg'] == OUTBOX_ARG_EVENT:
+        return send_sync_task.send_event(entry['account_id'], **payload)
+    raise ValueError('Outbox: arg not supported')
+
+
+def relay_batch(send_sync_task):
+    """
+    Publishes one batch of pending entries, returns how many were published
+    or failed. Entries put off for an open circuit are not counted, so a
+    batch of them is polled like an idle one.
+    """
+    entries = db_model.claim_outbox_entries(config.OUTBOX_BATCH_SIZE)
+    if not entries:
+        # Ends the transaction of the empty claim
+        db_model.commit_session()
+        return 0
+
+    ts = time()
+    sent_ids, failed_ids, deferred_ids = [], [], []
+    for entry in entries:
+        try:
+            publish(send_sync_task, entry)
+            sent_ids.append(entry['id'])
+        except CircuitOpenError as e:
+            # Exchange is failing; put off without using an attempt
+            log.warning(f'Outbox entry {entry["id"]} not published: {e}')
+            deferred_ids.append(entry['id'])
+        except Exception as e:
+            log.exception(f'Error while publishing outbox entry '
+                          f'{entry["id"]}: {e}')
+            failed_ids.append(entry['id'])
+
+    # Marked before anything else commits: the commit releases the claims,
+    # and entries still pending then would be published by another relay
+    db_model.mark_outbox_entries(sent_ids, failed_ids,
+                                 config.OUTBOX_MAX_ATTEMPTS,
+                                 deferred_ids=deferred_ids)
+    # In a transaction of its own; ids left unregistered on an error are
+    # registered with the next batch
+    send_sync_task.register_tasks()
+    db_model.commit_session()
+    log_json.info('Outbox batch relayed.', extra={
+        'entries': len(entries), 'sent': len(sent_ids),
+        'failed': len(failed_ids), 'deferred': len(deferred_ids),
+        'duration': round(time() - ts, 3)})
+    return len(sent_ids) + len(failed_ids)
+
+
+def prune_sent_entries():
+    """Deletes one chunk of expired sent entries, returns its size"""
+    deleted = db_model.delete_sent_outbox_entries(config.OUTBOX_RETENTION,
+                                                  PRUNE_CHUNK_SIZE)
+    if deleted:
+        log_json.info('Sent outbox entries pruned.',
+                      extra={'entries': deleted})
+    return deleted
+
+
+def run():
+    log.info('Outbox relay started')
+    app.conf.update(**CONFIRM_OPTIONS)
+    send_sync_task = SendSyncTask(celery_config=dict(config.CELERY_CONFIG,
+                                                     **CONFIRM_OPTIONS))
+    pruned_at = 0
+    while True:
+        try:
+            count = relay_batch(send_sync_task)
+        except Exception as e:
+            log.exception(f'Error in outbox relay: {e}')
+            db_model.rollback_session()
+            count = 0
+        if count >= config.OUTBOX_BATCH_SIZE:
+            continue
+        if config.OUTBOX_RETENTION and \
+                monotonic() - pruned_at >= PRUNE_INTERVAL:
+            # A chunk per idle poll until the expired entries are gone
+            try:
+                if prune_sent_entries() < PRUNE_CHUNK_SIZE:
+                    pruned_at = monotonic()
+            except Exception as e:
+                log.exception(f'Error while pruning outbox entries: {e}')
+                db_model.rollback_session()
+                pruned_at = monotonic()
+        sleep(config.OUTBOX_POLL_INTERVAL)
+
+
+if __name__ == '__main__':
+    run()
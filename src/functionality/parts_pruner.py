@@ -0,0 +1,48 @@
+from time import sleep
+
+from src import config
+from src.models.database import db_model, acquire_prune_lock, \
+    release_prune_lock
+from src.utils.config_loggers import log, log_json
+
+
+def prune_stale_parts():
+    """
+    Archives incoming_sms_parts rows older than the parts window to
+    PARTS_ARCHIVE_TABLE in primary key chunks, so the table and its indexes
+    stay small. Parts are kept for audit, so nothing is pruned without an
+    archive table; migrations/003_create_incoming_sms_parts_archive.sql
+    creates incoming_sms_parts_archive. Only one pruner runs at a time across
+    workers.
+    """
+    log.info('Inside function prune_stale_parts')
+    if not config.PARTS_ARCHIVE_TABLE:
+        log.error('PARTS_ARCHIVE_TABLE is not set, parts are not pruned')
+        return 0
+    token = acquire_prune_lock(config.PARTS_PRUNE_INTERVAL or 3600)
+    if not token:
+        log.info('Parts pruning is already running, skipping')
+        return 0
+
+    total = 0
+    try:
+        watermark = db_model.refresh_part_watermark()
+        if not watermark:
+            return 0
+
+        for _ in range(config.PARTS_PRUNE_MAX_CHUNKS):
+            deleted = db_model.delete_parts_below(
+                watermark, config.PARTS_PRUNE_CHUNK_SIZE,
+                archive_table=config.PARTS_ARCHIVE_TABLE)
+            total += deleted
+            if deleted < config.PARTS_PRUNE_CHUNK_SIZE:
+                break
+            # Give replication and the incoming workers some room
+            sleep(0.1)
+    finally:
+        release_prune_lock(token)
+
+    log.info(f'Pruned {total} incoming_sms_parts rows below id {watermark}')
+    log_json.info('Pruned stale incoming sms parts.',
+                  extra={'pruned_parts': total, 'watermark': watermark})
+    return total
@@ -0,0 +1,94 @@
+"""
+Routing plan of an account: which channels an incoming message is pushed to.
+
+The plan depends only on account tags and the incoming config, so it is
+compiled once per (account, incoming config) and kept in process. Each
+message still reads the account tags (one cache lookup); the plan is
+recompiled when any tag or config value it was built from has changed.
+"""
+from collections import OrderedDict, namedtuple
+
+from src.models.account import get_account_tags
+from src.utils.config_loggers import log
+from src.utils.constants import IS_PUSH_ENABLED_ACCOUNT_TAG_FLAG_NAME, \
+    IS_CONVERSE_DESK_ENABLED_ACCOUNT_TAG_FLAG_NAME
+
+SUBSCRIPTION_TAG = 'subscription_management'
+LIVE_CHAT_TAG = 'isLiveChatEnabled'
+PUSH_TO_URL_TAG = 'push_incoming_to_url'
+
+ROUTING_TAGS = (IS_PUSH_ENABLED_ACCOUNT_TAG_FLAG_NAME,
+                IS_CONVERSE_DESK_ENABLED_ACCOUNT_TAG_FLAG_NAME,
+                SUBSCRIPTION_TAG, LIVE_CHAT_TAG, PUSH_TO_URL_TAG)
+
+# incoming config flag: IncomingSMSSync push method, in push order
+PLATFORM_CHANNELS = (
+    ('push_to_sf', 'push_to_salesforce'),
+    ('push_to_zoho', 'push_to_zoho'),
+    ('push_to_bullhorn', 'push_to_bullhorn'),
+    ('push_to_url', 'push_to_url'),
+    ('push_to_email', 'push_to_email'),
+    ('push_to_live_chat', 'push_to_live_chat')
+)
+
+ROUTING_CONFIG_KEYS = ('id', 'bot_status') + \
+    tuple(flag for flag, _ in PLATFORM_CHANNELS)
+
+MAX_PLANS = 10000
+
+# channels - IncomingSMSSync push methods to call, in order
+# is_converse_desk - incoming messages are routed through Converse Desk
+# push_url_fallback - use account level push URL setting when the incoming
+# config has none
+RoutingPlan = namedtuple('RoutingPlan', ['channels', 'is_converse_desk',
+                                         'push_url_fallback'])
+
+_plans = OrderedDict()
+
+
+def compile_routing_plan(tags, account_config):
+    is_converse_desk = bool(
+        tags.get(IS_CONVERSE_DESK_ENABLED_ACCOUNT_TAG_FLAG_NAME, 0))
+    channels = []
+
+    # Usual channels to push incoming messages
+    if tags.get(IS_PUSH_ENABLED_ACCOUNT_TAG_FLAG_NAME):
+        channels.append('push_to_mobile')
+    # If Converse Desk is enabled then bot and subscription are routed
+    # through the Converse Desk
+    if account_config.get('bot_status') and not is_converse_desk:
+        channels.append('push_to_bot')
+    if tags.get(SUBSCRIPTION_TAG) and not is_converse_desk:
+        channels.append('push_to_subscription')
+    channels.append('push_to_converse_desk' if is_converse_desk else
+                    'push_to_auto_reply_business_hour')
+
+    # Platform specific channels to push incoming messages
+    for flag, push_method in PLATFORM_CHANNELS:
+        if not account_config.get(flag):
+            continue
+        if push_method == 'push_to_live_chat' and not tags.get(LIVE_CHAT_TAG):
+            continue
+        channels.append(push_method)
+
+    return RoutingPlan(channels=tuple(channels),
+                       is_converse_desk=is_converse_desk,
+                       push_url_fallback=bool(tags.get(PUSH_TO_URL_TAG)))
+
+
+def get_routing_plan(account_id, account_config):
+    tags = get_account_tags(account_id=account_id)
+    key = (account_id, account_config.get('id'))
+    fingerprint = (tuple(tags.get(t) for t in ROUTING_TAGS),
+                   tuple(account_config.get(k) for k in ROUTING_CONFIG_KEYS))
+
+    cached = _plans.get(key)
+    if cached and cached[0] == fingerprint:
+        return cached[1]
+
+    plan = compile_routing_plan(tags, account_config)
+    log.info(f'Routing plan compiled for {key}: {plan}')
+    _plans[key] = (fingerprint, plan)
+    if len(_plans) > MAX_PLANS:
+        _plans.popitem(last=False)
+    return plan
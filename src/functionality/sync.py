@@ -1,104 +1,291 @@
+import datetime
 import json
-from copy import deepcopy
+import socket
 from time import mktime, strptime
 
+from amqp.exceptions import ConnectionError as AMQPConnectionError
 from celery import current_task
+from kombu.exceptions import OperationalError
 from send_task import SendTask
 from sm_utils.utils import function_logger, generate_payload_for_crm
 
 from src import config
 from src.config import SQLALCHEMY_DATABASE_URI, BROKER_URL, get_worker_config, \
     CELERY_CONFIG
-from src.models.account import is_push_enabled_account, \
-    get_account_id_or_parent_id, is_saas_converse_desk_enabled
+from src.functionality.email_digest import is_digest_account, \
+    buffer_message, take_messages, restore_messages
+from src.functionality.micro_batch import is_batched, add_payload, \
+    flush_batches
+from src.functionality.routing import get_routing_plan
+from src.models.account import get_account_id_or_parent_id
 from src.models.database import db_model
 from src.models.incoming_sms import is_account_hipaa_enabled
+from src.models.outbox import OUTBOX_ARG_PAYLOAD, OUTBOX_ARG_ENTRY_ID, \
+    OUTBOX_ARG_EVENT, OUTBOX_STATUS_PENDING
+from src.utils.circuit_breaker import get_breaker, CircuitOpenError
 from src.utils.config_loggers import log, log_json
 from src.utils.constants import *
-from src.utils.helper import handle_exceptions, insensitive_data, map_keys
+from src.utils.helper import handle_exceptions, insensitive_data, \
+    compile_projection, message_view
 from src.utils.message_event import MessageEvent
 
+# Channel payload schemas, compiled once.
+# key_from_message: required_key_for_worker_payload
+MOBILE_PAYLOAD = compile_projection({
+    'message': 'sms_text',
+    'mobilenumber': 'mobile_number',
+    'accountId': 'account_id',
+    'sms_id': 'incoming_id',
+    'shortCode': 'sender_id',
+    'mms_urls': 'mms_url',
+    'channel_type': 'channel_type'
+})
+SALESFORCE_PAYLOAD = compile_projection({
+    'message': 'sms_text',
+    'mobilenumber': 'mobile_number',
+    'shortCode': 'inbound_number',
+    'accountId': 'account_id',
+    'sms_id': 'incoming_id',
+    'mms_urls': 'mms_url',
+    'providerName': 'providerName',
+    'created_on': 'created_on',
+    'channel_type': 'channel_type',
+    'event_type': 'event_type'
+})
+ZOHO_PAYLOAD = compile_projection({
+    'message': 'sms_text',
+    'mobilenumber': 'mobile_number',
+    'shortCode': 'inbound_number',
+    'accountId': 'account_id',
+    'sms_id': 'sms_id',
+    'mms_urls': 'mms_url'
+})
+BULLHORN_PAYLOAD = compile_projection({
+    'sms_id': 'id',
+    'message': 'text',
+    'mms_urls': 'mms_url'
+})
+LIVE_CHAT_PAYLOAD = compile_projection({'sms_id': 'message_id'})
+EMAIL_CONTENT = compile_projection({
+    'message': 'text',
+    'mobilenumber': 'mobilenumber',
+    'shortCode': 'shortcode',
+    'mms_urls': 'mms_urls'
+})
+BOT_PAYLOAD = compile_projection({
+    'sms_id': 'sms_id',
+    'message': 'sms_text',
+    'mobilenumber': 'phone_number',
+    'shortCode': 'short_code',
+    'accountId': 'account_id'
+})
+SUBSCRIPTION_PAYLOAD = compile_projection({
+    'message': 'message',
+    'mobilenumber': 'mobile_number',
+    'shortCode': 'sender_id',
+    'accountId': 'account_id',
+    'keyword': 'keyword',
+    'subKeyword': 'sub_keyword'
+})
+
+
+def save_push_email(account_id, email_content, subject, commit=True,
+                    template_type=PUSH_EMAIL_TEMPLATE_TYPE):
+    """Saves the email log of push to email, returns the worker payload"""
+    account_info = db_model.get_account_info(account_id)
+    email_content['name'] = account_info['contact_name']
+    email = db_model.save_email(
+        commit=commit,
+        from_address=EMAIL_FROM_ADDRESS,
+        to_address=account_info['email_id'],
+        cc=CC_ADDRESS,
+        subject=subject,
+        template_type=template_type,
+        variable_field_values=json.dumps(email_content))
+    return {'system_email_log_id': email['id']}
+
+
+# Errors of the broker connection; others (payload, task log row) are about
+# the dispatch, not the exchange
+BROKER_CONNECTION_ERRORS = (OperationalError, AMQPConnectionError,
+                            ConnectionError, socket.timeout)
+
+
+def _is_broker_failure(e):
+    return isinstance(e, BROKER_CONNECTION_ERRORS)
+
 
 class SendSyncTask(object):
 
-    def __init__(self):
+    def __init__(self, celery_config=None):
         self.send_task_obj = SendTask(
             database_url=SQLALCHEMY_DATABASE_URI,
-            broker_url=BROKER_URL, **CELERY_CONFIG,
-            request_id=current_task.request.id,
+            broker_url=BROKER_URL, **(celery_config or CELERY_CONFIG),
+            request_id=current_task.request.id if current_task else None,
             logger_name=config.DEFAULT_LOGGER_NAME
         )
+        # Downstream task ids, registered in one go by register_tasks():
+        # {is_hipaa: {entry_id: task_id}}
+        self.task_ids = {}
+        self._hipaa_accounts = {}
 
-    def send_with_payload(self, account_id, worker, payload):
+    def send_with_payload(self, account_id, worker, payload, sms_ids=None):
+        """sms_ids: messages of a batch payload, logged with its task"""
         func = self.send_task_obj.generic_send_task
-        return self._send(account_id, worker, payload, func)
+        return self._send(account_id, worker, payload, func, sms_ids)
 
     def send_with_entry_id(self, worker, payload):
         func = self.send_task_obj.generic_send_task_arg_entry_id
         account_id = payload.get('account_id')
         return self._send(account_id, worker, payload, func)
 
-    def _send(self, account_id, worker, payload, func):
+    @staticmethod
+    def send_event(account_id, message_id, subscription_payload=None,
+                   bot_status=False):
+        MessageEvent().in_event(message_id,
+                                subscription_payload=subscription_payload,
+                                bot_status=bot_status)
+        return True
+
+    def _send(self, account_id, worker, payload, func, sms_ids=None):
         worker_config = self._get_worker_config(worker)
-        result = func(
+        # Fails fast with CircuitOpenError while the exchange is failing
+        breaker = get_breaker(f'exchange:{worker_config.get("exchange")}',
+                              is_failure=_is_broker_failure)
+        result = breaker.call(
+            func,
             payload=payload,
             **worker_config
         )
+        if sms_ids:
+            self._log_batch_task(worker, result, sms_ids)
         return self._update_task(account_id, result)
 
+    @staticmethod
+    def _log_batch_task(worker, result, sms_ids):
+        # One task row for the whole batch; each message is traced to it
+        task, entry_id = result
+        for sms_id in sms_ids:
+            log_json.info(f'Message sent to {worker} in a batch.', extra={
+                'sms_id': sms_id, 'task_id': str(task), 'entry_id': entry_id,
+                'batch_size': len(sms_ids)})
+
+    def register_tasks(self):
+        """Stores task ids of all dispatched channels of the message"""
+        log.info(f'Inside function register_tasks = {self.task_ids}')
+        for is_hipaa, task_ids in self.task_ids.items():
+            db_model.update_celery_task_ids(is_hipaa, task_ids)
+        self.task_ids = {}
+
     @staticmethod
     def _get_worker_config(worker):
         return get_worker_config(worker)
 
-    @staticmethod
-    def _update_task(account_id, result):
+    def _update_task(self, account_id, result):
         task, entry_id = result
         log.info(f'Inside function _update_task = {task}, {entry_id}')
-        is_hipaa = is_account_hipaa_enabled(account_id)
-        db_model.update_celery_task_id(is_hipaa, entry_id, task)
+        self.task_ids.setdefault(self._is_hipaa(account_id), {})[entry_id] = \
+            task
+        return True
+
+    def _is_hipaa(self, account_id):
+        if account_id not in self._hipaa_accounts:
+            self._hipaa_accounts[account_id] = is_account_hipaa_enabled(
+                account_id)
+        return self._hipaa_accounts[account_id]
+
+
+class OutboxWriter(object):
+    """
+    Same interface as SendSyncTask, but dispatches are saved to the outbox in
+    the current transaction and published later by the outbox relay.
+    """
+
+    def __init__(self, account_id, sms_id):
+        self.account_id = account_id
+        self.sms_id = sms_id
+        self.entries = []
+
+    def send_with_payload(self, account_id, worker, payload, sms_ids=None):
+        return self._add(worker, OUTBOX_ARG_PAYLOAD, payload)
+
+    def send_with_entry_id(self, worker, payload):
+        return self._add(worker, OUTBOX_ARG_ENTRY_ID, payload)
+
+    def send_event(self, account_id, message_id, subscription_payload=None,
+                   bot_status=False):
+        return self._add(CHANNEL_CONVERSE_DESK, OUTBOX_ARG_EVENT, {
+            'message_id': message_id,
+            'subscription_payload': subscription_payload,
+            'bot_status': bot_status
+        })
+
+    def register_tasks(self):
+        log.info(f'Inside function OutboxWriter.register_tasks: '
+                 f'{len(self.entries)} entries')
+        db_model.add_outbox_entries(self.entries)
+        self.entries = []
+
+    def _add(self, worker, arg, payload):
+        self.entries.append({
+            'incoming_sms_id': self.sms_id,
+            'account_id': self.account_id,
+            'worker': worker,
+            'arg': arg,
+            'payload': json.dumps(payload, default=str),
+            'request_id': current_task.request.id if current_task else None,
+            'status': OUTBOX_STATUS_PENDING,
+            'attempts': 0,
+            'created_on': datetime.datetime.now(datetime.timezone.utc)
+        })
         return True
 
 
 class IncomingSMSSync(object):
 
-    def __init__(self, message, account_config):
-        self.message = deepcopy(message)
+    def __init__(self, message, account_config, journal=None, outbox=False):
+        self.message = message_view(message)
         self.account_config = account_config
-        self.send_sync_task = SendSyncTask()
+        # Stage journal of the message; channels already dispatched by an
+        # earlier attempt are skipped.
+        self.journal = journal
+        # Dispatches are saved to the outbox instead of being published
+        self.outbox = outbox
+        self._subscription_payload = None
+        # Workers not dispatched as their exchange circuit was open
+        self.circuit_open = []
         # Fetch parent account details if auth is not  set for this account
         self.set_account_with_valid_auth()
         self.account_id = int(self.message.get('accountId'))
+        self.send_sync_task = OutboxWriter(self.account_id,
+                                           self.message['sms_id']) \
+            if outbox else SendSyncTask()
+        self.routing_plan = get_routing_plan(self.account_id, account_config)
 
     def push(self):
         log.info('Inside function IncomingSMSSync.push')
         log.info(f'Push to channels for account :{self.account_id}')
 
-        # Usual channels to push incoming messages
-        self.push_to_mobile()
-        self.push_to_bot()
-        self.push_to_subscription()
-        self.push_to_converse_desk()
-
-        # Platform specific channels to push incoming messages
-        sync_map = {
-            'sf': self.push_to_salesforce,
-            'zoho': self.push_to_zoho,
-            'bullhorn': self.push_to_bullhorn,
-            'url': self.push_to_url,
-            'email': self.push_to_email,
-            'live_chat': self.push_to_live_chat
-        }
-
-        for channel, sync_func in sync_map.items():
-            if self.account_config.get(f'push_to_{channel}'):
-                sync_func()
+        try:
+            self._push()
+        finally:
+            # Task ids of all dispatched channels are stored together
+            self.send_sync_task.register_tasks()
+
+    def _push(self):
+        # Channels are decided by the routing plan of the account
+        log.info(f'Routing plan channels: {self.routing_plan.channels}')
+        for push_method in self.routing_plan.channels:
+            getattr(self, push_method)()
+        if self.circuit_open:
+            # The other channels were dispatched and are skipped by the
+            # retried task, which dispatches these once the circuit closes
+            raise CircuitOpenError(f'Circuit open, not dispatched: '
+                                   f'{", ".join(self.circuit_open)}')
 
     @handle_exceptions
     def push_to_mobile(self):
         log.info('Inside function IncomingSMSSync.push_to_mobile')
-        if not is_push_enabled_account(account_id=self.account_id):
-            log.info("Push to mobile notification skipped")
-            return None
         payload = self._get_payload_for_mobile()
         self.send_task(CHANNEL_MOBILE, payload)
 
@@ -107,34 +294,27 @@ class IncomingSMSSync(object):
         log.info('Inside function IncomingSMSSync.push_to_bot')
         if not self._is_bot_enabled_for_incoming_number():
             return
-        # If Converse Desk is enabled then route messages through the Converse
-        # Desk
-        if is_saas_converse_desk_enabled(account_id=self.account_id):
-            return
-
         payload = self._get_payload_for_bot()
         self.send_task(CHANNEL_BOT, payload)
 
     @handle_exceptions
     def push_to_subscription(self):
         log.info('Inside function IncomingSMSSync.push_to_subscription')
-        if not self._is_subscription_mgmt_enabled():
-            return
-        if not is_saas_converse_desk_enabled(account_id=self.account_id):
-            payload = self._get_payload_for_subscription()
-            self.send_task(CHANNEL_SUBSCRIPTION, payload)
+        payload = self._get_payload_for_subscription()
+        self.send_task(CHANNEL_SUBSCRIPTION, payload)
 
     @handle_exceptions
     def push_to_converse_desk(self):
         log.info('Inside function IncomingSMSSync.push_to_converse_desk')
-        if is_saas_converse_desk_enabled(account_id=self.account_id):
-            return MessageEvent().in_event(
-                self.message.get("sms_id"),
-                subscription_payload=self._get_payload_for_auto_reply(),
-                bot_status=self._is_bot_enabled_for_incoming_number()
-            )
-        log.info("Push to conversation desk notification skipped")
-        return self.push_to_auto_reply_business_hour()
+        if self._is_dispatched(CHANNEL_CONVERSE_DESK):
+            return None
+        self.send_sync_task.send_event(
+            self.account_id,
+            self.message.get("sms_id"),
+            subscription_payload=self._get_payload_for_auto_reply(),
+            bot_status=self._is_bot_enabled_for_incoming_number()
+        )
+        return self._record_dispatch(CHANNEL_CONVERSE_DESK)
 
     @handle_exceptions
     def push_to_auto_reply_business_hour(self):
@@ -147,7 +327,6 @@ class IncomingSMSSync(object):
     @handle_exceptions
     def push_to_salesforce(self):
         log.info('Inside function IncomingSMSSync.push_to_salesforce')
-        self.message.update(bot_status=self.account_config.get('bot_status'))
         payload = self._get_payload_for_salesforce()
         log_json.info(f'Sending data to push to Salesforce: '
                       f'{CHANNEL_SALESFORCE_PUSH}')
@@ -182,7 +361,7 @@ class IncomingSMSSync(object):
         log_json.info(f'Sending data to push to URL: {CHANNEL_URL}')
 
         if (not payload.get('url') or not payload.get('request_type')) and \
-                self._is_push_to_url_enabled():
+                self.routing_plan.push_url_fallback:
             # If enabled, get the account level setting for Push Incoming SMS
             # to URL.
             payload = self._get_payload_for_url_from_account_config()
@@ -192,6 +371,19 @@ class IncomingSMSSync(object):
     @handle_exceptions
     def push_to_email(self):
         log.info('Inside function IncomingSMSSync.push_to_email')
+        # Payload for email saves the email log, so check before building it
+        if self._is_dispatched(CHANNEL_EMAIL):
+            return
+        # Outbox dispatches must stay in the transaction of the message,
+        # which a buffered message would outlive if it rolls back
+        if not self.outbox and is_digest_account(self.account_id) and \
+                buffer_message(self.account_id,
+                               dict(EMAIL_CONTENT(self.message),
+                                    sms_id=self.message['sms_id'])):
+            log_json.info(f'Message added to email digest: {CHANNEL_EMAIL}')
+            self.audit(CHANNEL_EMAIL)
+            self._record_dispatch(CHANNEL_EMAIL)
+            return
         payload = self._get_payload_for_email()
         log_json.info(f'Sending data to push to email: {CHANNEL_EMAIL}')
         self.send_task(CHANNEL_EMAIL, payload)
@@ -199,18 +391,30 @@ class IncomingSMSSync(object):
     @handle_exceptions
     def push_to_live_chat(self):
         log.info('Inside function IncomingSMSSync.push_to_live_chat')
-        if not self._is_livechat_enabled():
-            return
         payload = self._get_payload_for_livechat()
         self.send_task(CHANNEL_LIVE_CHAT, payload, arg='entry_id')
 
     def send_task(self, worker, payload, audit=True, arg='payload'):
         log.info('Inside function IncomingSMSSync.send_task')
-        if arg == 'payload':
-            result = self.send_sync_task.send_with_payload(self.account_id,
-                                                           worker, payload)
-        elif arg == 'entry_id':
-            result = self.send_sync_task.send_with_entry_id(worker, payload)
+        if self._is_dispatched(worker):
+            return True
+        if arg == 'payload' and is_batched(worker, self.outbox) and \
+                add_payload(self.send_sync_task, self.account_id, worker,
+                            payload):
+            log.info(f'Payload for {worker} added to its batch')
+            result = True
+        elif arg in ('payload', 'entry_id'):
+            try:
+                if arg == 'payload':
+                    result = self.send_sync_task.send_with_payload(
+                        self.account_id, worker, payload)
+                else:
+                    result = self.send_sync_task.send_with_entry_id(worker,
+                                                                    payload)
+            except CircuitOpenError:
+                # Not dropped: push() fails the stage once all channels ran
+                self.circuit_open.append(worker)
+                raise
         else:
             log_json.error(f"error while sending task to worker :{worker} i.e "
                            f"arg not supported")
@@ -218,8 +422,19 @@ class IncomingSMSSync(object):
 
         if audit:
             self.audit(worker)
+        self._record_dispatch(worker)
         return result
 
+    def _is_dispatched(self, channel):
+        if self.journal and self.journal.is_dispatched(channel):
+            log.info(f'Channel {channel} already dispatched, skipping')
+            return True
+        return False
+
+    def _record_dispatch(self, channel):
+        if self.journal:
+            self.journal.record_dispatch(channel)
+
     def audit(self, channel):
         log.info('Inside function IncomingSMSSync.audit')
         db_model.audit_sync(self.account_id, self.message['sms_id'], channel)
@@ -229,7 +444,9 @@ class IncomingSMSSync(object):
         params = {'account_id': int(self.message['accountId'])}
         account_id = get_account_id_or_parent_id(**params)
         log.info(f'Account-id is set to {account_id}')
-        self.message['accountId'] = account_id
+        # Message of the handler is not modified; payloads read the account
+        # through the view.
+        self.message = message_view(self.message, accountId=account_id)
 
     def _is_bot_enabled_for_incoming_number(self):
         log.info('Inside function _is_bot_enabled_for_incoming_number')
@@ -238,75 +455,26 @@ class IncomingSMSSync(object):
             return False
         return bool(self.account_config.get("bot_status"))
 
-    def _is_subscription_mgmt_enabled(self):
-        log.info('Inside function _is_subscription_mgmt_enabled')
-        tag_name = 'subscription_management'
-        return db_model.get_account_tag(self.account_id, tag_name)
-
-    def _is_livechat_enabled(self):
-        log.info('Inside function _is_livechat_enabled')
-        tag_name = 'isLiveChatEnabled'
-        return db_model.get_account_tag(self.account_id, tag_name)
-
-    def _is_push_to_url_enabled(self):
-        log.info('Inside function _is_push_to_url_enabled')
-        tag_name = 'push_incoming_to_url'
-        return db_model.get_account_tag(self.account_id, tag_name)
-
     def _get_payload_for_mobile(self):
         log.info('Inside function _get_payload_for_mobile')
-        key_map = {
-            'message': 'sms_text',
-            'mobilenumber': 'mobile_number',
-            'accountId': 'account_id',
-            'sms_id': 'incoming_id',
-            'shortCode': 'sender_id',
-            'mms_urls': 'mms_url',
-            'channel_type': 'channel_type'
-        }
-        return map_keys(self.message, key_map)
+        return MOBILE_PAYLOAD(self.message)
 
     def _get_payload_for_auto_reply(self):
         log.info('Inside function _get_payload_for_autoreply')
         response = dict(messageid=self.message.get("sms_id"))
-        sub_payload = self._get_payload_for_subscription()
-        response.update(sub_payload)
+        response.update(self._get_payload_for_subscription())
         log.info(f"Final payload: {insensitive_data(response)}")
         return response
 
     def _get_payload_for_salesforce(self):
         log.info('Inside function _get_payload_for_salesforce')
-        # key_from_message: required_key_for_worker_payload
-        key_map = {
-            'message': 'sms_text',
-            'mobilenumber': 'mobile_number',
-            'shortCode': 'inbound_number',
-            'accountId': 'account_id',
-            'sms_id': 'incoming_id',
-            'mms_urls': 'mms_url',
-            'providerName': 'providerName',
-            'created_on': 'created_on',
-            'bot_status': 'bot_status'
-        }
-        if 'channel_type' in self.message:
-            key_map.update(channel_type='channel_type')
-        if 'event_type' in self.message:
-            key_map.update(event_type='event_type')
-        return map_keys(self.message, key_map)
+        payload = SALESFORCE_PAYLOAD(self.message)
+        payload['bot_status'] = self.account_config.get('bot_status')
+        return payload
 
     def _get_payload_for_zoho(self):
         log.info('Inside function _get_payload_for_zoho')
-        # key_from_message: required_key_for_worker_payload
-        key_map = {
-            'message': 'sms_text',
-            'mobilenumber': 'mobile_number',
-            'shortCode': 'inbound_number',
-            'accountId': 'account_id',
-            'sms_id': 'sms_id',
-            'mms_urls': 'mms_url'
-        }
-
-        payload = map_keys(self.message, key_map)
+        payload = ZOHO_PAYLOAD(self.message)
         payload['type'] = 'incoming'
         payload['direction'] = 'IN'
         payload[CELERY_X_HEADER] = current_task.request.get(CELERY_X_HEADER)
@@ -320,12 +488,7 @@ class IncomingSMSSync(object):
 
     def _get_payload_for_bullhorn(self):
         log.info("Inside function _get_payload_for_bullhorn")
-        key_map = {
-            'sms_id': 'id',
-            'message': 'text',
-            'mms_urls': 'mms_url'
-        }
-        payload = map_keys(self.message, key_map)
+        payload = BULLHORN_PAYLOAD(self.message)
         return {
             'direction': 'incoming',
             'type': 'mms' if payload.get('mms_url') else 'sms',
@@ -335,9 +498,7 @@ class IncomingSMSSync(object):
     @function_logger(log)
     def _get_payload_for_livechat(self):
         log.info('Inside function _get_payload_for_livechat')
-        # key_from_message: required_key_for_worker_payload
-        key_map = {'sms_id': 'message_id'}
-        return map_keys(self.message, key_map)
+        return LIVE_CHAT_PAYLOAD(self.message)
 
     def _get_payload_for_url_from_account_config(self):
         log.info('Inside function _get_payload_for_url_from_account_config')
@@ -390,52 +551,72 @@ class IncomingSMSSync(object):
 
     def _get_payload_for_email(self):
         log.info('Inside function _get_payload_for_email')
-        account_info = db_model.get_account_info(self.account_id)
-        # key_from_message: required_key_for_worker_payload
-        key_map = {
-            'message': 'text',
-            'mobilenumber': 'mobilenumber',
-            'shortCode': 'shortcode',
-            'mms_urls': 'mms_urls'
-        }
-        email_content = map_keys(self.message, key_map)
-        email_content['name'] = account_info['contact_name']
-        email_content = json.dumps(email_content)
         subject = 'SMS-Magic: Incoming text message {account_id}'.format(
             account_id=self.account_id)
-
-        # Save the email in DB
-        email = db_model.save_email(
-            from_address=EMAIL_FROM_ADDRESS,
-            to_address=account_info['email_id'],
-            cc=CC_ADDRESS,
-            subject=subject,
-            template_type=PUSH_EMAIL_TEMPLATE_TYPE,
-            variable_field_values=email_content)
-
-        return {'system_email_log_id': email['id']}
+        return save_push_email(self.account_id, EMAIL_CONTENT(self.message),
+                               subject, commit=not self.outbox)
 
     def _get_payload_for_bot(self):
         log.info('Inside function _get_payload_for_bot')
-        # key_from_message: required_key_for_worker_payload
-        key_map = {
-            'sms_id': 'sms_id',
-            'message': 'sms_text',
-            'mobilenumber': 'phone_number',
-            'shortCode': 'short_code',
-            'accountId': 'account_id'
-        }
-        return map_keys(self.message, key_map)
+        return BOT_PAYLOAD(self.message)
 
     def _get_payload_for_subscription(self):
         log.info('Inside function _get_payload_for_subscription')
-        # key_from_message: required_key_for_worker_payload
-        key_map = {
-            'message': 'message',
-            'mobilenumber': 'mobile_number',
-            'shortCode': 'sender_id',
-            'accountId': 'account_id',
-            'keyword': 'keyword',
-            'subKeyword': 'sub_keyword'
-        }
-        return map_keys(self.message, key_map)
+        # Shared by subscription and auto reply payloads; built once
+        if self._subscription_payload is None:
+            self._subscription_payload = SUBSCRIPTION_PAYLOAD(self.message)
+        return dict(self._subscription_payload)
+
+
+def flush_email_digest(account_id):
+    """Sends the buffered messages of the account as one email"""
+    messages = take_messages(account_id)
+    if not messages:
+        return 0
+    email_content = {'messages': messages, 'count': len(messages)}
+    subject = f'SMS-Magic: {len(messages)} incoming text messages ' \
+              f'{account_id}'
+    sent = False
+    try:
+        if config.OUTBOX_ENABLED:
+            send_sync_task = OutboxWriter(account_id, messages[-1]['sms_id'])
+            payload = save_push_email(
+                account_id, email_content, subject, commit=False,
+                template_type=config.EMAIL_DIGEST_TEMPLATE_TYPE)
+        else:
+            send_sync_task = SendSyncTask()
+            payload = save_push_email(
+                account_id, email_content, subject,
+                template_type=config.EMAIL_DIGEST_TEMPLATE_TYPE)
+        send_sync_task.send_with_payload(account_id, CHANNEL_EMAIL, payload)
+        # Outbox entries are only kept when the commit succeeds
+        sent = not config.OUTBOX_ENABLED
+        send_sync_task.register_tasks()
+        db_model.commit_session()
+    except Exception as e:
+        log.exception(f'Error while sending email digest of account '
+                      f'{account_id}: {e}')
+        db_model.rollback_session()
+        if not sent:
+            restore_messages(account_id, messages)
+        raise
+    log_json.info('Email digest sent.', extra={
+        'account_id': account_id, 'messages': len(messages)})
+    return len(messages)
+
+
+def flush_crm_batch(account_id, worker, group):
+    """Sends the CRM payloads buffered for the batch"""
+    send_sync_task = SendSyncTask()
+    try:
+        try:
+            return flush_batches(send_sync_task, account_id, worker, group)
+        finally:
+            # Batches sent before a failed one are registered too
+            send_sync_task.register_tasks()
+            db_model.commit_session()
+    except Exception as e:
+        log.exception(f'Error while flushing batch of {worker} for account '
+                      f'{account_id}: {e}')
+        db_model.rollback_session()
+        raise
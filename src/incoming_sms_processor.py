@@ -1,15 +1,28 @@
 import json
 from time import time
 
+from src.functionality.fair_share import admit, log_queue_time
 from src.functionality.incoming_sms_handler import IncomingSMSHandler
 from src.functionality.incoming_whatsapp_handler import IncomingWhatsappHandler
+from src.functionality.multipart_affinity import forward_to_partition
+from src.functionality.multipart_deadline import sweep_expired_groups
+from src.functionality.parts_pruner import prune_stale_parts
+from src.functionality.sync import flush_email_digest, flush_crm_batch
 from src.models.database import Model
+from src.models.incoming_message import IncomingMessage
+from src.utils.adaptive_concurrency import record_task
 from src.utils.celery_app import app
 from src.utils.config_loggers import log, log_json
 from src.utils.constants import TASK_MODULE, SMS_TASK_NAME, WA_TASK_NAME, \
     INCOMING_MULTICHANNEL, INCOMING_SINGLE, MULTI_CHANNEL_TASK_MODULE, \
-    CELERY_TASK_STATUS_FAILED
+    CELERY_TASK_STATUS_FAILED, PRUNE_PARTS_TASK_NAME, \
+    SWEEP_MULTIPART_TASK_NAME, FLUSH_EMAIL_DIGEST_TASK_NAME, \
+    FLUSH_CRM_BATCH_TASK_NAME
 from src.utils.helper import insensitive_data, masked_data
+# Connect the signals of the metrics, memory and SQL instrumentation
+from src.utils.memory_profiler import profile_task_start  # noqa: F401
+from src.utils.metrics import setup_metrics  # noqa: F401
+from src.utils.query_budget import start_task_stats  # noqa: F401
 
 OPTIONS = {'bind': True, 'max_retries': 2}
 
@@ -17,6 +30,9 @@ OPTIONS = {'bind': True, 'max_retries': 2}
 @app.task(name=SMS_TASK_NAME, task_module=TASK_MODULE, **OPTIONS)
 def handle_incoming_sms(self, data):
     log.info('Inside handle_incoming_sms task')
+    data = load_payload(data)
+    if route_elsewhere(data, SMS_TASK_NAME):
+        return True
     status, exception = handle_incoming(data, clazz=IncomingSMSHandler,
                                         channel=INCOMING_SINGLE)
     if not status:
@@ -27,6 +43,9 @@ def handle_incoming_sms(self, data):
 @app.task(name=WA_TASK_NAME, task_module=MULTI_CHANNEL_TASK_MODULE, **OPTIONS)
 def handle_incoming_whatsapp(self, data):
     log.info('Inside handle_incoming_whatsapp task')
+    data = load_payload(data)
+    if route_elsewhere(data, WA_TASK_NAME):
+        return True
     status, exception = handle_incoming(data, clazz=IncomingWhatsappHandler,
                                         channel=INCOMING_MULTICHANNEL)
     if not status:
@@ -34,11 +53,60 @@ def handle_incoming_whatsapp(self, data):
     return True
 
 
+@app.task(name=PRUNE_PARTS_TASK_NAME, task_module=TASK_MODULE)
+def prune_incoming_sms_parts():
+    log.info('Inside prune_incoming_sms_parts task')
+    return prune_stale_parts()
+
+
+@app.task(name=SWEEP_MULTIPART_TASK_NAME, task_module=TASK_MODULE)
+def sweep_multipart_deadlines():
+    log.info('Inside sweep_multipart_deadlines task')
+    return sweep_expired_groups()
+
+
+@app.task(name=FLUSH_EMAIL_DIGEST_TASK_NAME, task_module=TASK_MODULE)
+def send_email_digest(account_id):
+    log.info('Inside send_email_digest task')
+    return flush_email_digest(account_id)
+
+
+@app.task(name=FLUSH_CRM_BATCH_TASK_NAME, task_module=TASK_MODULE)
+def send_crm_batch(account_id, worker, group):
+    log.info('Inside send_crm_batch task')
+    return flush_crm_batch(account_id, worker, group)
+
+
+def load_payload(data):
+    """
+    Parses the task data once for routing and handling; data which is not
+    JSON is returned as is and reported by handle_incoming
+    """
+    if isinstance(data, dict):
+        return data
+    try:
+        return json.loads(data)
+    except ValueError:
+        return data
+
+
+def route_elsewhere(payload, task_name):
+    """Returns True when the task was handed over to another queue"""
+    if not isinstance(payload, dict):
+        return False
+    log_queue_time(payload)
+    # Parts of a multipart message are processed by their partition consumer
+    if task_name == SMS_TASK_NAME and forward_to_partition(payload):
+        return True
+    return not admit(payload, task_name)
+
+
 def handle_incoming(data, clazz=None, channel=None):
     ts = time()
-    payload = {}
+    # Kept for the failure report when the payload is invalid
+    payload = data if isinstance(data, dict) else {}
     try:
-        payload = data if isinstance(data, dict) else json.loads(data)
+        payload = IncomingMessage.parse(data)
         log.info(f'Task received: {insensitive_data(payload)}')
         log_json.info(f'Payload for incoming sms:{masked_data(payload)}')
         clazz(payload).process()
@@ -57,9 +125,10 @@ def handle_incoming(data, clazz=None, channel=None):
                            f'processing for payload:{masked_data(payload)}'
                            f'; Retrying the process...',
                            extra={'error': str(e), 'channel': channel})
-
+        record_task(time() - ts, failed=True)
         return False, e
 
+    record_task(time() - ts)
     log.info(f'Task succeeded in {(time() - ts):2.4f}s\n')
     return True, None
 
@@ -5,8 +5,7 @@ from sm_models.salesforce import SalesforceAuthCodeMap
 from sm_utils.utils import not_empty, function_logger
 
 from src.utils.config_loggers import log, log_json
-from src.utils.constants import IS_PUSH_ENABLED_ACCOUNT_TAG_FLAG_NAME, \
-    IS_CONVERSE_DESK_ENABLED_ACCOUNT_TAG_FLAG_NAME, ACTIVE
+from src.utils.constants import ACTIVE
 from src.utils.database import session
 from src.utils.helper import to_dict
 from src.utils.redis_cache import magic_cache
@@ -47,18 +46,6 @@ def get_apikey(account_id=None):
     return get_account(account_id=account_id).get('api_key')
 
 
-@function_logger(log)
-def is_push_enabled_account(account_id=None):
-    all_tags = get_account_tags(account_id=account_id)
-    return all_tags.get(IS_PUSH_ENABLED_ACCOUNT_TAG_FLAG_NAME, None)
-
-
-@function_logger(log)
-def is_saas_converse_desk_enabled(account_id=None):
-    all_tags = get_account_tags(account_id=account_id)
-    return all_tags.get(IS_CONVERSE_DESK_ENABLED_ACCOUNT_TAG_FLAG_NAME, 0)
-
-
 @function_logger(log)
 def get_sf_auth_map(account_id=None):
     sql = session.query(SalesforceAuthCodeMap)
@@ -1,5 +1,7 @@
 import datetime
+import json
 import time
+import uuid
 
 from celery import current_task
 from retrying import retry
@@ -10,18 +12,54 @@ from sm_models.incoming import IncomingSms, IncomingSmsParts, \
 from sm_models.providers import WhatsappAccountMobileMapping
 from sm_models.task_loggers import SystemEmailLog, CeleryTask
 from sm_utils.utils import function_logger
-from sqlalchemy import func
+from sqlalchemy import case, func, literal_column, or_
 
 from src import config
 from src.models.account import get_account_tags, get_account_settings, \
     get_apikey, get_account, is_bullhorn
+from src.models.outbox import IncomingSmsOutbox, OUTBOX_STATUS_PENDING, \
+    OUTBOX_STATUS_SENT, OUTBOX_STATUS_FAILED
+from src.utils.adaptive_concurrency import retry_unless_degraded
 from src.utils.config_loggers import log
 from src.utils.constants import CELERY_TASK_STATUS_STARTED, \
-    CELERY_TASK_STATUS_COMPLETED, CHANNEL
+    CELERY_TASK_STATUS_COMPLETED, CELERY_TASK_STATUS_FAILED, CHANNEL
 from src.utils.database import session
 from src.utils.helper import get_orm_column_mapping, to_dict, random_sleep, \
-    insensitive_data
-from src.utils.redis_cache import magic_cache, redis_cache
+    insensitive_data, check_dates
+from src.utils.redis_cache import redis_cache
+
+# Inbound number fields used while processing a message
+INBOUND_NUMBER_COLUMNS = ('id', 'short_code', 'incoming_provider_id',
+                          'is_shared', 'country_id', 'inbound_number_type')
+
+PARTS_WATERMARK_KEY = f'{config.APP_NAME}:PARTS_WATERMARK'
+# Last known watermark, kept without expiry as starting point of next refresh
+PARTS_WATERMARK_SEED_KEY = f'{config.APP_NAME}:PARTS_WATERMARK_SEED'
+# Held by the parts pruner and by whoever moves the watermark, so the
+# watermark is not moved while parts below it are being pruned
+PARTS_PRUNE_LOCK_KEY = f'{config.APP_NAME}:PARTS_PRUNE_LOCK'
+PARTS_WATERMARK_LOCK_EXPIRY = 60
+
+# Deletes the lock only while it holds the token of the caller, so a lock
+# which expired and was taken by someone else is left alone
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def acquire_prune_lock(expiry):
+    """Returns the token of the acquired lock, None if it is held"""
+    token = uuid.uuid4().hex
+    if redis_cache.set(PARTS_PRUNE_LOCK_KEY, token, nx=True, ex=expiry):
+        return token
+    return None
+
+
+def release_prune_lock(token):
+    redis_cache.eval(RELEASE_LOCK_SCRIPT, 1, PARTS_PRUNE_LOCK_KEY, token)
 
 
 class Model(object):
@@ -44,7 +82,7 @@ class Model(object):
         sql = sql.filter(table_source.short_code == short_code)
         sql = sql.filter(table_source.is_deleted == 0)
         number = sql.first()
-        return to_dict(number)
+        return to_dict(number, columns=INBOUND_NUMBER_COLUMNS)
 
     @staticmethod
     def get_incoming_config_by_shortcode(short_code, keyword=None):
@@ -67,17 +105,41 @@ class Model(object):
 
     @staticmethod
     def get_keyword_whatsapp_mapping(short_code, mobile_number):
+        cache_key = Model.get_whatsapp_mapping_key(short_code, mobile_number)
+        if config.WA_MAPPING_CACHE_EXPIRY:
+            cached = redis_cache.get(cache_key)
+            if cached:
+                return tuple(json.loads(cached))
+
         sql = session.query(WhatsappAccountMobileMapping)
         sql = sql.filter_by(shortCode=short_code, mobileNumber=mobile_number)
         sql = sql.order_by(WhatsappAccountMobileMapping.createdOn.desc())
         result = sql.first()
-        return (result.keyword, result.subKeyword) if result else (None, None)
+        if not result:
+            if config.WA_MAPPING_CACHE_EXPIRY and config.NEGATIVE_CACHE_EXPIRY:
+                # Remembered briefly; a new mapping is written through
+                redis_cache.set(cache_key, json.dumps([None, None]),
+                                ex=config.NEGATIVE_CACHE_EXPIRY, nx=True)
+            return None, None
+        if config.WA_MAPPING_CACHE_EXPIRY:
+            # nx: a mapping written meanwhile is newer than the one read
+            redis_cache.set(cache_key,
+                            json.dumps([result.keyword, result.subKeyword]),
+                            ex=config.WA_MAPPING_CACHE_EXPIRY, nx=True)
+        return result.keyword, result.subKeyword
 
     @staticmethod
     def insert_keyword_whatsapp_mapping(**params):
         record = WhatsappAccountMobileMapping(**params)
         session.add(record)
         session.commit()
+        if config.WA_MAPPING_CACHE_EXPIRY:
+            # Write-through: the new row is the latest mapping of the number
+            redis_cache.set(
+                Model.get_whatsapp_mapping_key(params['shortCode'],
+                                               params['mobileNumber']),
+                json.dumps([params.get('keyword'), params.get('subKeyword')]),
+                ex=config.WA_MAPPING_CACHE_EXPIRY)
 
     @staticmethod
     def save_mms_url(is_hipaa, url, sms_id, skip_url_storage=None):
@@ -99,7 +161,7 @@ class Model(object):
 
     @staticmethod
     @function_logger(log)
-    def save_incoming_sms(is_hipaa, params):
+    def save_incoming_sms(is_hipaa, params, commit=True):
         mapping = get_orm_column_mapping(IncomingSms)
         params = {v: params[k] for k, v in mapping.items() if k in params}
         template = '<< {} is not stored due to hipaa compliance >>'
@@ -113,14 +175,15 @@ class Model(object):
             params['channel_type'] = CHANNEL.MMS
 
         log.info(f'Incoming SMS parameters: {insensitive_data(params)}')
-        params.update({
-            'created_on': datetime.datetime.now(datetime.timezone.utc),
-            'modified_on': datetime.datetime.now(datetime.timezone.utc)
-        })
-        sms = IncomingSms(**params)
-        session.add(sms)
-        session.commit()
-        return to_dict(sms)
+        # Stored as the DATETIME column keeps it, so the returned created_on
+        # is the same as reading the row back would give.
+        now = datetime.datetime.now(datetime.timezone.utc).replace(
+            microsecond=0, tzinfo=None)
+        params.update({'created_on': now, 'modified_on': now})
+        sms = Model._insert(IncomingSms, params)
+        if commit:
+            session.commit()
+        return sms
 
     @staticmethod
     def save_incoming_sms_part(params):
@@ -132,11 +195,26 @@ class Model(object):
         if 'part_number' not in params:
             params["part_number"] = 1
 
-        part = IncomingSmsParts(**params)
-        session.add(part)
+        part = Model._insert(IncomingSmsParts, params)
         session.commit()
-        log.info(f'Saved message part id: {part.id}')
-        return part.id
+        log.info(f'Saved message part id: {part["id"]}')
+        return part['id']
+
+    @staticmethod
+    def _insert(orm_class, values):
+        """
+        Inserts a row with a Core INSERT in the session transaction. Returns
+        the given values (keyed by ORM attribute, dates as ISO strings) with
+        the generated id, without reading the row back after commit. Server
+        side defaults are not part of the result.
+        """
+        mapping = get_orm_column_mapping(orm_class)
+        columns = {orm_key: db_key for db_key, orm_key in mapping.items()}
+        result = session.execute(orm_class.__table__.insert(),
+                                 {columns[k]: v for k, v in values.items()})
+        record = {k: check_dates(v) for k, v in values.items()}
+        record['id'] = result.lastrowid
+        return record
 
     @staticmethod
     def get_count_of_parts(reference_id, short_code, account_id, mobile_number):
@@ -166,7 +244,7 @@ class Model(object):
         # Although, key is deleted when message parts get assembled but this is
         # fallback
         if count_of_parts == 1:
-            redis_cache.expire(parts_key, 3600 * 24)
+            redis_cache.expire(parts_key, config.PARTS_WINDOW)
 
         return count_of_parts
 
@@ -174,14 +252,8 @@ class Model(object):
     def get_parts_count_from_db(reference_id, short_code, account_id,
                                 mobile_number):
         sql = session.query(func.count(IncomingSmsParts.id))
-        cached_id = Model.get_part_cached_id()
-        if cached_id:
-            sql = sql.filter(IncomingSmsParts.id >= cached_id)
-        sql = sql.filter(IncomingSmsParts.account_id == account_id)
-        sql = sql.filter(IncomingSmsParts.reference_id == reference_id)
-        sql = sql.filter(IncomingSmsParts.incoming_sms_id == 0)
-        sql = sql.filter(IncomingSmsParts.short_code == short_code)
-        sql = sql.filter(IncomingSmsParts.mobile_number == mobile_number)
+        sql = sql.filter(*Model._pending_parts_filter(
+            reference_id, short_code, account_id, mobile_number))
         return sql.scalar()
 
     @staticmethod
@@ -190,40 +262,29 @@ class Model(object):
         # with parts which comes at the same time and processed by different
         # thread/processes
         random_sleep()
-        sql = session.query(IncomingSmsParts)
-        cached_id = Model.get_part_cached_id()
-        if cached_id:
-            sql = sql.filter(IncomingSmsParts.id >= cached_id)
-        sql = sql.filter(IncomingSmsParts.account_id == account_id)
-        sql = sql.filter(IncomingSmsParts.reference_id == reference_id)
-        sql = sql.filter(IncomingSmsParts.incoming_sms_id == 0)
-        sql = sql.filter(IncomingSmsParts.short_code == short_code)
-        sql = sql.filter(IncomingSmsParts.mobile_number == mobile_number)
+        sql = session.query(IncomingSmsParts.part_number,
+                            IncomingSmsParts.message)
+        sql = sql.filter(*Model._pending_parts_filter(
+            reference_id, short_code, account_id, mobile_number))
         sql = sql.order_by(IncomingSmsParts.part_number)
-        parts = sql.all()
-        return to_dict(parts)
+        return [part._asdict() for part in sql.all()]
 
     @staticmethod
-    @retry(wait_fixed=1000, stop_max_attempt_number=3)
+    @retry(wait_fixed=1000, stop_max_attempt_number=3,
+           retry_on_exception=retry_unless_degraded)
     def update_parts_of_sms(reference_id, short_code, account_id, mobile_number,
                             sms_id):
         log.info(f'Inside function update_parts_of_sms: {locals()}')
         try:
             sql = session.query(IncomingSmsParts)
-            cached_id = Model.get_part_cached_id()
-            if cached_id:
-                sql = sql.filter(IncomingSmsParts.id >= cached_id)
-            parts = sql.filter(
-                IncomingSmsParts.account_id == account_id,
-                IncomingSmsParts.reference_id == reference_id,
-                IncomingSmsParts.incoming_sms_id == 0,
-                IncomingSmsParts.short_code == short_code,
-                IncomingSmsParts.mobile_number == mobile_number
-            ).all()
-            for part in parts:
-                part.incoming_sms_id = sms_id
-                part.status = "success"
-                part.modified_on = datetime.datetime.now(datetime.timezone.utc)
+            sql = sql.filter(*Model._pending_parts_filter(
+                reference_id, short_code, account_id, mobile_number))
+            updated = sql.update({
+                IncomingSmsParts.incoming_sms_id: sms_id,
+                IncomingSmsParts.status: 'success',
+                IncomingSmsParts.modified_on:
+                    datetime.datetime.now(datetime.timezone.utc)
+            }, synchronize_session=False)
             session.flush()
             # Delete parts counting key as all parts are already assembled.
             redis_cache.delete(Model.get_part_key(
@@ -232,12 +293,84 @@ class Model(object):
                 mobile_number,
                 reference_id
             ))
-            log.info('Updated table incoming_sms_parts successfully')
+            log.info(f'Updated {updated} rows of table incoming_sms_parts '
+                     f'successfully')
         except Exception as e:
             log.warning(f'Error while updating incoming_sms_parts: {e}')
             db_model.rollback_session()
             raise e
 
+    @staticmethod
+    def expire_parts_of_sms(reference_id, short_code, account_id,
+                            mobile_number):
+        """Marks parts of a message which never completed as expired"""
+        sql = session.query(IncomingSmsParts)
+        sql = sql.filter(*Model._pending_parts_filter(
+            reference_id, short_code, account_id, mobile_number))
+        expired = sql.update({
+            IncomingSmsParts.status: 'expired',
+            IncomingSmsParts.modified_on:
+                datetime.datetime.now(datetime.timezone.utc)
+        }, synchronize_session=False)
+        session.commit()
+        redis_cache.delete(Model.get_part_key(
+            account_id,
+            short_code,
+            mobile_number,
+            reference_id
+        ))
+        log.info(f'Expired {expired} parts of message {reference_id}')
+        return expired
+
+    @staticmethod
+    def _pending_parts_filter(reference_id, short_code, account_id,
+                              mobile_number):
+        """
+        Criteria for parts of one message which are not yet assembled, bounded
+        by the id watermark of the parts window.
+        """
+        criteria = [
+            IncomingSmsParts.account_id == account_id,
+            IncomingSmsParts.reference_id == reference_id,
+            IncomingSmsParts.incoming_sms_id == 0,
+            IncomingSmsParts.short_code == short_code,
+            IncomingSmsParts.mobile_number == mobile_number
+        ]
+        cached_id = Model.get_part_cached_id()
+        if cached_id:
+            criteria.append(IncomingSmsParts.id >= cached_id)
+        return criteria
+
+    @staticmethod
+    def delete_parts_below(watermark, chunk_size, archive_table=None):
+        """
+        Deletes the oldest chunk of parts with id below the watermark, copying
+        them to archive_table first when it is set. Returns deleted row count.
+        """
+        sql = session.query(IncomingSmsParts.id)
+        sql = sql.filter(IncomingSmsParts.id < watermark)
+        ids = sql.order_by(IncomingSmsParts.id).limit(chunk_size).all()
+        if not ids:
+            return 0
+
+        first_id, last_id = ids[0].id, ids[-1].id
+        try:
+            if archive_table:
+                session.execute(
+                    f'INSERT INTO {archive_table} SELECT * FROM '
+                    f'{IncomingSmsParts.__tablename__} '
+                    f'WHERE id BETWEEN :first_id AND :last_id',
+                    {'first_id': first_id, 'last_id': last_id})
+            sql = session.query(IncomingSmsParts)
+            sql = sql.filter(IncomingSmsParts.id.between(first_id, last_id))
+            deleted = sql.delete(synchronize_session=False)
+            session.commit()
+        except Exception as e:
+            log.warning(f'Error while deleting incoming_sms_parts: {e}')
+            db_model.rollback_session()
+            raise e
+        return deleted
+
     @staticmethod
     def audit_sync(account_id, incoming_sms_id, sync_type):
         audit_params = {
@@ -254,11 +387,101 @@ class Model(object):
         return get_account(account_id=account_id)
 
     @staticmethod
-    def save_email(**kwargs):
-        email = SystemEmailLog(**kwargs)
-        session.add(email)
+    def save_email(commit=True, **kwargs):
+        email = Model._insert(SystemEmailLog, kwargs)
+        if commit:
+            session.commit()
+        return email
+
+    @staticmethod
+    def commit_session():
+        session.commit()
+
+    @staticmethod
+    def add_outbox_entries(entries):
+        """Inserts dispatch intents in the session transaction"""
+        if entries:
+            session.execute(IncomingSmsOutbox.__table__.insert(), entries)
+
+    @staticmethod
+    def claim_outbox_entries(limit):
+        """
+        Locks up to `limit` pending entries due for an attempt, skipping the
+        ones locked by another relay. Locks are held until the entries are
+        marked.
+        """
+        sql = session.query(IncomingSmsOutbox)
+        sql = sql.filter(IncomingSmsOutbox.status == OUTBOX_STATUS_PENDING)
+        sql = sql.filter(or_(IncomingSmsOutbox.next_attempt_at.is_(None),
+                             IncomingSmsOutbox.next_attempt_at <= func.now()))
+        sql = sql.order_by(IncomingSmsOutbox.id).limit(limit)
+        return to_dict(sql.with_for_update(skip_locked=True).all())
+
+    @staticmethod
+    def mark_outbox_entries(sent_ids, failed_ids, max_attempts,
+                            deferred_ids=()):
+        """
+        Marks published entries sent and counts an attempt for the failed
+        ones, which are retried with an exponential backoff and given up
+        after max_attempts. Deferred entries (exchange circuit open) are
+        retried once the circuit may close, without using an attempt.
+        Commits and so releases the claimed entries.
+        """
+        if sent_ids:
+            # By the database clock, which prunes them on sent_on
+            sql = session.query(IncomingSmsOutbox)
+            sql = sql.filter(IncomingSmsOutbox.id.in_(sent_ids))
+            sql.update({IncomingSmsOutbox.status: OUTBOX_STATUS_SENT,
+                        IncomingSmsOutbox.sent_on: func.now()},
+                       synchronize_session=False)
+        if failed_ids:
+            # MySQL assigns in SET order, so status and the backoff go first
+            # to be decided on the attempts before this update
+            attempts = IncomingSmsOutbox.attempts + 1
+            backoff = f'LEAST({int(config.OUTBOX_RETRY_BACKOFF)} * ' \
+                      f'POW(2, {IncomingSmsOutbox.attempts.name}), ' \
+                      f'{int(config.OUTBOX_RETRY_MAX_BACKOFF)})'
+            sql = session.query(IncomingSmsOutbox)
+            sql = sql.filter(IncomingSmsOutbox.id.in_(failed_ids))
+            sql.update([
+                (IncomingSmsOutbox.status, case(
+                    [(attempts >= max_attempts, OUTBOX_STATUS_FAILED)],
+                    else_=OUTBOX_STATUS_PENDING)),
+                (IncomingSmsOutbox.next_attempt_at, func.date_add(
+                    func.now(), literal_column(f'INTERVAL {backoff} SECOND'))),
+                (IncomingSmsOutbox.attempts, attempts)
+            ], synchronize_session=False,
+                update_args={'preserve_parameter_order': True})
+        if deferred_ids:
+            sql = session.query(IncomingSmsOutbox)
+            sql = sql.filter(IncomingSmsOutbox.id.in_(deferred_ids))
+            sql.update({IncomingSmsOutbox.next_attempt_at: func.date_add(
+                func.now(), literal_column(
+                    f'INTERVAL {int(config.CIRCUIT_RESET_TIMEOUT)} SECOND'))},
+                synchronize_session=False)
         session.commit()
-        return to_dict(email)
+
+    @staticmethod
+    def delete_sent_outbox_entries(retention, limit):
+        """
+        Deletes up to `limit` entries sent more than `retention` seconds ago,
+        oldest first, and returns how many were deleted. Failed entries are
+        kept for investigation.
+        """
+        sent_before = func.date_sub(func.now(), literal_column(
+            f'INTERVAL {int(retention)} SECOND'))
+        sql = session.query(IncomingSmsOutbox.id)
+        sql = sql.filter(IncomingSmsOutbox.status == OUTBOX_STATUS_SENT)
+        sql = sql.filter(IncomingSmsOutbox.sent_on < sent_before)
+        ids = [row.id for row in sql.order_by(IncomingSmsOutbox.id)
+               .limit(limit)]
+        deleted = 0
+        if ids:
+            sql = session.query(IncomingSmsOutbox)
+            sql = sql.filter(IncomingSmsOutbox.id.in_(ids))
+            deleted = sql.delete(synchronize_session=False)
+        session.commit()
+        return deleted
 
     @staticmethod
     def get_account_tag(account_id, tag_name):
@@ -271,7 +494,8 @@ class Model(object):
         return all_settings.get(setting)
 
     @staticmethod
-    @retry(wait_fixed=1000, stop_max_attempt_number=3)
+    @retry(wait_fixed=1000, stop_max_attempt_number=3,
+           retry_on_exception=retry_unless_degraded)
     def update_celery_task(entry_id=None, status=None, error=None):
         log.info(f'Inside function update_celery_task: {locals()}')
         if not entry_id:
@@ -305,32 +529,106 @@ class Model(object):
             raise e
 
     @staticmethod
-    def update_celery_task_id(is_hipaa, entry_id, task_id):
+    def fail_unstarted_celery_task(entry_id=None, error=None):
+        """
+        Fails a CeleryTask with one UPDATE, without loading the row. Used for
+        messages rejected from the negative cache, which have no account.
+        """
+        if not entry_id:
+            return 0
+        try:
+            sql = session.query(CeleryTask).filter_by(entry_id=entry_id)
+            updated = sql.update({
+                CeleryTask.task_status: CELERY_TASK_STATUS_FAILED,
+                CeleryTask.finished_on: datetime.datetime.now(
+                    datetime.timezone.utc),
+                CeleryTask.error_message: error or None
+            }, synchronize_session=False)
+            session.commit()
+            return updated
+        except Exception as e:
+            log.warning(f'Error while updating celery tasks: {entry_id} - {e}')
+            db_model.rollback_session()
+            raise e
+
+    @staticmethod
+    def update_celery_task_ids(is_hipaa, task_ids):
+        """
+        Sets task_id of several CeleryTask rows with one UPDATE, committed
+        with the audits of the dispatches, so a later rollback of the
+        message keeps them.
+        param: task_ids - {entry_id: task_id}
+        """
+        if not task_ids:
+            return 0
+        # Rows were inserted by SendTask on its own connection
         session.commit()
-        c_task = session.query(CeleryTask).filter_by(entry_id=entry_id).first()
-        c_task.task_id = task_id
+        values = {
+            CeleryTask.task_id: case(task_ids, value=CeleryTask.entry_id)}
         if is_hipaa:
-            c_task.payload_data = '<< payload removed due to hipaa >>'
-        session.flush()
+            values[CeleryTask.payload_data] = \
+                '<< payload removed due to hipaa >>'
+        sql = session.query(CeleryTask)
+        sql = sql.filter(CeleryTask.entry_id.in_(list(task_ids)))
+        updated = sql.update(values, synchronize_session=False)
+        session.commit()
+        return updated
 
     @staticmethod
     def is_bullhorn_account(account_id):
         return is_bullhorn(account_id=account_id)
 
     @staticmethod
-    @magic_cache(expiry=3600 * 24)
     def get_part_cached_id():
         """
-        This method caches incoming_sms_parts table id from 24 hours ago. This
-        id will be used in incoming_sms_parts search queries for faster
-        retrieval. The assumption here is that all parts of messages should come
-        within 24 hours.
+        Returns the first incoming_sms_parts id within the parts window. This
+        id bounds incoming_sms_parts search queries for faster retrieval. The
+        assumption here is that all parts of messages should come within the
+        window (24 hours).
+        """
+        cached_id = redis_cache.get(PARTS_WATERMARK_KEY)
+        if cached_id:
+            return int(cached_id)
+        token = acquire_prune_lock(PARTS_WATERMARK_LOCK_EXPIRY)
+        if not token:
+            # Being moved or pruned; the previous watermark is still a valid
+            # lower bound
+            seed_id = redis_cache.get(PARTS_WATERMARK_SEED_KEY)
+            if seed_id:
+                return int(seed_id)
+            # No watermark yet, so nothing was pruned: searched from the
+            # start of the window, leaving the lock to its owner
+            return Model.refresh_part_watermark()
+        try:
+            return Model.refresh_part_watermark()
+        finally:
+            release_prune_lock(token)
+
+    @staticmethod
+    def refresh_part_watermark():
+        """
+        Moves the watermark forward. The search starts from the previous
+        watermark, so only rows added since then are scanned by primary key.
+        A watermark which is up to one refresh old is still a valid lower bound.
+        The window is computed by the database clock, as createdOn is written
+        by it. Callers hold PARTS_PRUNE_LOCK_KEY unless no watermark was ever
+        set.
         """
-        result = session.execute(config.INTERVAL_QUERY)
-        record = result.first() if result.rowcount > 0 else None
+        previous_id = int(redis_cache.get(PARTS_WATERMARK_SEED_KEY) or 0)
+        window_start = func.date_sub(func.now(), literal_column(
+            f'INTERVAL {int(config.PARTS_WINDOW)} SECOND'))
+        sql = session.query(IncomingSmsParts.id)
+        sql = sql.filter(IncomingSmsParts.id >= previous_id)
+        sql = sql.filter(IncomingSmsParts.created_on > window_start)
+        record = sql.order_by(IncomingSmsParts.id).first()
         if not record:
             log.error('CAN_NOT_OBTAINED_INCOMING_SMS_PARTS_ID')
             return None
+
+        redis_cache.set(PARTS_WATERMARK_KEY, record.id,
+                        config.PARTS_WATERMARK_EXPIRY)
+        redis_cache.set(PARTS_WATERMARK_SEED_KEY, record.id)
+        log.info(f'incoming_sms_parts watermark moved to {record.id}')
         return record.id
 
     @staticmethod
@@ -344,5 +642,18 @@ class Model(object):
         log.info(f'Function get_part_key return: {part_key}')
         return part_key
 
+    @staticmethod
+    def get_whatsapp_mapping_key(short_code, mobile_number):
+        return f'{config.APP_NAME}:WA_MAPPING:{short_code}:{mobile_number}'
+
+    @staticmethod
+    def get_part_number(params):
+        """Part number of the part, as save_incoming_sms_part stores it"""
+        mapping = get_orm_column_mapping(IncomingSmsParts)
+        for db_key, orm_key in mapping.items():
+            if orm_key == 'part_number' and db_key in params:
+                return int(params[db_key])
+        return 1
+
 
 db_model = Model()
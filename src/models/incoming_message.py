@@ -0,0 +1,105 @@
+"""
+Incoming message as it moves through the handler stages.
+
+The task payload is parsed and validated once, at task entry. Known payload
+fields and the fields derived by the stages are slots; anything else the
+provider sent is kept as is, since all provider inputs are stored. The
+message behaves as a mapping, so stages and models keep reading it by
+payload key, and `view()` gives channel builders a read-only view without
+copying.
+"""
+import json
+from collections.abc import Mapping, MutableMapping
+from types import MappingProxyType
+
+# Sent by one_api
+PAYLOAD_FIELDS = (
+    'providerId', 'providerName', 'messageId', 'mobilenumber', 'shortCode',
+    'message', 'mms_urls', 'entry_id', 'totalParts', 'isMultiPart',
+    'referenceId', 'partOrderNumber', 'channel_type',
+    'duplicate_incoming_redis_key', 'isCronRequest'
+)
+# Set by the handler stages
+DERIVED_FIELDS = (
+    'keyword', 'subKeyword', 'table_source', 'accountId',
+    'incomingProviderId', 'skip_db_url_storage', 'sms_id', 'created_on'
+)
+FIELDS = PAYLOAD_FIELDS + DERIVED_FIELDS
+_FIELD_SET = frozenset(FIELDS)
+
+REQUIRED_FIELDS = ('providerId', 'mobilenumber', 'shortCode', 'message')
+
+
+class IncomingMessage(MutableMapping):
+    __slots__ = FIELDS + ('_extra',)
+
+    def __init__(self, fields=()):
+        self._extra = {}
+        for key, value in dict(fields).items():
+            self[key] = value
+
+    @classmethod
+    def parse(cls, data):
+        """
+        Message of a task payload (JSON text or dict). Raises KeyError for a
+        missing required field and ValueError for an invalid payload.
+        """
+        if isinstance(data, cls):
+            return data
+        if isinstance(data, (str, bytes)):
+            data = json.loads(data)
+        if not isinstance(data, Mapping):
+            raise ValueError(f'Payload is not an object: {type(data)}')
+        for field in REQUIRED_FIELDS:
+            if data.get(field) is None:
+                raise KeyError(field)
+        if not isinstance(data['message'], str):
+            raise ValueError('Payload message is not text')
+        message = cls(data)
+        message.shortCode = str(message.shortCode)
+        message.mobilenumber = str(message.mobilenumber)
+        return message
+
+    def view(self):
+        """Read-only view of the message, not a copy"""
+        return MappingProxyType(self)
+
+    def __getitem__(self, key):
+        if key in _FIELD_SET:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in _FIELD_SET:
+            setattr(self, key, value)
+        else:
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in _FIELD_SET:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        if key in _FIELD_SET:
+            return hasattr(self, key)
+        return key in self._extra
+
+    def __iter__(self):
+        for field in FIELDS:
+            if hasattr(self, field):
+                yield field
+        yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f'IncomingMessage({dict(self)})'
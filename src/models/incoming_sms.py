@@ -3,15 +3,55 @@ from datetime import datetime
 
 from sm_utils.utils import function_logger
 
+from src import config
 from src.models.account import get_account
 from src.models.database import db_model
 from src.utils.config_loggers import log, log_json
 from src.utils.constants import DUPLICATE_INCOMING_REDIS_EXPIRY, \
     CELERY_TASK_STATUS_FAILED, CELERY_TASK_STATUS_COMPLETED, \
-    CELERY_TASK_STATUS_STARTED
+    CELERY_TASK_STATUS_STARTED, INBOUND_NUMBER_NOT_FOUND, \
+    INCOMING_CONFIG_NOT_FOUND
 from src.utils.redis_cache import redis_cache
 
 
+class NegativelyCachedError(ValueError):
+    """Lookup known to find nothing, served from the negative cache"""
+
+
+def _negative_cache_key(error_code, *key_parts):
+    key = ':'.join(str(part) for part in key_parts)
+    return f'{config.APP_NAME}:{error_code}:{key}'
+
+
+def is_negatively_cached(error_code, shortcode, *key_parts):
+    """
+    Returns True if an earlier lookup for these keys found nothing. Every such
+    hit is counted per shortcode, so junk traffic can be spotted from Redis.
+    """
+    if not config.NEGATIVE_CACHE_EXPIRY:
+        return False
+    if not redis_cache.get(_negative_cache_key(error_code, shortcode,
+                                               *key_parts)):
+        return False
+
+    hits_key = _negative_cache_key(f'{error_code}-HITS', shortcode)
+    hits = redis_cache.incr(hits_key)
+    if hits == 1:
+        redis_cache.expire(hits_key, 3600 * 24)
+    log.warning(f'{error_code} served from negative cache for short-code: '
+                f'{shortcode}; hits: {hits}')
+    log_json.warning(f'{error_code} served from negative cache.',
+                     extra={'short_code': shortcode, 'negative_hits': hits})
+    return True
+
+
+def set_negative_cache(error_code, shortcode, *key_parts):
+    if not config.NEGATIVE_CACHE_EXPIRY:
+        return
+    redis_cache.set(_negative_cache_key(error_code, shortcode, *key_parts), 1,
+                    config.NEGATIVE_CACHE_EXPIRY)
+
+
 @function_logger(log)
 def is_account_hipaa_enabled(account_id):
     is_hipaa = db_model.get_account_tag(account_id, 'hipaa_compliant')
@@ -22,13 +62,18 @@ def is_account_hipaa_enabled(account_id):
 
 @function_logger(log)
 def get_inbound_number(shortcode, provider_id, table_source):
+    table_name = table_source.__tablename__
+    if is_negatively_cached(INBOUND_NUMBER_NOT_FOUND, shortcode, table_name):
+        raise NegativelyCachedError(INBOUND_NUMBER_NOT_FOUND)
+
     inbound_number = db_model.get_inbound_number_by_shortcode(shortcode,
                                                               table_source)
     if not inbound_number:
         log.error(f"Inbound number not found for short-code: {shortcode}")
         log_json.error(f"Unable to process request as inbound number not found "
                        f"for shortcode:{shortcode}.")
-        raise ValueError("INBOUND-NUMBER-NOT_FOUND")
+        set_negative_cache(INBOUND_NUMBER_NOT_FOUND, shortcode, table_name)
+        raise ValueError(INBOUND_NUMBER_NOT_FOUND)
 
     # Don't validate for correct provider for now, because multiple
     # entries for same providers exist on production server.
@@ -42,6 +87,9 @@ def get_inbound_number(shortcode, provider_id, table_source):
 
 @function_logger(log)
 def get_incoming_config(shortcode, keyword=None):
+    if is_negatively_cached(INCOMING_CONFIG_NOT_FOUND, shortcode, keyword):
+        raise NegativelyCachedError(INCOMING_CONFIG_NOT_FOUND)
+
     incoming_config = db_model.get_incoming_config_by_shortcode(shortcode,
                                                                 keyword=keyword)
     if incoming_config:
@@ -50,7 +98,8 @@ def get_incoming_config(shortcode, keyword=None):
     else:
         log.error(f'Incoming config not found for shortcode: {shortcode}')
         log_json.error(f'Incoming config not found for shortcode: {shortcode}')
-        raise ValueError("INCOMING-CONFIG-NOT_FOUND")
+        set_negative_cache(INCOMING_CONFIG_NOT_FOUND, shortcode, keyword)
+        raise ValueError(INCOMING_CONFIG_NOT_FOUND)
 
     log.debug(f"Account info for shortcode {shortcode}: {incoming_config}")
     log_json.info(f"account_id = {account_id} for shortcode: {shortcode}.",
@@ -108,12 +157,12 @@ def save_mms_urls(is_hipaa, params, sms_id):
         db_model.save_mms_url(is_hipaa, url, sms_id, skip)
 
 
-def save_incoming_sms(params):
+def save_incoming_sms(params, commit=True):
     log.info('Inside function save_incoming_sms')
     params["incomingProviderId"] = params["providerId"]
     account_id = params.get('accountId')
     is_hipaa = is_account_hipaa_enabled(account_id)
-    sms_record = db_model.save_incoming_sms(is_hipaa, params)
+    sms_record = db_model.save_incoming_sms(is_hipaa, params, commit=commit)
     if params.get("mms_urls", []) and not params.get("skip_db_url_storage"):
         save_mms_urls(is_hipaa, params, sms_record["id"])
     return sms_record
@@ -150,14 +199,18 @@ def assemble_message(params):
     if not parts:
         log.debug("No message parts")
         return
+    return join_parts([p['message'] for p in parts])
 
+
+def join_parts(messages):
+    """Joins texts of message parts, in part order, into the message"""
     message = ''
-    for p in parts:
+    for part in messages:
         try:
-            message += p['message']
+            message += part
         except UnicodeEncodeError:
             try:
-                message += p['message'].decode("utf-8")
+                message += part.decode("utf-8")
             except Exception as e:
                 log.exception(f'Error while joining message parts: {e}')
     try:
@@ -235,3 +288,8 @@ def complete_celery_task(entry_id=None):
 def fail_celery_task(entry_id=None, error=None):
     return db_model.update_celery_task(
         entry_id=entry_id, status=CELERY_TASK_STATUS_FAILED, error=error)
+
+
+def reject_celery_task(entry_id=None, error=None):
+    """Fails the CeleryTask of a message rejected before it was started"""
+    return db_model.fail_unstarted_celery_task(entry_id=entry_id, error=error)
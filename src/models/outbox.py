@@ -0,0 +1,39 @@
+"""
+Outbox of channel dispatches, written in the transaction which saves the
+incoming message and published by the outbox relay.
+
+The table is created by the migrations/*_incoming_sms_outbox*.sql files; it
+is not part of the sm_models metadata. Sent entries are deleted by the relay
+after OUTBOX_RETENTION.
+"""
+from sqlalchemy import Column, BigInteger, Integer, String, Text, DateTime
+from sqlalchemy.ext.declarative import declarative_base
+
+Base = declarative_base()
+
+OUTBOX_STATUS_PENDING = 'pending'
+OUTBOX_STATUS_SENT = 'sent'
+OUTBOX_STATUS_FAILED = 'failed'
+
+# How the relay publishes the entry
+OUTBOX_ARG_PAYLOAD = 'payload'
+OUTBOX_ARG_ENTRY_ID = 'entry_id'
+OUTBOX_ARG_EVENT = 'event'
+
+
+class IncomingSmsOutbox(Base):
+    __tablename__ = 'incoming_sms_outbox'
+
+    id = Column(BigInteger, primary_key=True)
+    incoming_sms_id = Column(BigInteger, nullable=False)
+    account_id = Column(Integer, nullable=False)
+    worker = Column(String(64), nullable=False)
+    arg = Column(String(16), nullable=False)
+    payload = Column(Text, nullable=False)
+    request_id = Column(String(64))
+    status = Column(String(16), nullable=False, default=OUTBOX_STATUS_PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    # Retried from then on; NULL is due at once
+    next_attempt_at = Column(DateTime)
+    created_on = Column(DateTime, nullable=False)
+    sent_on = Column(DateTime)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Adaptive concurrency of the worker pool.
+
+Pool processes record the latency and outcome of every task in memory shared
+with the main worker process. The autoscaler of the main process turns these
+into a concurrency limit, additive increase / multiplicative decrease: the
+limit is halved while tasks are slower than ADAPTIVE_TARGET_LATENCY or fail
+more often than ADAPTIVE_MAX_ERROR_RATE, and grows by one process per interval
+once they recover. When downstreams are degraded even at the minimum limit,
+the worker stops consuming its queues for ADAPTIVE_PAUSE seconds.
+
+While degraded, in-process retries of database writes are skipped; the task
+is retried by Celery later instead.
+"""
+import multiprocessing
+from time import monotonic
+
+from celery.worker.autoscale import Autoscaler
+
+from src import config
+from src.utils.config_loggers import log, log_json
+
+COUNT, LATENCY, ERRORS, DEGRADED = range(4)
+
+
+class SharedStats(object):
+    """
+    Task counters shared by the pool processes. Created before the pool
+    forks, so every process (including ones forked later) shares the memory.
+    """
+
+    def __init__(self):
+        self._values = multiprocessing.Array('d', 4)
+
+    def record(self, latency, failed=False):
+        with self._values.get_lock():
+            self._values[COUNT] += 1
+            self._values[LATENCY] += latency
+            self._values[ERRORS] += int(failed)
+
+    def drain(self):
+        """Returns (count, latency sum, errors) since last drain"""
+        with self._values.get_lock():
+            count, latency, errors = self._values[:DEGRADED]
+            self._values[COUNT] = self._values[LATENCY] = \
+                self._values[ERRORS] = 0
+        return int(count), latency, int(errors)
+
+    @property
+    def degraded(self):
+        return bool(self._values[DEGRADED])
+
+    @degraded.setter
+    def degraded(self, value):
+        self._values[DEGRADED] = int(value)
+
+
+class AIMDLimiter(object):
+
+    def __init__(self, min_limit, max_limit, target_latency, max_error_rate,
+                 decrease=0.5):
+        self.min_limit = max(min_limit, 1)
+        self.max_limit = max(max_limit, self.min_limit)
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.decrease = decrease
+        self.limit = self.max_limit
+        self.degraded = False
+
+    def update(self, count, latency, errors):
+        """Returns the new limit for the tasks seen in the last interval"""
+        if not count:
+            # No signal, keep the limit
+            return self.limit
+        self.degraded = latency / count > self.target_latency or \
+            errors / count > self.max_error_rate
+        if self.degraded:
+            self.limit = max(self.min_limit, int(self.limit * self.decrease))
+        else:
+            self.limit = min(self.max_limit, self.limit + 1)
+        return self.limit
+
+    @property
+    def at_minimum(self):
+        return self.limit == self.min_limit
+
+
+stats = SharedStats()
+
+
+def record_task(latency, failed=False):
+    if config.ADAPTIVE_CONCURRENCY:
+        stats.record(latency, failed)
+
+
+def retry_unless_degraded(exception):
+    """retry_on_exception of @retry: no in-process retries while degraded"""
+    return not (config.ADAPTIVE_CONCURRENCY and stats.degraded)
+
+
+class AdaptiveAutoscaler(Autoscaler):
+    """Celery autoscaler (worker_autoscaler) bounded by the AIMD limit"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limiter = AIMDLimiter(self.min_concurrency, self.max_concurrency,
+                                   config.ADAPTIVE_TARGET_LATENCY,
+                                   config.ADAPTIVE_MAX_ERROR_RATE)
+        self.adapted_at = monotonic()
+        self.paused_at = None
+        self.paused_queues = []
+
+    def _maybe_scale(self, req=None):
+        now = monotonic()
+        if now - self.adapted_at >= config.ADAPTIVE_INTERVAL:
+            self.adapted_at = now
+            self._adapt(now)
+        if self.processes > self.max_concurrency:
+            self._shrink(self.processes - self.max_concurrency)
+            return True
+        return super()._maybe_scale(req)
+
+    def _adapt(self, now):
+        count, latency, errors = stats.drain()
+        limit = self.limiter.update(count, latency, errors)
+        stats.degraded = self.limiter.degraded
+        if limit != self.max_concurrency:
+            log_json.warning('Worker concurrency limit changed.', extra={
+                'limit': limit, 'tasks': count, 'errors': errors,
+                'latency': round(latency / count, 3) if count else None})
+            # Called with the mutex held, so not through update()
+            self._update_consumer_prefetch_count(limit)
+            self.max_concurrency = limit
+
+        if self.paused_at:
+            if now - self.paused_at >= config.ADAPTIVE_PAUSE:
+                self._resume()
+        elif self.limiter.degraded and self.limiter.at_minimum:
+            self._pause(now)
+
+    def _pause(self, now):
+        consumer = self.worker.consumer
+        self.paused_queues = [q.name for q in consumer.task_consumer.queues]
+        log.warning(f'Downstreams degraded, pausing {self.paused_queues}')
+        for queue in self.paused_queues:
+            consumer.cancel_task_queue(queue)
+        self.paused_at = now
+
+    def _resume(self):
+        log.warning(f'Resuming {self.paused_queues}')
+        for queue in self.paused_queues:
+            self.worker.consumer.add_task_queue(queue)
+        self.paused_queues = []
+        self.paused_at = None
+        # Probe with the minimum limit; no samples were taken while paused
+        self.limiter.degraded = stats.degraded = False
@@ -1,9 +1,14 @@
 # !/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from time import time
+
 from celery import Celery
+from celery.signals import before_task_publish
 
 from src import config
+from src.utils.constants import PRUNE_PARTS_TASK_NAME, TASK_MODULE, \
+    SWEEP_MULTIPART_TASK_NAME
 
 __author__ = "Yashpal Meena <yashpal.meena@screen-magic.com>"
 __copyright__ = "Copyright 2022 Screen Magic Mobile Pvt Ltd"
@@ -17,9 +22,39 @@ def get_celery_app(app_name):
         task_acks_late='False',
         accept_content=['json'],
         task_ignore_result=True,
-        worker_hijack_root_logger=True
+        worker_hijack_root_logger=True,
+        beat_schedule=get_beat_schedule()
     )
+    if config.ADAPTIVE_CONCURRENCY:
+        _app.conf.worker_autoscaler = \
+            'src.utils.adaptive_concurrency:AdaptiveAutoscaler'
     return _app
 
 
+def get_beat_schedule():
+    """Periodic maintenance tasks, sent by `celery beat` to the worker queue"""
+    schedule = {}
+    if config.PARTS_PRUNE_INTERVAL:
+        schedule['prune-incoming-sms-parts'] = {
+            'task': PRUNE_PARTS_TASK_NAME,
+            'schedule': config.PARTS_PRUNE_INTERVAL,
+            'options': {'queue': TASK_MODULE}
+        }
+    if config.MULTIPART_SWEEP_INTERVAL:
+        schedule['sweep-multipart-deadlines'] = {
+            'task': SWEEP_MULTIPART_TASK_NAME,
+            'schedule': config.MULTIPART_SWEEP_INTERVAL,
+            'options': {'queue': TASK_MODULE,
+                        'expires': config.MULTIPART_SWEEP_INTERVAL}
+        }
+    return schedule
+
+
 app = get_celery_app(config.APP_NAME)
+
+
+@before_task_publish.connect
+def stamp_queued_at(headers=None, **kwargs):
+    """Send time of every published task, for its queue time (fair_share)"""
+    if headers is not None:
+        headers.setdefault('queuedAt', time())
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Circuit breakers for upstreams (media upload URL, worker exchanges), shared by
+all processes through Redis.
+
+CIRCUIT_FAILURE_THRESHOLD failures within CIRCUIT_FAILURE_WINDOW seconds open
+the circuit: calls fail fast with CircuitOpenError. After
+CIRCUIT_RESET_TIMEOUT seconds the circuit is half-open and a single process
+gets to probe the upstream; success closes the circuit, failure opens it
+again. When Redis is not reachable, calls are allowed.
+"""
+from time import time, monotonic
+
+from src import config
+from src.utils.config_loggers import log, log_json
+from src.utils.redis_cache import redis_cache
+
+# Counts a failure and opens the circuit at the threshold; a failed probe of
+# an open circuit opens it again. ARGV: threshold, now, window, open expiry
+FAILURE_SCRIPT = """
+local failures = redis.call('HINCRBY', KEYS[1], 'failures', 1)
+if failures == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+local opened = redis.call('HEXISTS', KEYS[1], 'opened_at') == 1
+if opened or failures >= tonumber(ARGV[1]) then
+    redis.call('HSET', KEYS[1], 'opened_at', ARGV[2])
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    return 1
+end
+return 0
+"""
+
+# Takes the probe of a half-open circuit. Returns 1 if taken, 0 if another
+# process is probing; None from RedisCache means Redis is not reachable.
+PROBE_SCRIPT = """
+if redis.call('SET', KEYS[1], 1, 'NX', 'EX', ARGV[1]) then
+    return 1
+end
+return 0
+"""
+
+# State read from Redis is reused for this long within a process
+STATE_CACHE_TTL = 1
+
+
+class CircuitOpenError(Exception):
+    """Upstream is failing, call was not made"""
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, name, is_failure=None):
+        self.name = name
+        self.key = f'{config.APP_NAME}:CIRCUIT:{name}'
+        # Exceptions which count as upstream failures; all by default
+        self.is_failure = is_failure or (lambda e: True)
+        self._state = None
+        self._state_read_at = None
+
+    def call(self, func, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpenError(f'Circuit {self.name} is open')
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if self.is_failure(e):
+                self.failure()
+            raise
+        self.success()
+        return result
+
+    def allow(self):
+        failures, opened_at = self._read_state()
+        if not opened_at:
+            return True
+        if time() - opened_at < config.CIRCUIT_RESET_TIMEOUT:
+            return False
+        # Half-open: one probe at a time
+        probe = redis_cache.eval(PROBE_SCRIPT, 1, f'{self.key}:PROBE',
+                                 config.CIRCUIT_RESET_TIMEOUT)
+        if probe is None:
+            # Redis errors allow the call
+            return True
+        if probe:
+            log.info(f'Circuit {self.name} half-open, probing')
+        return bool(probe)
+
+    def success(self):
+        # Nothing to reset for a closed circuit without failures
+        if self._state and any(self._state):
+            redis_cache.delete(self.key)
+            redis_cache.delete(f'{self.key}:PROBE')
+            if self._state[1]:
+                log_json.info('Circuit closed.', extra={'circuit': self.name})
+            self._state = (0, None)
+
+    def failure(self):
+        opened = redis_cache.eval(FAILURE_SCRIPT, 1, self.key,
+                                  config.CIRCUIT_FAILURE_THRESHOLD, time(),
+                                  config.CIRCUIT_FAILURE_WINDOW,
+                                  config.CIRCUIT_OPEN_EXPIRY)
+        if opened:
+            log_json.warning('Circuit open.', extra={'circuit': self.name})
+        self._state = None
+
+    def _read_state(self):
+        if self._state is None or \
+                monotonic() - self._state_read_at >= STATE_CACHE_TTL:
+            state = redis_cache.hmget(self.key, 'failures', 'opened_at') or \
+                (None, None)
+            self._state = (int(state[0] or 0),
+                           float(state[1]) if state[1] else None)
+            self._state_read_at = monotonic()
+        return self._state
+
+
+_breakers = {}
+
+
+def get_breaker(name, is_failure=None):
+    """Circuit breaker of the upstream, one per process"""
+    if name not in _breakers:
+        _breakers[name] = CircuitBreaker(name, is_failure)
+    return _breakers[name]
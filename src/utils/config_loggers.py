@@ -34,6 +34,8 @@ LOG_CONFIG = {
             'formatter': 'json',
             'level': 'DEBUG',
             'filename': config.JSON_LOG_FILE_PATH,
+            # Opened on the first record, by the process writing it
+            'delay': True,
         }
     },
     'loggers': {
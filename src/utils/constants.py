@@ -1,5 +1,9 @@
 TASK_MODULE = 'incoming_sms_processor'
 MULTI_CHANNEL_TASK_MODULE = 'incoming_whatsapp_process'
+# Partition queues of multipart messages: incoming_sms_processor.multipart.<n>
+MULTIPART_QUEUE_PREFIX = f'{TASK_MODULE}.multipart'
+# Tasks of shortcodes over their fair share
+OVERFLOW_QUEUE = f'{TASK_MODULE}.overflow'
 
 MAIN_MODULE = 'incoming_sms_processor'
 
@@ -62,6 +66,17 @@ CELERY_TASK_STATUS_FAILED = 'FAILED'
 
 SMS_TASK_NAME = "incoming_sms_processor.handle_incoming_sms"
 WA_TASK_NAME = "incoming_sms_processor.handle_incoming_whatsapp"
+PRUNE_PARTS_TASK_NAME = "incoming_sms_processor.prune_incoming_sms_parts"
+SWEEP_MULTIPART_TASK_NAME = "incoming_sms_processor.sweep_multipart_deadlines"
+FLUSH_EMAIL_DIGEST_TASK_NAME = "incoming_sms_processor.flush_email_digest"
+FLUSH_CRM_BATCH_TASK_NAME = "incoming_sms_processor.flush_crm_batch"
+
+# Upper bounds of the latency buckets (Redis commands, tasks), in milliseconds
+LATENCY_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+                   10000, float('inf'))
+
+INBOUND_NUMBER_NOT_FOUND = 'INBOUND-NUMBER-NOT_FOUND'
+INCOMING_CONFIG_NOT_FOUND = 'INCOMING-CONFIG-NOT_FOUND'
 
 SCREEN_MAGIC_DOMAINS = {'sms-magic.com', 'txtbox.in'}
 
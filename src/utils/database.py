@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
+import threading
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.orm import scoped_session, sessionmaker, Session
 
 from src import config
 
@@ -10,6 +12,9 @@ from src import config
 How to use scoped sessions, please see here 
 https://docs.sqlalchemy.org/en/13/orm/contextual.html?highlight=
 scoped_session#sqlalchemy.orm.scoping.scoped_session
+
+The engine is created on first use in each process, so importing this module
+(and forking worker children) does not set up a connection pool.
 """
 
 __author__ = "Yashpal Meena <yashpal.meena@screen-magic.com>"
@@ -17,5 +22,47 @@ __copyright__ = "Copyright 2022 Screen Magic Mobile Pvt Ltd"
 
 db_url = config.SQLALCHEMY_DATABASE_URI
 options = {'pool_recycle': 3600, 'echo': False}
-engine = create_engine(db_url, **options)
-session = scoped_session(sessionmaker(bind=engine))
+
+_engine = None
+_engine_pid = None
+
+
+def get_engine():
+    """Engine of the current process, created on first use"""
+    global _engine, _engine_pid
+    if _engine is None or _engine_pid != os.getpid():
+        # The engine of the parent is left alone: disposing it here would
+        # close connections the parent is still using.
+        _engine = create_engine(db_url, **options)
+        _engine_pid = os.getpid()
+        event.listen(_engine, 'connect', _on_connect)
+        event.listen(_engine, 'checkout', _on_checkout)
+    return _engine
+
+
+def _on_connect(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    # Never use a connection inherited through fork
+    if connection_record.info['pid'] != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            f'Connection record belongs to pid '
+            f'{connection_record.info["pid"]}, not {os.getpid()}')
+
+
+class LazySession(Session):
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        return get_engine()
+
+
+def _session_scope():
+    # A session used before fork is not reused by the child
+    return os.getpid(), threading.get_ident()
+
+
+session = scoped_session(sessionmaker(class_=LazySession),
+                         scopefunc=_session_scope)
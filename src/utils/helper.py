@@ -1,18 +1,28 @@
 import datetime
+from collections import ChainMap
+from collections.abc import Mapping
 from functools import wraps
 from random import randint
 from time import sleep
+from types import MappingProxyType
 from sqlalchemy import inspect
+from sqlalchemy.types import Date, DateTime
 
 from src.utils.config_loggers import log
 from src.utils.constants import MASK_FILTER
 
+_column_mappings = {}
+_row_serializers = {}
 
-def to_dict(model=None, single=False):
+
+def to_dict(model=None, single=False, columns=None):
+    """
+    Converts ORM object(s) to dict(s). Pass columns to convert only those
+    attributes.
+    """
     def _object_to_dict(obj):
         if obj:
-            _columns = getattr(obj, '__mapper__').columns.keys()
-            return {c: check_dates(getattr(obj, c)) for c in _columns}
+            return get_row_serializer(type(obj), columns)(obj)
         return {}
 
     if isinstance(model, list):
@@ -27,11 +37,58 @@ def check_dates(date_object):
     return date_object
 
 
+def get_row_serializer(orm_class, columns=None):
+    """
+    Returns a row -> dict function for the ORM class, compiled on first use.
+    Only date/datetime columns are converted to ISO strings, the rest are
+    copied as they are. Requested columns which the class does not have are
+    ignored.
+    """
+    columns = tuple(columns) if columns else None
+    serializer = _row_serializers.get((orm_class, columns))
+    if serializer is None:
+        serializer = _row_serializers[(orm_class, columns)] = \
+            _compile_row_serializer(orm_class, columns)
+    return serializer
+
+
+def _compile_row_serializer(orm_class, columns=None):
+    mapper_columns = inspect(orm_class).columns
+    keys = tuple(k for k in mapper_columns.keys()
+                 if not columns or k in columns)
+    date_keys = tuple(k for k in keys if _is_date_type(mapper_columns[k].type))
+    if not keys:
+        return lambda obj: {}
+
+    def serialize(obj):
+        # Loaded values are read from the instance dict directly; expired or
+        # deferred attributes go through the descriptor, which loads them.
+        state = obj.__dict__
+        row = {k: state[k] if k in state else getattr(obj, k) for k in keys}
+        for k in date_keys:
+            value = row[k]
+            if value is not None:
+                row[k] = check_dates(value)
+        return row
+
+    return serialize
+
+
+def _is_date_type(column_type):
+    # Custom types (TypeDecorator) keep the underlying type in impl
+    return isinstance(column_type, (Date, DateTime)) or \
+        isinstance(getattr(column_type, 'impl', None), (Date, DateTime))
+
+
 def get_orm_column_mapping(orm_class):
-    mapper = inspect(orm_class)
-    orm_keys = mapper.columns.keys()
-    db_keys = [e.key for e in mapper.columns.values()]
-    return dict(zip(db_keys, orm_keys))
+    """Returns {db column name: ORM attribute}, computed once per class"""
+    mapping = _column_mappings.get(orm_class)
+    if mapping is None:
+        mapper = inspect(orm_class)
+        orm_keys = mapper.columns.keys()
+        db_keys = [e.key for e in mapper.columns.values()]
+        mapping = _column_mappings[orm_class] = dict(zip(db_keys, orm_keys))
+    return mapping
 
 
 def handle_exceptions(func):
@@ -47,14 +104,14 @@ def handle_exceptions(func):
 
 def insensitive_data(data_dict):
     return masked_data(data_dict, filter_words=['message', 'text']) \
-        if isinstance(data_dict, dict) else data_dict
+        if isinstance(data_dict, Mapping) else data_dict
 
 
 def masked_data(data=None, filter_words=MASK_FILTER):
     result = {}
-    if data and isinstance(data, dict):
+    if data and isinstance(data, Mapping):
         for k, v in data.items():
-            if isinstance(v, dict):
+            if isinstance(v, Mapping):
                 result[k] = masked_data(v)
             elif isinstance(v, list):
                 result[k] = list(map(masked_data, v))
@@ -71,6 +128,29 @@ def map_keys(dictionary, mapper):
     }
 
 
+def compile_projection(key_map):
+    """
+    Compiles {key_from_message: key_of_payload} into a message -> payload
+    function, same result as map_keys but only the mapped keys are read.
+    """
+    pairs = tuple(key_map.items())
+
+    def project(message):
+        return {dst: byte_to_str(message[src]) for src, dst in pairs
+                if src in message}
+
+    return project
+
+
+def message_view(message, **overrides):
+    """
+    Read only view of the message. Overrides shadow keys of the message
+    without copying it.
+    """
+    return MappingProxyType(ChainMap(overrides, message) if overrides else
+                            message)
+
+
 def byte_to_str(substring):
     return substring.decode('utf-8') if isinstance(substring, bytes) else \
         substring
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Guards an incoming message against being processed twice when the task is
+retried or redelivered. Two keys are kept per message:
+
+- the lock, held by the delivery processing the message. It has a short
+  expiry so a crashed worker does not hold the message forever, and is
+  extended at each stage boundary while a slow message (media upload, CRM
+  calls) is processed, so a redelivery does not process it in parallel.
+- the state, recording how far processing got, kept for a day:
+
+    SAVED -> DONE -> COMPLETED
+
+A message left SAVED is taken over once its lock is free, so a retry resumes
+it from its stage journal.
+"""
+import uuid
+from time import monotonic
+
+from src import config
+from src.utils.config_loggers import log, log_json
+from src.utils.redis_cache import redis_cache
+
+# Lock of the message is held by another delivery
+MESSAGE_STATE_PROCESSING = 'PROCESSING'
+# Message (or message part) is committed to database
+MESSAGE_STATE_SAVED = 'SAVED'
+# Pipeline has run, CeleryTask is not yet finalized
+MESSAGE_STATE_DONE = 'DONE'
+# CeleryTask is finalized, nothing left to do
+MESSAGE_STATE_COMPLETED = 'COMPLETED'
+
+# Takes the lock (KEYS[2]) if it is free and the message (state in KEYS[1])
+# is new or left in a resumable state. Returns {acquired, state}.
+# ARGV: token, PROCESSING, SAVED, lock expiry
+ACQUIRE_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return {0, ARGV[2]}
+end
+local state = redis.call('GET', KEYS[1])
+if state and state ~= ARGV[3] then
+    return {0, state}
+end
+redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[4])
+return {1, state or ''}
+"""
+
+# Extends the lock while it is still held. Returns 1 if extended.
+EXTEND_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Deletes the lock only while it is held by the caller
+UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class MessageInProgressError(Exception):
+    """Same message is being processed by another worker right now."""
+
+
+class MessageIdempotency(object):
+
+    def __init__(self, params):
+        self.key = self.get_key(params)
+        self.lock_key = f'{self.key}:LOCK' if self.key else None
+        self.state = None
+        self.resumed = False
+        # Set while this delivery holds the lock
+        self.token = None
+        self.extended_at = None
+
+    @staticmethod
+    def get_key(params):
+        message_id = params.get('messageId')
+        if not message_id:
+            return None
+        tag = f'{params.get("providerId")}:{message_id}:' \
+              f'{params.get("shortCode")}'
+        # Parts of a multipart message may share the provider message id
+        if params.get('isMultiPart'):
+            tag += f':{params.get("referenceId")}:' \
+                   f'{params.get("partOrderNumber")}'
+        # State and lock share the hash tag, so the scripts are cluster safe
+        return f'{config.APP_NAME}:IDEMPOTENCY:{{{tag}}}'
+
+    def acquire(self):
+        """
+        Returns True if this delivery owns the message. When Redis is not
+        reachable the guard is skipped and the message is processed as before.
+        """
+        if not self.key:
+            return True
+        token = uuid.uuid4().hex
+        result = redis_cache.eval(ACQUIRE_SCRIPT, 2, self.key, self.lock_key,
+                                  token, MESSAGE_STATE_PROCESSING,
+                                  MESSAGE_STATE_SAVED,
+                                  config.IDEMPOTENCY_LOCK_EXPIRY)
+        if not result:
+            return True
+
+        acquired, state = result
+        if acquired:
+            self.state = MESSAGE_STATE_PROCESSING
+            self.token = token
+            self.extended_at = monotonic()
+            self.resumed = state == MESSAGE_STATE_SAVED
+            if self.resumed:
+                log.info(f'Resuming partially processed message: {self.key}')
+            return True
+
+        self.state = state
+        log.warning(f'Duplicate delivery of {self.key}, state: {state}')
+        log_json.warning('Duplicate delivery of incoming message.',
+                         extra={'idempotency_key': self.key, 'state': state})
+        if state == MESSAGE_STATE_PROCESSING:
+            raise MessageInProgressError(f'{self.key} is being processed')
+        return False
+
+    def extend(self):
+        """
+        Extends the lock, at most every third of its expiry so a fast message
+        costs no extra round trip
+        """
+        if not self.token:
+            return
+        if monotonic() - self.extended_at < config.IDEMPOTENCY_LOCK_EXPIRY / 3:
+            return
+        self.extended_at = monotonic()
+        extended = redis_cache.eval(EXTEND_SCRIPT, 1, self.lock_key,
+                                    self.token, config.IDEMPOTENCY_LOCK_EXPIRY)
+        if extended == 0:
+            log_json.warning('In-progress lock of incoming message expired.',
+                             extra={'idempotency_key': self.key})
+
+    def mark(self, state):
+        if not self.key:
+            return
+        self.state = state
+        redis_cache.set(self.key, state, ex=config.IDEMPOTENCY_EXPIRY)
+
+    def release(self):
+        """Lets a redelivery process the message again."""
+        if not self.key:
+            return
+        self.state = None
+        redis_cache.delete(self.key)
+
+    def unlock(self):
+        """Frees the lock, so a retry or redelivery may take the message"""
+        if not self.token:
+            return
+        redis_cache.eval(UNLOCK_SCRIPT, 1, self.lock_key, self.token)
+        self.token = None
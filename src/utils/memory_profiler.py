@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Memory profiling of worker processes, enabled with MEMORY_PROFILE.
+
+Every task records the change of the resident set size (RSS) of its process.
+Every MEMORY_REPORT_EVERY tasks a report is appended to
+MEMORY_REPORT_DIR/memory-<pid>.log with:
+- RSS and its growth since the previous report, by task name
+- tracemalloc allocations grown since the previous report, by call site
+- SQLAlchemy sessions, identity map entries and scoped session registry size
+- object types which grew the most in number
+
+tracemalloc slows allocations down noticeably; enable on a single worker.
+"""
+import gc
+import os
+import resource
+import tracemalloc
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from celery.signals import task_prerun, task_postrun
+from sqlalchemy.orm import Session
+
+from src import config
+from src.utils.config_loggers import log, log_json
+from src.utils.database import session
+
+TRACEMALLOC_FRAMES = 10
+REPORT_TOP = 25
+
+PAGE_SIZE = resource.getpagesize()
+
+SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__, all_frames=True),
+    # Allocations of the reports themselves
+    tracemalloc.Filter(False, __file__, all_frames=True),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+def current_rss():
+    """Resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        # Not Linux: peak RSS, in KB
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+
+
+def count_objects():
+    """Returns (SQLAlchemy counts, object count by type)"""
+    gc.collect()
+    objects = gc.get_objects()
+    by_type = Counter(type(o).__name__ for o in objects)
+    sessions = [o for o in objects if isinstance(o, Session)]
+    counts = {
+        'sessions': len(sessions),
+        'identity_map': sum(len(s.identity_map) for s in sessions),
+        'new_and_dirty': sum(len(s.new) + len(s.dirty) for s in sessions),
+        'scoped_sessions': len(session.registry.registry),
+    }
+    return counts, by_type
+
+
+class MemoryProfiler(object):
+
+    def __init__(self, report_dir, every):
+        self.pid = os.getpid()
+        self.report_path = os.path.join(report_dir, f'memory-{self.pid}.log')
+        self.every = every
+        self.tasks = 0
+        self.rss_at_start = {}
+        # task name: [tasks, RSS growth, largest growth of one task]
+        self.growth = defaultdict(lambda: [0, 0, 0])
+        self.report_rss = None
+        self.snapshot = None
+        self.by_type = None
+
+    def task_started(self, task_id):
+        if self.snapshot is None:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.report_rss = current_rss()
+            self.snapshot = take_snapshot()
+            _, self.by_type = count_objects()
+        self.rss_at_start[task_id] = current_rss()
+
+    def task_finished(self, task_id, task_name):
+        rss_at_start = self.rss_at_start.pop(task_id, None)
+        if rss_at_start is None:
+            return
+        delta = current_rss() - rss_at_start
+        growth = self.growth[task_name]
+        growth[0] += 1
+        growth[1] += delta
+        growth[2] = max(growth[2], delta)
+        self.tasks += 1
+        if self.tasks % self.every == 0:
+            self.report()
+
+    def report(self):
+        rss = current_rss()
+        counts, by_type = count_objects()
+        snapshot = take_snapshot()
+        stats = snapshot.compare_to(self.snapshot, 'traceback')
+        type_growth = (by_type - self.by_type).most_common(REPORT_TOP)
+
+        lines = [f'=== {datetime.now().isoformat()} pid {os.getpid()} '
+                 f'after {self.tasks} tasks',
+                 f'RSS {rss >> 10} KB, '
+                 f'grown {(rss - self.report_rss) >> 10} KB since last report',
+                 '', 'RSS growth by task (tasks, total KB, largest KB):']
+        for name, (tasks, total, largest) in sorted(
+                self.growth.items(), key=lambda item: -item[1][1]):
+            lines.append(f'  {name}: {tasks}, {total >> 10}, {largest >> 10}')
+        lines += ['', f'SQLAlchemy: {counts}',
+                  '', 'Object types grown since last report:']
+        lines += [f'  {name}: +{count}' for name, count in type_growth]
+        lines += ['', 'Allocations grown since last report, by call site:']
+        for stat in [s for s in stats if s.size_diff > 0][:REPORT_TOP]:
+            lines.append(f'  +{stat.size_diff >> 10} KB, '
+                         f'+{stat.count_diff} blocks')
+            lines += [f'    {line}' for line in stat.traceback.format()]
+
+        with open(self.report_path, 'a') as report:
+            report.write('\n'.join(lines) + '\n\n')
+        log_json.info('Memory report written.', extra={
+            'tasks': self.tasks, 'rss': rss,
+            'rss_growth': rss - self.report_rss, 'report': self.report_path,
+            **counts})
+
+        self.growth.clear()
+        self.report_rss = rss
+        self.snapshot = snapshot
+        self.by_type = by_type
+
+
+_profiler = None
+
+
+def get_profiler():
+    """Profiler of the current process, None when disabled"""
+    global _profiler
+    if not config.MEMORY_PROFILE:
+        return None
+    if _profiler is None or _profiler.pid != os.getpid():
+        os.makedirs(config.MEMORY_REPORT_DIR, exist_ok=True)
+        _profiler = MemoryProfiler(config.MEMORY_REPORT_DIR,
+                                   config.MEMORY_REPORT_EVERY)
+        log.info(f'Memory profile reports: {_profiler.report_path}')
+    return _profiler
+
+
+@task_prerun.connect
+def profile_task_start(task_id=None, **kwargs):
+    profiler = get_profiler()
+    if profiler:
+        try:
+            profiler.task_started(task_id)
+        except Exception as e:
+            log.exception(f'Error in memory profiler: {e}')
+
+
+@task_postrun.connect
+def profile_task_end(task_id=None, task=None, **kwargs):
+    profiler = get_profiler()
+    if profiler:
+        try:
+            profiler.task_finished(task_id, task.name)
+        except Exception as e:
+            log.exception(f'Error in memory profiler: {e}')
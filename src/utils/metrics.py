@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Worker metrics shared by the prefork processes, enabled with METRICS_ENABLED.
+
+Each process writes its counters and histograms to its own memory mapped
+file in METRICS_DIR/<worker pid>, like the multiprocess mode of the
+Prometheus client. The main worker process serves one scrape of all the
+processes in the Prometheus text format on METRICS_PORT, summing the values
+of the files. Files of processes which exited (recycled by
+--max-tasks-per-child or scaled down) are folded into an archive file on
+scrape, so their counts are kept. A process holds a lock on its file while
+it lives, which is how a file of an exited process is told apart, also when
+its pid was reused.
+
+Values are reset when the worker restarts, as counters of any restarted
+process are. Without a port, the values are read with:
+
+    python -m src.utils.metrics METRICS_DIR/<worker pid>
+"""
+import fcntl
+import json
+import mmap
+import os
+import shutil
+import sys
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from struct import pack_into, unpack_from
+from time import monotonic
+
+from celery.signals import worker_init, worker_ready, worker_shutdown, \
+    task_prerun, task_postrun
+
+from src import config
+from src.utils.config_loggers import log
+from src.utils.constants import LATENCY_BUCKETS
+
+ARCHIVE_FILE = 'archive.db'
+INITIAL_SIZE = 1 << 16
+# Used bytes of the file, then entries of key length, key and value
+HEADER_SIZE = 8
+
+
+def _padded(length):
+    """Size of an entry key, aligned so the value is 8 byte aligned"""
+    return (4 + length + 7) & ~7
+
+
+def read_values(data):
+    """(key, value, position of the value) of the entries of a file"""
+    used = unpack_from('i', data, 0)[0] if len(data) >= HEADER_SIZE else 0
+    position = HEADER_SIZE
+    while position < used:
+        length = unpack_from('i', data, position)[0]
+        key = bytes(data[position + 4:position + 4 + length]).decode()
+        position += _padded(length)
+        yield key, unpack_from('d', data, position)[0], position
+        position += 8
+
+
+class MmapValues(object):
+    """
+    Values of one process in a memory mapped file. Only the process writing
+    the file holds its lock; other processes only read it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        while True:
+            self._file = open(path, 'a+b')
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            # Folded and removed by a scrape while waiting for the lock
+            inode = os.fstat(self._file.fileno()).st_ino
+            if os.path.exists(path) and os.stat(path).st_ino == inode:
+                break
+            self._file.close()
+        size = os.fstat(self._file.fileno()).st_size
+        if size < INITIAL_SIZE:
+            self._file.truncate(INITIAL_SIZE)
+        self._map(max(size, INITIAL_SIZE))
+        self._used = unpack_from('i', self._mmap, 0)[0] or HEADER_SIZE
+        self._positions = {key: position for key, _, position in
+                           read_values(self._mmap)}
+
+    def _map(self, size):
+        self._capacity = size
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+
+    def add(self, key, amount):
+        with self._lock:
+            position = self._positions.get(key)
+            if position is None:
+                position = self._append(key)
+            pack_into('d', self._mmap, position,
+                      unpack_from('d', self._mmap, position)[0] + amount)
+
+    def _append(self, key):
+        encoded = key.encode()
+        size = _padded(len(encoded)) + 8
+        while self._used + size > self._capacity:
+            self._mmap.close()
+            self._file.truncate(self._capacity * 2)
+            self._map(self._capacity * 2)
+        pack_into('i', self._mmap, self._used, len(encoded))
+        self._mmap[self._used + 4:self._used + 4 + len(encoded)] = encoded
+        position = self._used + _padded(len(encoded))
+        pack_into('d', self._mmap, position, 0.0)
+        # Readers see the entry once it is complete
+        self._used += size
+        pack_into('i', self._mmap, 0, self._used)
+        self._positions[key] = position
+        return position
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def values(self):
+        with self._lock:
+            return {key: value for key, value, _ in read_values(self._mmap)}
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+# Directory of the worker, set in the main process before the pool forks
+_directory = None
+_values = None
+# Documentation of the metrics, by name
+_metrics = {}
+
+
+def _process_values():
+    """Values of the current process, None while metrics are disabled"""
+    global _values, _directory
+    if _directory is None:
+        return None
+    if _values is None or _values.pid != os.getpid():
+        try:
+            _values = MmapValues(os.path.join(_directory,
+                                              f'{os.getpid()}.db'))
+        except OSError as e:
+            log.error(f'Metrics disabled in process {os.getpid()}: {e}')
+            _directory = _values = None
+    return _values
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.labelnames = tuple(labelnames)
+        # Keys of the samples, by label values
+        self._keys = {}
+        _metrics[name] = (self.kind, documentation)
+
+    def _key(self, sample, labels):
+        return json.dumps([self.kind, self.name, sample, labels],
+                          sort_keys=True)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        values = _process_values()
+        if values is None:
+            return
+        label_values = tuple(labels[name] for name in self.labelnames)
+        key = self._keys.get(label_values)
+        if key is None:
+            key = self._keys[label_values] = self._key('', labels)
+        values.add(key, amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        values = _process_values()
+        if values is None:
+            return
+        label_values = tuple(labels[name] for name in self.labelnames)
+        keys = self._keys.get(label_values)
+        if keys is None:
+            keys = self._keys[label_values] = [
+                self._key('_bucket', dict(labels, le=_format(bound)))
+                for bound in self.buckets
+            ] + [self._key('_sum', labels)]
+        if keys[0] not in values:
+            # Every bucket is rendered, also the ones not observed yet
+            for key in keys:
+                values.add(key, 0)
+        values.add(keys[bisect_left(self.buckets, value)], 1)
+        values.add(keys[-1], value)
+
+
+def _format(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if value % 1 else str(int(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n') \
+        .replace('"', r'\"')
+
+
+def _sample(name, labels, value):
+    if labels:
+        labels = ','.join(f'{label}="{_escape(labels[label])}"'
+                          for label in sorted(labels))
+        name = f'{name}{{{labels}}}'
+    return f'{name} {_format(value)}'
+
+
+def write_values(path, values):
+    """Writes values in the file format, replacing the file at once"""
+    entries = bytearray(HEADER_SIZE)
+    for key, value in values.items():
+        encoded = key.encode()
+        entry = bytearray(_padded(len(encoded)) + 8)
+        pack_into('i', entry, 0, len(encoded))
+        entry[4:4 + len(encoded)] = encoded
+        pack_into('d', entry, len(entry) - 8, value)
+        entries += entry
+    pack_into('i', entries, 0, len(entries))
+    with open(f'{path}.tmp', 'wb') as f:
+        f.write(entries)
+    os.replace(f'{path}.tmp', path)
+
+
+def archive_exited(directory):
+    """Folds the files of processes which exited into the archive file"""
+    exited = []
+    for file_name in sorted(os.listdir(directory)):
+        if file_name == ARCHIVE_FILE or not file_name.endswith('.db'):
+            continue
+        f = open(os.path.join(directory, file_name), 'rb')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Process alive
+            f.close()
+            continue
+        exited.append(f)
+    if not exited:
+        return
+    archive_path = os.path.join(directory, ARCHIVE_FILE)
+    try:
+        with open(archive_path, 'rb') as f:
+            archived = {key: value for key, value, _ in read_values(f.read())}
+    except FileNotFoundError:
+        archived = {}
+    for f in exited:
+        for key, value, _ in read_values(f.read()):
+            archived[key] = archived.get(key, 0) + value
+    write_values(archive_path, archived)
+    # Removed holding the lock, so a new process with the same pid waits
+    for f in exited:
+        os.unlink(f.name)
+        f.close()
+
+
+def collect(directory):
+    """Values summed over the files of the directory, by key"""
+    totals = defaultdict(float)
+    for file_name in os.listdir(directory):
+        if not file_name.endswith('.db'):
+            continue
+        try:
+            with open(os.path.join(directory, file_name), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            # Archived meanwhile
+            continue
+        for key, value, _ in read_values(data):
+            totals[key] += value
+    return totals
+
+
+def render(totals):
+    """Values in the Prometheus text format"""
+    metrics = defaultdict(list)
+    for key, value in totals.items():
+        kind, name, sample, labels = json.loads(key)
+        metrics[(kind, name)].append((sample, labels, value))
+    lines = []
+    for (kind, name), samples in sorted(metrics.items()):
+        documentation = _metrics.get(name, (kind, name))[1]
+        lines += [f'# HELP {name} {_escape(documentation)}',
+                  f'# TYPE {name} {kind}']
+        if kind == 'histogram':
+            lines += _render_histogram(name, samples)
+        else:
+            lines += [_sample(name, labels, value)
+                      for _, labels, value in sorted(samples, key=str)]
+    return '\n'.join(lines) + '\n'
+
+
+def _render_histogram(name, samples):
+    """Buckets are stored by bucket and rendered cumulative"""
+    series = defaultdict(lambda: {'buckets': [], 'sum': 0})
+    for sample, labels, value in samples:
+        bound = labels.pop('le', None)
+        labels_key = json.dumps(labels, sort_keys=True)
+        if sample == '_bucket':
+            series[labels_key]['buckets'].append((float(bound), value))
+        else:
+            series[labels_key]['sum'] = value
+    lines = []
+    for labels_key, values in sorted(series.items()):
+        labels = json.loads(labels_key)
+        count = 0
+        for bound, value in sorted(values['buckets']):
+            count += value
+            lines.append(_sample(f'{name}_bucket',
+                                 dict(labels, le=_format(bound)), count))
+        lines += [_sample(f'{name}_sum', labels, values['sum']),
+                  _sample(f'{name}_count', labels, count)]
+    return lines
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    _lock = threading.Lock()
+
+    def do_GET(self):
+        try:
+            with self._lock:
+                archive_exited(_directory)
+                body = render(collect(_directory)).encode()
+        except Exception as e:
+            log.exception(f'Error while collecting metrics: {e}')
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+TASKS = Counter('incoming_tasks_total', 'Tasks run, by task and state',
+                ('task', 'state'))
+TASK_LATENCY = Histogram('incoming_task_latency_ms',
+                         'Latency of tasks in milliseconds', ('task',))
+
+_started = {}
+
+
+@worker_init.connect
+def setup_metrics(**kwargs):
+    global _directory
+    if not config.METRICS_ENABLED:
+        return
+    directory = os.path.join(config.METRICS_DIR, str(os.getpid()))
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    _directory = directory
+
+
+@worker_ready.connect
+def serve_metrics(**kwargs):
+    if _directory is None or not config.METRICS_PORT:
+        return
+    try:
+        server = HTTPServer(('', config.METRICS_PORT), MetricsHandler)
+    except OSError as e:
+        log.error(f'Metrics not served on port {config.METRICS_PORT}: {e}')
+        return
+    threading.Thread(target=server.serve_forever, name='metrics',
+                     daemon=True).start()
+    log.info(f'Metrics served on port {config.METRICS_PORT}')
+
+
+@worker_shutdown.connect
+def remove_metrics(**kwargs):
+    if _directory is not None:
+        shutil.rmtree(_directory, ignore_errors=True)
+
+
+@task_prerun.connect
+def start_task_timer(task_id=None, **kwargs):
+    if _directory is not None:
+        _started[task_id] = monotonic()
+
+
+@task_postrun.connect
+def record_task_metrics(task_id=None, task=None, state=None, **kwargs):
+    started = _started.pop(task_id, None)
+    if started is None:
+        return
+    TASKS.inc(task=task.name, state=state)
+    TASK_LATENCY.observe((monotonic() - started) * 1000, task=task.name)
+
+
+if __name__ == '__main__':
+    sys.stdout.write(render(collect(sys.argv[1])))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+SQL statements, rows and database time per Celery task, enabled with
+SQL_INSTRUMENTATION.
+
+Engine events count every statement. When the task ends, the totals are
+logged on one JSON line, and statements run SQL_REPEAT_THRESHOLD times or
+more within the task (N+1 queries) are listed.
+
+Tests and benchmarks put a scenario under a budget:
+
+    with query_budget(statements=8):
+        IncomingSMSHandler(payload).process()
+
+which raises QueryBudgetExceeded when the scenario runs more statements,
+or repeats one statement more often, than allowed.
+"""
+from collections import Counter
+from contextlib import contextmanager
+from time import perf_counter
+
+from celery.signals import task_prerun, task_postrun
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from src import config
+from src.utils.config_loggers import log_json
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Scenario ran more SQL than its budget"""
+
+
+class QueryStats(object):
+
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+        self.db_time = 0
+        self.by_statement = Counter()
+
+    def record(self, statement, rows, seconds):
+        self.statements += 1
+        self.rows += max(rows, 0)
+        self.db_time += seconds
+        self.by_statement[statement] += 1
+
+    def repeated(self, threshold):
+        """Statements run at least `threshold` times, most repeated first"""
+        return [(statement, count) for statement, count in
+                self.by_statement.most_common() if count >= threshold]
+
+    def summary(self):
+        return {'sql_statements': self.statements, 'sql_rows': self.rows,
+                'sql_time': round(self.db_time, 4)}
+
+
+# Stats of the running task and of the budgeted scenarios, when any
+_collectors = []
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_execute(conn, cursor, statement, parameters, context,
+                    executemany):
+    if _collectors:
+        conn.info.setdefault('query_started', []).append(perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_execute(conn, cursor, statement, parameters, context,
+                   executemany):
+    started = conn.info.get('query_started')
+    if not (_collectors and started):
+        return
+    seconds = perf_counter() - started.pop()
+    for stats in _collectors:
+        stats.record(statement, cursor.rowcount, seconds)
+
+
+@contextmanager
+def collect_queries():
+    stats = QueryStats()
+    _collectors.append(stats)
+    try:
+        yield stats
+    finally:
+        _collectors.remove(stats)
+
+
+@contextmanager
+def query_budget(statements=None, repeats=None):
+    """
+    Fails the scenario when it runs more than `statements` statements
+    (SQL_QUERY_BUDGET by default) or one statement more than `repeats` times
+    """
+    statements = statements or config.SQL_QUERY_BUDGET
+    with collect_queries() as stats:
+        yield stats
+    if statements and stats.statements > statements:
+        raise QueryBudgetExceeded(
+            f'{stats.statements} SQL statements, budget is {statements}: '
+            f'{dict(stats.by_statement)}')
+    if repeats and stats.repeated(repeats + 1):
+        raise QueryBudgetExceeded(
+            f'Statements repeated over {repeats} times: '
+            f'{stats.repeated(repeats + 1)}')
+
+
+_task_stats = {}
+
+
+@task_prerun.connect
+def start_task_stats(task_id=None, **kwargs):
+    if config.SQL_INSTRUMENTATION:
+        stats = QueryStats()
+        _task_stats[task_id] = stats
+        _collectors.append(stats)
+
+
+@task_postrun.connect
+def log_task_stats(task_id=None, task=None, **kwargs):
+    stats = _task_stats.pop(task_id, None)
+    if stats is None:
+        return
+    _collectors.remove(stats)
+    extra = dict(stats.summary(), task=task.name)
+    repeated = stats.repeated(config.SQL_REPEAT_THRESHOLD)
+    if repeated:
+        extra['sql_repeated'] = [{'statement': statement, 'count': count}
+                                 for statement, count in repeated]
+        log_json.warning('Task SQL usage, repeated statements.', extra=extra)
+    else:
+        log_json.info('Task SQL usage.', extra=extra)
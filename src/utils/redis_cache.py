@@ -1,8 +1,17 @@
-import json
-from functools import wraps
+import os
+import threading
+from contextlib import contextmanager
+from functools import partial, wraps
+from time import monotonic
+
+from redis import Connection
+from redis.exceptions import ConnectionError as RedisConnectionError, \
+    TimeoutError as RedisTimeoutError
 
 from src import config
-from src.utils.config_loggers import log
+from src.utils.config_loggers import log, log_json
+from src.utils.metrics import Counter, Histogram
+from src.utils.serializer import CacheSerializer
 
 
 def magic_cache(expiry=3600, args_key=None, kwargs_key=None):
@@ -27,19 +36,22 @@ def magic_cache(expiry=3600, args_key=None, kwargs_key=None):
                 for key in kwargs_key:
                     cache_key += f':{key}:{kwargs.get(key, "STATIC")}'
             log.info(f'cache_key: {cache_key}')
-            data_json = redis_cache.get(cache_key)
-            if data_json:
-                log.info(f'Fetching {cache_key} from cache')
-                response = json.loads(data_json)
-                log.info(f'Response: Redis cache: {response}')
-                return response
+            data = cache_store.get(cache_key)
+            if data:
+                log.info(f'Fetching {cache_key} from cache ({len(data)} bytes)')
+                try:
+                    response = cache_serializer.loads(data)
+                    log.debug('Response: Redis cache: %s', response)
+                    return response
+                except Exception as e:
+                    log.error(f'Unable to deserialize {cache_key}: {e}')
 
             log.info('Getting data from function')
             response = fn(*args, **kwargs)
-            log.info(f'Response from function: {response}')
+            log.debug('Response from function: %s', response)
             if response is not None and cache_key:
-                data_json = json.dumps(response)
-                redis_cache.set(cache_key, data_json, expiry)
+                data = cache_serializer.dumps(response)
+                cache_store.set(cache_key, data, expiry)
             return response
 
         return wrapper
@@ -47,56 +59,222 @@ def magic_cache(expiry=3600, args_key=None, kwargs_key=None):
     return function_cache
 
 
+REDIS_LATENCY = Histogram('incoming_redis_command_latency_ms',
+                          'Latency of Redis commands in milliseconds',
+                          ('command',))
+REDIS_ERRORS = Counter('incoming_redis_command_errors_total',
+                       'Failed Redis commands', ('command',))
+
+
+# Wall-clock end of the Redis command running in the thread
+_command = threading.local()
+
+
+@contextmanager
+def command_deadline(ms):
+    """Bounds the Redis commands sent within by `ms` milliseconds in all"""
+    _command.expires_at = monotonic() + ms / 1000
+    try:
+        yield
+    finally:
+        _command.expires_at = None
+
+
+class DeadlineConnectionMixin(object):
+    """
+    Connection whose socket timeout is the time left to the deadline of the
+    current command, so one pool serves commands of every deadline and the
+    retries of a command (cluster redirects, reconnects) share its deadline.
+    """
+
+    def send_packed_command(self, *args, **kwargs):
+        expires_at = getattr(_command, 'expires_at', None)
+        if expires_at is not None:
+            timeout = expires_at - monotonic()
+            if timeout <= 0:
+                raise RedisTimeoutError('Redis command deadline exceeded')
+            self.socket_timeout = timeout
+            if self._sock:
+                self._sock.settimeout(timeout)
+        return super().send_packed_command(*args, **kwargs)
+
+
+class DeadlineConnection(DeadlineConnectionMixin, Connection):
+    pass
+
+
+class FastFailState(object):
+    """Consecutive failures of Redis, shared by the clients of a process"""
+
+    def __init__(self):
+        self.failures = 0
+        self.failing_until = None
+
+
 class RedisCache:
+    """
+    Redis client which never raises: a failing command is logged and returns
+    None, so callers fall back to the database.
 
-    def __init__(self, redis_client):
+    Each command is bounded by its deadline (REDIS_COMMAND_DEADLINES, else
+    REDIS_DEADLINE_MS) of wall-clock time, retries included. The client and
+    its pool are shared by all deadlines. After REDIS_FAST_FAIL_THRESHOLD
+    consecutive connection errors or timeouts, commands return None without
+    calling Redis until a PING succeeds, tried every REDIS_FAST_FAIL_SECONDS.
+    Clients given the same fast_fail state fail fast together.
+    """
+
+    def __init__(self, redis_client=None, connect=None, fast_fail=None):
         log.info('In the constructor of RedisCache')
-        self.redis_client = redis_client
+        self._redis_client = redis_client
+        # Builds the client on first use in each process, see
+        # get_redis_client
+        self._connect = connect
+        self._pid = None
+        self.fast_fail = fast_fail or FastFailState()
+
+    @property
+    def redis_client(self):
+        """Client of the current process"""
+        if not self._connect:
+            return self._redis_client
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._redis_client = None
+        if self._redis_client is None:
+            self._redis_client = self._connect()
+            if self._redis_client is None:
+                # Connected again once fast fail allows it
+                self._failed()
+        return self._redis_client
 
     def __getattr__(self, method_name):
         log.debug(f'RedisCache.__getattr__: {method_name}')
+        if not self._healthy():
+            return RedisCache._stub
+        deadline = config.REDIS_COMMAND_DEADLINES.get(
+            method_name, config.REDIS_DEADLINE_MS)
         try:
             redis_method = getattr(self.redis_client, method_name)
         except Exception as e:
             log.error(f'RedisCache:Prop:Exception:{method_name}: {e}')
             return RedisCache._stub
-        return self._wrapper(redis_method)
+        return self._wrapper(method_name, redis_method, deadline)
 
-    @staticmethod
-    def _wrapper(f):
+    def _wrapper(self, name, f, deadline):
         def applicator(*args, **kwargs):
+            started = monotonic()
+            failed = True
             try:
-                return f(*args, **kwargs)
+                with command_deadline(deadline):
+                    result = f(*args, **kwargs)
+                failed = False
+            except (RedisConnectionError, RedisTimeoutError) as err:
+                log.error(f'RedisCache:Exception:{name}: {err}')
+                self._failed()
+                return None
             except Exception as err:
-                log.error(f'RedisCache:Exception:{f.__name__}: {err}')
-            return None
+                log.error(f'RedisCache:Exception:{name}: {err}')
+                if (monotonic() - started) * 1000 >= deadline:
+                    # Retries given up on the deadline, e.g. the cluster's
+                    # "TTL exhausted"
+                    self._failed()
+                return None
+            finally:
+                self._record(name, (monotonic() - started) * 1000, failed)
+            self.fast_fail.failures = 0
+            return result
 
         return applicator
 
+    def _healthy(self):
+        state = self.fast_fail
+        if state.failing_until is None:
+            return True
+        if monotonic() < state.failing_until:
+            return False
+        # Health check before commands are let through again
+        state.failing_until = None
+        if self.ping():
+            log_json.info('Redis reachable again, fast fail ended.')
+            return True
+        return False
+
+    def _failed(self):
+        state = self.fast_fail
+        state.failures += 1
+        if config.REDIS_FAST_FAIL_THRESHOLD and \
+                state.failures >= config.REDIS_FAST_FAIL_THRESHOLD:
+            if state.failing_until is None:
+                log_json.warning('Redis failing, commands fail fast.',
+                                 extra={'failures': state.failures})
+            state.failing_until = monotonic() + config.REDIS_FAST_FAIL_SECONDS
+
+    @staticmethod
+    def _record(name, ms, failed):
+        REDIS_LATENCY.observe(ms, command=name)
+        if failed:
+            REDIS_ERRORS.inc(command=name)
+
     @staticmethod
     def _stub(*args, **kwargs):
         log.debug(f'In RedisCache.stub: args: {args}, kwargs: {kwargs}')
         return None
 
 
-def get_redis_client():
+def connect_redis(decode_responses=True):
     redis_client = None
+    options = {
+        'decode_responses': decode_responses,
+        'socket_timeout': config.REDIS_DEADLINE_MS / 1000,
+        'socket_connect_timeout': config.REDIS_CONNECT_TIMEOUT_MS / 1000,
+    }
+    if config.REDIS_MAX_CONNECTIONS:
+        options['max_connections'] = config.REDIS_MAX_CONNECTIONS
     try:
         if config.SERVICE_REDIS_CLUSTER_HOST in ('localhost', '127.0.0.1'):
-            from redis import Redis
-            redis_client = Redis(decode_responses=True, socket_timeout=10)
+            from redis import Redis, ConnectionPool
+            pool = ConnectionPool(connection_class=DeadlineConnection,
+                                  **options)
+            redis_client = Redis(connection_pool=pool)
         else:
             from rediscluster import RedisCluster
+            from rediscluster.connection import ClusterConnection
+
+            class DeadlineClusterConnection(DeadlineConnectionMixin,
+                                            ClusterConnection):
+                pass
+
             redis_client = RedisCluster(
                 host=config.SERVICE_REDIS_CLUSTER_HOST,
                 port=int(config.SERVICE_REDIS_CLUSTER_PORT),
-                decode_responses=True,
-                socket_timeout=10
+                connection_class=DeadlineClusterConnection,
+                **options
             )
+            # Tries per command (16 by default, with sleeps in between)
+            redis_client.RedisClusterRequestTTL = \
+                config.REDIS_CLUSTER_REQUEST_TTL
     except Exception as e:
         log.exception(f'Exception in redis connection {e}')
 
-    return RedisCache(redis_client)
+    return redis_client
+
+
+def get_redis_client(decode_responses=True, fast_fail=None):
+    """
+    RedisCache connecting on first use. RedisCluster reads the slots of the
+    cluster when created, so it is not created at import time, and a forked
+    child creates its own.
+    """
+    return RedisCache(connect=partial(connect_redis, decode_responses),
+                      fast_fail=fast_fail)
 
 
 redis_cache = get_redis_client()
+# magic_cache values may be binary, so they are read without decoding. The
+# decoding is set per connection, so this client has a pool of its own; a
+# failing Redis is detected once for both.
+cache_store = get_redis_client(decode_responses=False,
+                               fast_fail=redis_cache.fast_fail)
+cache_serializer = CacheSerializer(config.CACHE_SERIALIZER,
+                                   config.CACHE_COMPRESS_THRESHOLD)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Serializers for values cached in Redis by ``magic_cache``.
+
+Values written by a binary codec carry a 5 byte header:
+
+    b'MC' + <format version> + <codec id> + <compression flag>
+
+Values written by the legacy ``json`` codec have no header, exactly as before.
+Both forms are always readable, so the rollout is: deploy with
+CACHE_SERIALIZER=json everywhere, then switch the codec once every worker runs
+the new reader.
+"""
+import json
+import zlib
+
+HEADER_MAGIC = b'MC'
+FORMAT_VERSION = b'1'
+HEADER_SIZE = len(HEADER_MAGIC) + len(FORMAT_VERSION) + 2
+COMPRESSED, UNCOMPRESSED = b'z', b'-'
+
+
+class JsonCodec(object):
+    name = 'json'
+    codec_id = b'j'
+
+    @staticmethod
+    def dumps(value):
+        return json.dumps(value).encode('utf-8')
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+
+class OrjsonCodec(object):
+    name = 'orjson'
+    codec_id = b'o'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, value):
+        return self._orjson.dumps(value, option=self._orjson.OPT_NON_STR_KEYS)
+
+    def loads(self, data):
+        return self._orjson.loads(data)
+
+
+class MsgpackCodec(object):
+    name = 'msgpack'
+    codec_id = b'm'
+
+    def __init__(self):
+        import msgpack
+        self._msgpack = msgpack
+
+    def dumps(self, value):
+        return self._msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data):
+        return self._msgpack.unpackb(data, raw=False)
+
+
+CODECS = {
+    JsonCodec.name: JsonCodec,
+    OrjsonCodec.name: OrjsonCodec,
+    MsgpackCodec.name: MsgpackCodec
+}
+
+
+def get_codec(name):
+    """
+    Returns codec instance for the given name. Raises ValueError for an
+    unknown codec and ImportError when its library is not installed, so a
+    misconfigured CACHE_SERIALIZER stops the worker instead of silently
+    writing json.
+    """
+    if name not in CODECS:
+        raise ValueError(f'Unknown cache codec: {name}')
+    return CODECS[name]()
+
+
+class CacheSerializer(object):
+    """
+    param: codec - name of the codec used for writing ('json', 'orjson' or
+    'msgpack'). Reading always supports all installed codecs.
+    param: compress_threshold - values whose encoded size is at least this
+    many bytes are zlib compressed. 0 disables compression. Legacy json
+    values are never compressed.
+    """
+
+    def __init__(self, codec=JsonCodec.name, compress_threshold=0,
+                 compress_level=1):
+        self.codec = get_codec(codec)
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self._readers = {}
+
+    @property
+    def is_legacy(self):
+        return self.codec.name == JsonCodec.name
+
+    def dumps(self, value):
+        data = self.codec.dumps(value)
+        if self.is_legacy:
+            return data
+
+        flag = UNCOMPRESSED
+        if self.compress_threshold and len(data) >= self.compress_threshold:
+            compressed = zlib.compress(data, self.compress_level)
+            if len(compressed) < len(data):
+                data, flag = compressed, COMPRESSED
+        return HEADER_MAGIC + FORMAT_VERSION + self.codec.codec_id + flag + data
+
+    def loads(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if not data.startswith(HEADER_MAGIC):
+            return json.loads(data)
+
+        version = data[2:3]
+        if version != FORMAT_VERSION:
+            raise ValueError(f'Unsupported cache format version: {version}')
+        codec_id, flag = data[3:4], data[4:5]
+        body = data[HEADER_SIZE:]
+        if flag == COMPRESSED:
+            body = zlib.decompress(body)
+        return self._reader(codec_id).loads(body)
+
+    def _reader(self, codec_id):
+        reader = self._readers.get(codec_id)
+        if reader is None:
+            for codec in CODECS.values():
+                if codec.codec_id == codec_id:
+                    reader = self._readers[codec_id] = codec()
+                    break
+            else:
+                raise ValueError(f'Unknown cache codec: {codec_id}')
+        return reader
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Per message journal of completed processing stages and their outputs, kept
+in a Redis hash. A retried or redelivered task restores the outputs and
+resumes at the first incomplete stage instead of starting over.
+
+Checkpoints are held in memory until flush(), so stages which are cheap to
+repeat cost no Redis round trips unless a later stage made them worth keeping.
+Channel dispatches are written together with their stage, in one HMSET. A
+failed stage flushes what it dispatched before the task is retried; only a
+worker killed in the middle of the channels stage loses them, and the retry
+dispatches those channels again.
+
+The journal is keyed by the CeleryTask entry id, else by the idempotency key
+of the provider message id. A message with neither has no journal: a retry
+starts over from the first stage, as it did before the journal.
+"""
+import json
+
+from src import config
+from src.utils.config_loggers import log
+from src.utils.redis_cache import redis_cache
+
+STAGE_LOOKUP = 'lookup'
+STAGE_PART = 'part'
+STAGE_MULTIPART = 'multipart'
+STAGE_MEDIA = 'media'
+STAGE_SAVE = 'save'
+STAGE_METERING = 'metering'
+STAGE_CHANNELS = 'channels'
+STAGE_PARTS_UPDATE = 'parts_update'
+
+CHANNEL_FIELD_PREFIX = 'channel:'
+
+
+class StageRetryError(Exception):
+    """A stage after save failed; the retried task resumes from it."""
+
+
+class StageJournal(object):
+
+    def __init__(self, journal_id):
+        self.key = f'{config.APP_NAME}:JOURNAL:{journal_id}' \
+            if journal_id else None
+        if not self.key:
+            log.info('No entry id or message id, stages are not journaled')
+        self.stages = {}
+        self.channels = set()
+        self._pending = {}
+        self._stored = False
+
+    def load(self):
+        if not self.key:
+            return
+        for field, value in (redis_cache.hgetall(self.key) or {}).items():
+            if field.startswith(CHANNEL_FIELD_PREFIX):
+                self.channels.add(field[len(CHANNEL_FIELD_PREFIX):])
+            else:
+                self.stages[field] = json.loads(value)
+        self._stored = bool(self.stages or self.channels)
+        log.info(f'Journal {self.key} loaded; stages: {list(self.stages)}, '
+                 f'channels: {self.channels}')
+
+    def is_done(self, stage):
+        return stage in self.stages
+
+    def output(self, stage):
+        return self.stages.get(stage)
+
+    def record(self, stage, output=None, flush=False):
+        output = output or {}
+        self.stages[stage] = output
+        self._pending[stage] = json.dumps(output, default=str)
+        if flush:
+            self.flush()
+
+    def is_dispatched(self, channel):
+        return channel in self.channels
+
+    def record_dispatch(self, channel):
+        """Written with the channels stage, see flush()"""
+        self.channels.add(channel)
+        self._pending[f'{CHANNEL_FIELD_PREFIX}{channel}'] = 1
+
+    def flush(self):
+        if not self.key or not self._pending:
+            return
+        redis_cache.hmset(self.key, self._pending)
+        if not self._stored:
+            redis_cache.expire(self.key, config.IDEMPOTENCY_EXPIRY)
+            self._stored = True
+        self._pending = {}
+
+    def clear(self):
+        self._pending = {}
+        if self.key and self._stored:
+            redis_cache.delete(self.key)
+            self._stored = False
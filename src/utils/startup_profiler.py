@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Reports where a fresh worker process spends its time before it can serve the
+first task: import time per module (from `python -X importtime`, in a clean
+interpreter) and the time taken by the lazily initialized resources on first
+use (database engine and connection, Redis clients, JSON log file).
+
+Usage:
+    python -m src.utils.startup_profiler [module] [top]
+
+module defaults to the Celery task module, top to 25 rows.
+"""
+import os
+import re
+import subprocess
+import sys
+from collections import defaultdict
+from time import perf_counter
+
+DEFAULT_MODULE = 'src.incoming_sms_processor'
+DEFAULT_TOP = 25
+
+IMPORT_TIME_LINE = re.compile(
+    r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)\s*$')
+
+
+def profile_imports(module):
+    """Returns [(module, self us, cumulative us, depth)] in import order"""
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, env=dict(os.environ))
+    imports, errors = [], []
+    for line in process.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            imports.append((name, int(self_us), int(cumulative_us),
+                            len(indent) // 2))
+        elif not line.startswith('import time:'):
+            errors.append(line)
+    if process.returncode:
+        raise RuntimeError(f'Importing {module} failed:\n' + '\n'.join(errors))
+    return imports
+
+
+def by_package(imports):
+    """Self time summed by top level package"""
+    totals = defaultdict(int)
+    for name, self_us, _, _ in imports:
+        totals[name.split('.')[0]] += self_us
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)
+
+
+def profile_initialization():
+    """Returns [(resource, seconds)] for the first use of each resource"""
+    timings = []
+
+    def timed(name, func):
+        started = perf_counter()
+        try:
+            func()
+        except Exception as e:
+            name = f'{name} (failed: {e})'
+        timings.append((name, perf_counter() - started))
+
+    from src.utils.config_loggers import log_json
+    from src.utils.database import get_engine, session
+    from src.utils.redis_cache import redis_cache, cache_store
+
+    timed('database engine', get_engine)
+    timed('database connection', lambda: session.execute('SELECT 1'))
+    timed('redis client', lambda: redis_cache.redis_client)
+    timed('redis ping', redis_cache.ping)
+    timed('cache store client', lambda: cache_store.redis_client)
+    timed('json log file', lambda: log_json.debug('Startup profiler.'))
+    session.remove()
+    return timings
+
+
+def main(args):
+    module = args[0] if args else DEFAULT_MODULE
+    top = int(args[1]) if len(args) > 1 else DEFAULT_TOP
+
+    imports = profile_imports(module)
+    total = next((c for n, _, c, _ in imports if n == module), 0)
+    print(f'Import of {module}: {total / 1000:.1f} ms, '
+          f'{len(imports)} modules\n')
+
+    print(f'{"module":<60} {"self ms":>9} {"cumulative ms":>14}')
+    for name, self_us, cumulative_us, _ in sorted(
+            imports, key=lambda item: item[2], reverse=True)[:top]:
+        print(f'{name:<60} {self_us / 1000:>9.1f} '
+              f'{cumulative_us / 1000:>14.1f}')
+
+    print(f'\n{"package":<60} {"self ms":>9}')
+    for package, self_us in by_package(imports)[:top]:
+        print(f'{package:<60} {self_us / 1000:>9.1f}')
+
+    started = perf_counter()
+    __import__(module)
+    print(f'\nImport in this process: '
+          f'{(perf_counter() - started) * 1000:.1f} ms\n')
+    print(f'{"resource (first use)":<60} {"ms":>9}')
+    for name, seconds in profile_initialization():
+        print(f'{name:<60} {seconds * 1000:>9.1f}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
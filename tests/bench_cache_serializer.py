@@ -0,0 +1,70 @@
+"""
+Compares magic_cache serializers on size and CPU.
+
+Usage:
+    python -m tests.bench_cache_serializer [payload.json ...]
+
+Payload files are JSON values dumped from the cache, e.g.
+    redis-cli --raw get IncomingSMSHandler:GET_ACCOUNT:account_id:<id>
+Without arguments a sample account row and tag map are used.
+"""
+import json
+import sys
+from timeit import timeit
+
+from src.utils.serializer import CacheSerializer, CODECS
+
+ROUNDS = 2000
+
+SAMPLE_PAYLOADS = {
+    'account': {
+        'id': 123456789, 'company_name': 'SMS_Magic', 'contact_name': 'PK',
+        'phone_number': '8390886493', 'email_id': 'cicd1@screen-magic.com',
+        'api_key': 'c3a2bd5e-0d0e-4a43-9c0c-0c8f1d4f6a11',
+        'created_on': '2022-10-19T10:00:00', 'modified_on': None,
+        'customer_id': 4242, 'timezone': 'Asia/Kolkata', 'is_deleted': 0,
+        **{f'column_{i}': f'value_{i}' for i in range(60)}
+    },
+    'account_tags': {f'tag_flag_{i}': i % 3 for i in range(250)},
+    'account_settings': {f'setting_{i}': f'{i}' * 8 for i in range(120)}
+}
+
+
+def load_payloads(paths):
+    if not paths:
+        return SAMPLE_PAYLOADS
+    payloads = {}
+    for path in paths:
+        with open(path) as f:
+            payloads[path] = json.load(f)
+    return payloads
+
+
+def bench(name, serializer, value):
+    data = serializer.dumps(value)
+    dumps_us = timeit(lambda: serializer.dumps(value), number=ROUNDS)
+    loads_us = timeit(lambda: serializer.loads(data), number=ROUNDS)
+    print(f'{name:<22} {len(data):>8} '
+          f'{dumps_us / ROUNDS * 1e6:>10.2f} {loads_us / ROUNDS * 1e6:>10.2f}')
+
+
+def main(paths):
+    serializers = {'json (legacy)': CacheSerializer('json')}
+    for codec in CODECS:
+        serializer = CacheSerializer(codec)
+        if serializer.codec.name != codec or codec == 'json':
+            continue
+        serializers[codec] = serializer
+        serializers[f'{codec}+zlib'] = CacheSerializer(codec,
+                                                       compress_threshold=1)
+
+    for payload_name, value in load_payloads(paths).items():
+        print(f'\n{payload_name}')
+        print(f'{"serializer":<22} {"bytes":>8} {"dumps us":>10} '
+              f'{"loads us":>10}')
+        for name, serializer in serializers.items():
+            bench(name, serializer, value)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
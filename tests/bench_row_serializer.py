@@ -0,0 +1,78 @@
+"""
+Compares the compiled row serializer and cached column mapping with the
+helpers they replaced.
+
+Usage:
+    python -m tests.bench_row_serializer
+"""
+import datetime
+from timeit import timeit
+
+from sqlalchemy import Column, DateTime, Integer, String, inspect
+from sqlalchemy.ext.declarative import declarative_base
+
+from src.utils.helper import to_dict, check_dates, get_orm_column_mapping
+
+ROUNDS = 20000
+
+Base = declarative_base()
+
+
+class InboundNumberLike(Base):
+    __tablename__ = 'inbound_number_like'
+    id = Column(Integer, primary_key=True)
+    short_code = Column('shortCode', String(20))
+    incoming_provider_id = Column('incomingProviderId', Integer)
+    is_shared = Column(Integer)
+    country_id = Column(Integer)
+    inbound_number_type = Column(Integer)
+    created_on = Column('createdOn', DateTime)
+    modified_on = Column('modifiedOn', DateTime)
+    __table_args__ = {'extend_existing': True}
+
+
+for i in range(20):
+    setattr(InboundNumberLike, f'extra_{i}', Column(String(20)))
+
+
+def legacy_to_dict(obj):
+    _columns = getattr(obj, '__mapper__').columns.keys()
+    return {c: check_dates(getattr(obj, c)) for c in _columns}
+
+
+def legacy_column_mapping(orm_class):
+    mapper = inspect(orm_class)
+    orm_keys = mapper.columns.keys()
+    db_keys = [e.key for e in mapper.columns.values()]
+    return dict(zip(db_keys, orm_keys))
+
+
+def report(name, seconds):
+    print(f'{name:<36} {seconds / ROUNDS * 1e6:>8.2f} us')
+
+
+def main():
+    now = datetime.datetime.now()
+    row = InboundNumberLike(id=1, short_code='14242387011',
+                            incoming_provider_id=1, is_shared=0, country_id=1,
+                            inbound_number_type=1, created_on=now,
+                            modified_on=now,
+                            **{f'extra_{i}': f'value_{i}' for i in range(20)})
+    assert legacy_to_dict(row) == to_dict(row)
+    projection = ('id', 'short_code', 'incoming_provider_id', 'is_shared')
+
+    report('to_dict (legacy)', timeit(lambda: legacy_to_dict(row),
+                                      number=ROUNDS))
+    report('to_dict (compiled)', timeit(lambda: to_dict(row), number=ROUNDS))
+    report('to_dict (compiled, 4 columns)',
+           timeit(lambda: to_dict(row, columns=projection), number=ROUNDS))
+    report('get_orm_column_mapping (legacy)',
+           timeit(lambda: legacy_column_mapping(InboundNumberLike),
+                  number=ROUNDS))
+    report('get_orm_column_mapping (cached)',
+           timeit(lambda: get_orm_column_mapping(InboundNumberLike),
+                  number=ROUNDS))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import multiprocessing
+import threading
+import unittest
+from time import sleep, monotonic
+from unittest import mock
+
+from src.utils import adaptive_concurrency
+from src.utils.adaptive_concurrency import AIMDLimiter, SharedStats
+
+
+class InjectedDownstream(object):
+    """
+    Downstream (database, Redis) of a task with artificial latency: `base`
+    seconds per call, plus `injected`, plus `base` for every call in flight
+    over `capacity`.
+    """
+
+    def __init__(self, base=0.005, capacity=4):
+        self.base = base
+        self.capacity = capacity
+        self.injected = 0
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def call(self):
+        with self.lock:
+            self.in_flight += 1
+            overload = max(0, self.in_flight - self.capacity)
+        sleep(self.base + self.injected + overload * self.base)
+        with self.lock:
+            self.in_flight -= 1
+
+
+def run_interval(limiter, downstream, stats):
+    """Runs `limit` tasks concurrently and adapts the limit to them"""
+    def task():
+        started = monotonic()
+        downstream.call()
+        stats.record(monotonic() - started)
+
+    threads = [threading.Thread(target=task) for _ in range(limiter.limit)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return limiter.update(*stats.drain())
+
+
+class TestAIMDLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = AIMDLimiter(1, 8, target_latency=1, max_error_rate=0.2)
+
+    def test_decreases_multiplicatively_and_floors(self):
+        self.assertEqual(self.limiter.update(10, 20, 0), 4)
+        self.assertTrue(self.limiter.degraded)
+        self.assertEqual(self.limiter.update(10, 20, 0), 2)
+        self.assertEqual(self.limiter.update(10, 20, 0), 1)
+        self.assertEqual(self.limiter.update(10, 20, 0), 1)
+        self.assertTrue(self.limiter.at_minimum)
+
+    def test_errors_degrade(self):
+        self.assertEqual(self.limiter.update(10, 1, 5), 4)
+
+    def test_increases_additively_up_to_max(self):
+        self.limiter.limit = 6
+        self.assertEqual(self.limiter.update(10, 1, 0), 7)
+        self.assertEqual(self.limiter.update(10, 1, 0), 8)
+        self.assertEqual(self.limiter.update(10, 1, 0), 8)
+        self.assertFalse(self.limiter.degraded)
+
+    def test_no_samples_keep_limit(self):
+        self.limiter.limit = 3
+        self.assertEqual(self.limiter.update(0, 0, 0), 3)
+
+
+class TestSharedStats(unittest.TestCase):
+
+    def test_records_of_forked_processes_are_shared(self):
+        stats = SharedStats()
+        stats.record(0.5)
+        process = multiprocessing.get_context('fork').Process(
+            target=stats.record, args=(1.5, True))
+        process.start()
+        process.join()
+        self.assertEqual(stats.drain(), (2, 2.0, 1))
+        self.assertEqual(stats.drain(), (0, 0, 0))
+
+    def test_retries_skipped_only_while_degraded(self):
+        with mock.patch.object(adaptive_concurrency.config,
+                               'ADAPTIVE_CONCURRENCY', 1):
+            adaptive_concurrency.stats.degraded = True
+            self.assertFalse(adaptive_concurrency.retry_unless_degraded(None))
+            adaptive_concurrency.stats.degraded = False
+            self.assertTrue(adaptive_concurrency.retry_unless_degraded(None))
+
+
+class TestLatencyInjection(unittest.TestCase):
+
+    def test_limit_follows_injected_latency(self):
+        downstream = InjectedDownstream(base=0.005, capacity=4)
+        stats = SharedStats()
+        limiter = AIMDLimiter(1, 8, target_latency=0.05, max_error_rate=0.2)
+
+        # Healthy: at max the overload latency stays under the target
+        for _ in range(3):
+            run_interval(limiter, downstream, stats)
+        self.assertEqual(limiter.limit, 8)
+
+        # Slow downstream: limit backs off to the minimum
+        downstream.injected = 0.1
+        for _ in range(4):
+            run_interval(limiter, downstream, stats)
+        self.assertEqual(limiter.limit, 1)
+        self.assertTrue(limiter.degraded)
+
+        # Recovered downstream: limit climbs back one step per interval
+        downstream.injected = 0
+        limits = [run_interval(limiter, downstream, stats) for _ in range(7)]
+        self.assertEqual(limits, [2, 3, 4, 5, 6, 7, 8])
+        self.assertFalse(limiter.degraded)
+
+
+if __name__ == '__main__':
+    unittest.main()
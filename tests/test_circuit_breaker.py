@@ -0,0 +1,114 @@
+import unittest
+from unittest import mock
+
+from src.utils import circuit_breaker
+from src.utils.circuit_breaker import CircuitBreaker, CircuitOpenError, \
+    FAILURE_SCRIPT, PROBE_SCRIPT
+from tests.utils import start_patches
+
+
+class FakeRedis(object):
+    """The commands and scripts of the breaker, on dicts"""
+
+    def __init__(self):
+        self.hashes = {}
+        self.keys = set()
+        self.down = False
+
+    def hmget(self, key, *fields):
+        if self.down:
+            return None
+        return [self.hashes.get(key, {}).get(field) for field in fields]
+
+    def delete(self, key):
+        self.hashes.pop(key, None)
+        self.keys.discard(key)
+
+    def eval(self, script, numkeys, key, *args):
+        if self.down:
+            return None
+        if script == PROBE_SCRIPT:
+            if key in self.keys:
+                return 0
+            self.keys.add(key)
+            return 1
+        assert script == FAILURE_SCRIPT
+        threshold, now = args[:2]
+        state = self.hashes.setdefault(key, {})
+        state['failures'] = state.get('failures', 0) + 1
+        if 'opened_at' in state or state['failures'] >= threshold:
+            state['opened_at'] = now
+            return 1
+        return 0
+
+
+def fail():
+    raise ConnectionError('upstream down')
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        start_patches(
+            self,
+            mock.patch.object(circuit_breaker, 'redis_cache', self.redis),
+            mock.patch.object(circuit_breaker, 'STATE_CACHE_TTL', 0),
+            mock.patch.multiple(circuit_breaker.config,
+                                CIRCUIT_FAILURE_THRESHOLD=2,
+                                CIRCUIT_RESET_TIMEOUT=30))
+        self.breaker = CircuitBreaker('media')
+
+    def open_circuit(self):
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                self.breaker.call(fail)
+
+    def test_closed_circuit_allows_calls(self):
+        self.assertEqual(self.breaker.call(lambda: 'ok'), 'ok')
+        with self.assertRaises(ConnectionError):
+            self.breaker.call(fail)
+        self.assertTrue(self.breaker.allow())
+
+    def test_open_circuit_fails_fast(self):
+        self.open_circuit()
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.call(lambda: 'ok')
+
+    def test_half_open_probe_closes_circuit(self):
+        self.open_circuit()
+        with mock.patch.object(circuit_breaker, 'time',
+                               return_value=circuit_breaker.time() + 31):
+            other = CircuitBreaker('media')
+            self.assertEqual(self.breaker.call(lambda: 'ok'), 'ok')
+        self.assertFalse(self.redis.hashes)
+        self.assertTrue(other.allow())
+
+    def test_half_open_allows_one_probe(self):
+        self.open_circuit()
+        with mock.patch.object(circuit_breaker, 'time',
+                               return_value=circuit_breaker.time() + 31):
+            self.assertTrue(self.breaker.allow())
+            self.assertFalse(CircuitBreaker('media').allow())
+
+    def test_failed_probe_opens_again(self):
+        self.open_circuit()
+        later = circuit_breaker.time() + 31
+        with mock.patch.object(circuit_breaker, 'time', return_value=later):
+            with self.assertRaises(ConnectionError):
+                self.breaker.call(fail)
+            self.redis.delete(f'{self.breaker.key}:PROBE')
+            self.assertFalse(self.breaker.allow())
+
+    def test_half_open_allows_calls_when_redis_down(self):
+        self.open_circuit()
+        self.breaker._read_state()
+        with mock.patch.object(circuit_breaker, 'time',
+                               return_value=circuit_breaker.time() + 31), \
+                mock.patch.object(circuit_breaker, 'STATE_CACHE_TTL', 60):
+            self.redis.down = True
+            self.assertTrue(self.breaker.allow())
+
+
+if __name__ == '__main__':
+    unittest.main()
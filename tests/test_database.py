@@ -0,0 +1,64 @@
+import datetime
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from sqlalchemy import create_engine, Column, Integer, String, DateTime
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session
+
+from src.models import database
+from src.models.database import Model
+
+Base = declarative_base()
+
+
+class Message(Base):
+    __tablename__ = 'message'
+
+    id = Column(Integer, primary_key=True)
+    # Attribute named apart from its column, as in some sm_models classes
+    account_id = Column('accountId', Integer)
+    message = Column(String(160))
+    created_on = Column(DateTime)
+
+
+class TestInsert(unittest.TestCase):
+
+    def setUp(self):
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        engine = create_engine(f'sqlite:///{path}')
+        Message.__table__.create(engine)
+        self.session, self.reader = Session(bind=engine), Session(bind=engine)
+        self.addCleanup(self.session.close)
+        self.addCleanup(self.reader.close)
+        patcher = mock.patch.object(database, 'session', self.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.created_on = datetime.datetime(2022, 5, 1, 10, 30)
+
+    def insert(self, message):
+        return Model._insert(Message, {'account_id': 7, 'message': message,
+                                       'created_on': self.created_on})
+
+    def test_record_has_id_and_given_values(self):
+        self.assertEqual(self.insert('first')['id'], 1)
+        self.assertEqual(self.insert('second'), {
+            'id': 2, 'account_id': 7, 'message': 'second',
+            'created_on': '2022-05-01T10:30:00'})
+
+    def test_row_visible_after_commit(self):
+        record = self.insert('hi')
+        self.assertEqual(self.reader.query(Message).count(), 0)
+        self.session.commit()
+
+        row = self.reader.query(Message).get(record['id'])
+        self.assertEqual((row.account_id, row.message, row.created_on),
+                         (7, 'hi', self.created_on))
+
+
+if __name__ == '__main__':
+    unittest.main()
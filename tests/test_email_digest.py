@@ -0,0 +1,92 @@
+import unittest
+from unittest import mock
+
+from src.functionality import email_digest, micro_batch, sync
+from src.functionality.email_digest import is_digest_account, \
+    buffer_message, take_messages
+from src.utils.constants import FLUSH_EMAIL_DIGEST_TASK_NAME
+from tests.utils import FakeBatchRedis, start_patches
+
+
+def message(sms_id):
+    return {'sms_id': sms_id, 'message': f'message {sms_id}'}
+
+
+class DigestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = FakeBatchRedis()
+        start_patches(
+            self,
+            mock.patch.object(micro_batch, 'redis_cache', self.redis),
+            mock.patch.object(micro_batch, 'app'),
+            mock.patch.multiple(email_digest.config, EMAIL_DIGEST_WINDOW=60,
+                                EMAIL_DIGEST_TEMPLATE_TYPE=99,
+                                EMAIL_DIGEST_ACCOUNTS={'7'}))
+        self.app = micro_batch.app
+
+
+class TestEmailDigest(DigestTestCase):
+
+    def test_only_listed_accounts_use_digest(self):
+        self.assertTrue(is_digest_account(7))
+        self.assertFalse(is_digest_account(8))
+        with mock.patch.object(email_digest.config,
+                               'EMAIL_DIGEST_ACCOUNTS', set()):
+            self.assertFalse(is_digest_account(7))
+        with mock.patch.object(email_digest.config,
+                               'EMAIL_DIGEST_TEMPLATE_TYPE', 0):
+            self.assertFalse(is_digest_account(7))
+
+    def test_first_message_schedules_flush(self):
+        for sms_id in (1, 2, 3):
+            self.assertTrue(buffer_message(7, message(sms_id)))
+        self.app.send_task.assert_called_once_with(
+            FLUSH_EMAIL_DIGEST_TASK_NAME, args=[7], countdown=60,
+            queue=micro_batch.TASK_MODULE)
+        self.assertEqual([item['sms_id'] for item in take_messages(7)],
+                         [1, 2, 3])
+        self.assertEqual(take_messages(7), [])
+
+    def test_message_not_buffered_when_redis_down(self):
+        self.redis.down = True
+        self.assertFalse(buffer_message(7, message(1)))
+
+
+class TestFlushEmailDigest(DigestTestCase):
+
+    def setUp(self):
+        super().setUp()
+        start_patches(
+            self,
+            mock.patch.object(sync, 'SendSyncTask'),
+            mock.patch.object(sync, 'save_push_email',
+                              return_value={'system_email_log_id': 5}),
+            mock.patch.object(sync, 'db_model'),
+            mock.patch.object(sync.config, 'OUTBOX_ENABLED', 0))
+        self.send_sync_task = sync.SendSyncTask.return_value
+        self.save_push_email = sync.save_push_email
+        for sms_id in (1, 2):
+            buffer_message(7, message(sms_id))
+
+    def test_flush_sends_all_messages_as_one_email(self):
+        self.assertEqual(sync.flush_email_digest(7), 2)
+        content = self.save_push_email.call_args[0][1]
+        self.assertEqual(content, {'count': 2,
+                                   'messages': [message(1), message(2)]})
+        self.assertEqual(self.save_push_email.call_args[1]['template_type'],
+                         99)
+        self.send_sync_task.send_with_payload.assert_called_once_with(
+            7, sync.CHANNEL_EMAIL, {'system_email_log_id': 5})
+        self.assertEqual(sync.flush_email_digest(7), 0)
+
+    def test_failed_flush_buffers_messages_again(self):
+        self.send_sync_task.send_with_payload.side_effect = RuntimeError()
+        with self.assertRaises(RuntimeError):
+            sync.flush_email_digest(7)
+        sync.db_model.rollback_session.assert_called_once()
+        self.assertEqual(take_messages(7), [message(1), message(2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
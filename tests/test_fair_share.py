@@ -0,0 +1,100 @@
+import json
+import unittest
+from unittest import mock
+
+from src.functionality import fair_share
+from src.functionality.fair_share import TAKE_TOKEN_SCRIPT, BUCKET_KEY, \
+    admit
+from src.utils.constants import OVERFLOW_QUEUE
+from tests.utils import start_patches
+
+TASK_NAME = 'incoming_sms_processor.process'
+
+
+class FakeRedis(object):
+    """The token bucket script on a dict, by a clock set by the test"""
+
+    def __init__(self):
+        self.buckets = {}
+        self.now = 1000.0
+        self.down = False
+
+    def eval(self, script, numkeys, key, rate, burst):
+        if self.down:
+            return None
+        assert script == TAKE_TOKEN_SCRIPT
+        tokens, ts = self.buckets.get(key, (burst, self.now))
+        tokens = min(burst, tokens + max(0, self.now - ts) * rate)
+        taken = 0
+        if tokens >= 1:
+            tokens -= 1
+            taken = 1
+        self.buckets[key] = (tokens, self.now)
+        return taken
+
+
+def payload(**kwargs):
+    return dict({'shortCode': '+14242387011', 'message': 'hi'}, **kwargs)
+
+
+class TestAdmit(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.app, = start_patches(
+            self,
+            mock.patch.object(fair_share, 'app'),
+            mock.patch.object(fair_share, 'redis_cache', self.redis),
+            mock.patch.multiple(fair_share.config, FAIR_SHARE_RATE=2,
+                                FAIR_SHARE_BURST=3))[:1]
+
+    def admitted(self, count, **kwargs):
+        return [admit(payload(**kwargs), TASK_NAME) for _ in range(count)]
+
+    def test_burst_admitted_then_deferred(self):
+        self.assertEqual(self.admitted(4), [True, True, True, False])
+        self.app.send_task.assert_called_once()
+        args, kwargs = self.app.send_task.call_args
+        self.assertEqual(args[0], TASK_NAME)
+        self.assertEqual(kwargs['queue'], OVERFLOW_QUEUE)
+        deferred = json.loads(kwargs['args'][0])
+        self.assertTrue(deferred['deferred'])
+        self.assertEqual(deferred['message'], 'hi')
+        self.assertIn('queuedAt', deferred)
+
+    def test_bucket_refilled_at_rate(self):
+        self.admitted(3)
+        self.redis.now += 0.5
+        self.assertEqual(self.admitted(2), [True, False])
+        # Never above the burst, however long the shortcode was idle
+        self.redis.now += 3600
+        self.assertEqual(self.admitted(4), [True, True, True, False])
+
+    def test_bucket_per_shortcode(self):
+        self.admitted(3)
+        self.assertEqual(self.admitted(1, shortCode='14155550100'), [True])
+        # The leading + is not part of the bucket
+        self.assertEqual(set(self.redis.buckets),
+                         {BUCKET_KEY.format('14242387011'),
+                          BUCKET_KEY.format('14155550100')})
+
+    def test_deferred_and_partitioned_tasks_not_admitted_again(self):
+        self.admitted(3)
+        self.assertEqual(self.admitted(2, deferred=True), [True, True])
+        self.assertEqual(self.admitted(2, partition=0), [True, True])
+        self.app.send_task.assert_not_called()
+        self.assertEqual(self.redis.buckets[
+            BUCKET_KEY.format('14242387011')][0], 0)
+
+    def test_admitted_when_redis_down(self):
+        self.redis.down = True
+        self.assertEqual(self.admitted(5), [True] * 5)
+
+    def test_disabled_without_rate(self):
+        with mock.patch.object(fair_share.config, 'FAIR_SHARE_RATE', 0):
+            self.assertEqual(self.admitted(5), [True] * 5)
+        self.assertEqual(self.redis.buckets, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import datetime
+import unittest
+
+from sqlalchemy import Column, Date, DateTime, Integer, String
+from sqlalchemy.ext.declarative import declarative_base
+
+from src.utils.helper import to_dict, get_orm_column_mapping, \
+    get_row_serializer, compile_projection, map_keys, message_view
+
+Base = declarative_base()
+
+
+class Row(Base):
+    __tablename__ = 'row'
+    id = Column(Integer, primary_key=True)
+    short_code = Column('shortCode', String(20))
+    created_on = Column('createdOn', DateTime)
+    valid_till = Column(Date)
+
+
+class TestRowSerializer(unittest.TestCase):
+
+    def setUp(self):
+        self.row = Row(id=1, short_code='14242387011',
+                       created_on=datetime.datetime(2022, 10, 19, 10, 0),
+                       valid_till=None)
+
+    def test_to_dict_converts_dates(self):
+        self.assertEqual(to_dict(self.row), {
+            'id': 1, 'short_code': '14242387011',
+            'created_on': '2022-10-19T10:00:00', 'valid_till': None})
+
+    def test_to_dict_projection(self):
+        self.assertEqual(to_dict(self.row, columns=('id', 'created_on', 'x')),
+                         {'id': 1, 'created_on': '2022-10-19T10:00:00'})
+
+    def test_to_dict_list_and_single(self):
+        other = Row(id=2, short_code='1')
+        self.assertEqual(len(to_dict([self.row, other])), 2)
+        self.assertEqual(to_dict([self.row, other], single=True)['id'], 2)
+        self.assertEqual(to_dict(None), {})
+
+    def test_serializer_is_compiled_once(self):
+        self.assertIs(get_row_serializer(Row), get_row_serializer(Row))
+        self.assertIs(get_orm_column_mapping(Row), get_orm_column_mapping(Row))
+
+    def test_orm_column_mapping(self):
+        self.assertEqual(get_orm_column_mapping(Row), {
+            'id': 'id', 'shortCode': 'short_code', 'createdOn': 'created_on',
+            'valid_till': 'valid_till'})
+
+
+class TestProjection(unittest.TestCase):
+
+    def setUp(self):
+        self.message = {'message': b'Hello', 'mobilenumber': '919999999999',
+                        'accountId': 1, 'sms_id': 10, 'extra': 'x'}
+        self.key_map = {'message': 'sms_text', 'accountId': 'account_id',
+                        'sms_id': 'incoming_id', 'mms_urls': 'mms_url'}
+
+    def test_projection_matches_map_keys(self):
+        project = compile_projection(self.key_map)
+        self.assertEqual(project(self.message),
+                         map_keys(self.message, self.key_map))
+
+    def test_message_view_overrides_without_copy(self):
+        view = message_view(self.message, accountId=2)
+        self.assertEqual(compile_projection(self.key_map)(view)['account_id'],
+                         2)
+        self.assertEqual(self.message['accountId'], 1)
+        with self.assertRaises(TypeError):
+            view['accountId'] = 3
+
+
+if __name__ == '__main__':
+    unittest.main()
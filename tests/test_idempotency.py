@@ -0,0 +1,136 @@
+import unittest
+from unittest import mock
+
+from src.utils import idempotency
+from src.utils.idempotency import MessageIdempotency, MessageInProgressError, \
+    MESSAGE_STATE_PROCESSING, MESSAGE_STATE_SAVED, MESSAGE_STATE_COMPLETED, \
+    ACQUIRE_SCRIPT, EXTEND_SCRIPT, UNLOCK_SCRIPT
+
+PARAMS = {'providerId': 1, 'messageId': 111, 'shortCode': '14242387011'}
+
+
+class FakeRedis(object):
+    """The idempotency scripts on a dict of (value, expires at)"""
+
+    def __init__(self):
+        self.values = {}
+        self.now = 0
+        self.evals = 0
+
+    def get(self, key):
+        value, expires_at = self.values.get(key, (None, None))
+        if expires_at is not None and expires_at <= self.now:
+            self.values.pop(key)
+            return None
+        return value
+
+    def set(self, key, value, ex=None):
+        self.values[key] = (value, None if ex is None else self.now + ex)
+        return True
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+    def eval(self, script, numkeys, *args):
+        self.evals += 1
+        keys, argv = args[:numkeys], args[numkeys:]
+        if script == ACQUIRE_SCRIPT:
+            state, lock = keys
+            token, processing, saved, expiry = argv
+            if self.get(lock) is not None:
+                return [0, processing]
+            current = self.get(state)
+            if current is not None and current != saved:
+                return [0, current]
+            self.set(lock, token, ex=int(expiry))
+            return [1, current or '']
+        held = self.get(keys[0]) == argv[0]
+        if script == EXTEND_SCRIPT:
+            if held:
+                self.set(keys[0], argv[0], ex=int(argv[1]))
+            return int(held)
+        assert script == UNLOCK_SCRIPT
+        if held:
+            self.delete(keys[0])
+        return int(held)
+
+
+class TestMessageIdempotency(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch.object(idempotency, 'redis_cache', self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.guard = MessageIdempotency(PARAMS)
+        self.assertTrue(self.guard.acquire())
+        self.expiry = idempotency.config.IDEMPOTENCY_LOCK_EXPIRY
+
+    def test_duplicate_rejected_while_lock_held(self):
+        with self.assertRaises(MessageInProgressError):
+            MessageIdempotency(PARAMS).acquire()
+        self.assertEqual(self.guard.state, MESSAGE_STATE_PROCESSING)
+
+    def test_saved_message_taken_over_once_lock_expired(self):
+        self.guard.mark(MESSAGE_STATE_SAVED)
+        # Redelivered while channels are being dispatched
+        with self.assertRaises(MessageInProgressError):
+            MessageIdempotency(PARAMS).acquire()
+
+        self.redis.now += self.expiry
+        retry = MessageIdempotency(PARAMS)
+        self.assertTrue(retry.acquire())
+        self.assertTrue(retry.resumed)
+
+    def test_saved_message_taken_over_once_unlocked(self):
+        self.guard.mark(MESSAGE_STATE_SAVED)
+        self.guard.unlock()
+        retry = MessageIdempotency(PARAMS)
+        self.assertTrue(retry.acquire())
+        self.assertTrue(retry.resumed)
+
+    def test_completed_message_skipped(self):
+        self.guard.mark(MESSAGE_STATE_COMPLETED)
+        self.guard.unlock()
+        duplicate = MessageIdempotency(PARAMS)
+        self.assertFalse(duplicate.acquire())
+        self.assertEqual(duplicate.state, MESSAGE_STATE_COMPLETED)
+
+    def test_released_message_processed_again(self):
+        self.guard.release()
+        self.guard.unlock()
+        redelivery = MessageIdempotency(PARAMS)
+        self.assertTrue(redelivery.acquire())
+        self.assertFalse(redelivery.resumed)
+
+    def test_expired_lock_taken_by_other_not_unlocked(self):
+        self.redis.now += self.expiry
+        other = MessageIdempotency(PARAMS)
+        self.assertTrue(other.acquire())
+        self.guard.unlock()
+        with self.assertRaises(MessageInProgressError):
+            MessageIdempotency(PARAMS).acquire()
+
+    def test_lock_extended_once_a_third_of_expiry_passed(self):
+        self.guard.extend()
+        self.assertEqual(self.redis.evals, 1)
+
+        self.redis.now += self.expiry - 1
+        self.guard.extended_at -= self.expiry
+        self.guard.extend()
+        self.assertEqual(self.redis.evals, 2)
+        # Held past the initial expiry
+        self.redis.now += 2
+        with self.assertRaises(MessageInProgressError):
+            MessageIdempotency(PARAMS).acquire()
+
+    def test_lock_not_extended_after_unlock(self):
+        self.guard.mark(MESSAGE_STATE_SAVED)
+        self.guard.unlock()
+        self.guard.extended_at -= self.expiry
+        self.guard.extend()
+        self.assertEqual(self.redis.evals, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import json
+import unittest
+
+from src.models.incoming_message import IncomingMessage
+from src.utils.helper import masked_data, message_view
+
+PAYLOAD = {
+    'mobilenumber': 9922000602,
+    'providerId': 1,
+    'messageId': 111,
+    'message': 'Beatles',
+    'shortCode': '14242387011',
+    'providerStatus': 'received'
+}
+
+
+class TestIncomingMessage(unittest.TestCase):
+
+    def test_parse_json_once(self):
+        message = IncomingMessage.parse(json.dumps(PAYLOAD))
+        self.assertIs(IncomingMessage.parse(message), message)
+        self.assertEqual(message.mobilenumber, '9922000602')
+        # Unknown provider fields are kept
+        self.assertEqual(message['providerStatus'], 'received')
+        self.assertFalse(hasattr(message, '__dict__'))
+
+    def test_invalid_payload(self):
+        with self.assertRaises(KeyError):
+            IncomingMessage.parse({'providerId': 1})
+        with self.assertRaises(ValueError):
+            IncomingMessage.parse(dict(PAYLOAD, message=['Beatles']))
+        with self.assertRaises(ValueError):
+            IncomingMessage.parse('not json')
+
+    def test_behaves_as_payload_dict(self):
+        message = IncomingMessage.parse(PAYLOAD)
+        message['keyword'] = 'BEATLES'
+        self.assertEqual(dict(message), dict(PAYLOAD, keyword='BEATLES',
+                                             mobilenumber='9922000602'))
+        self.assertNotIn('sms_id', message)
+        self.assertIsNone(message.get('sms_id'))
+        self.assertEqual(masked_data(message)['keyword'], 'BEATLES')
+
+    def test_view_is_read_only_and_live(self):
+        message = IncomingMessage.parse(PAYLOAD)
+        view = message_view(message.view())
+        message['sms_id'] = 5
+        self.assertEqual(view['sms_id'], 5)
+        with self.assertRaises(TypeError):
+            view['sms_id'] = 6
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import tempfile
+import tracemalloc
+import unittest
+from unittest import mock
+
+from src.utils import memory_profiler
+from src.utils.memory_profiler import profile_task_start, profile_task_end
+from tests.utils import start_patches
+
+
+class TestMemoryProfiler(unittest.TestCase):
+
+    def setUp(self):
+        report_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(report_dir.cleanup)
+        start_patches(
+            self,
+            mock.patch.multiple(memory_profiler.config, MEMORY_PROFILE=1,
+                                MEMORY_REPORT_EVERY=2,
+                                MEMORY_REPORT_DIR=report_dir.name),
+            mock.patch.object(memory_profiler, '_profiler', None))
+        if not tracemalloc.is_tracing():
+            self.addCleanup(tracemalloc.stop)
+        self.report_path = os.path.join(report_dir.name,
+                                        f'memory-{os.getpid()}.log')
+        self.task = mock.Mock()
+        self.task.name = 'incoming_sms_processor.handle_incoming_sms'
+
+    def run_task(self, task_id):
+        profile_task_start(task_id=task_id, task=self.task)
+        profile_task_end(task_id=task_id, task=self.task)
+
+    def reports(self):
+        with open(self.report_path) as report:
+            return report.read().split('\n\n=== ')
+
+    def test_report_every_n_tasks(self):
+        for task_id in range(4):
+            self.run_task(str(task_id))
+        reports = self.reports()
+        self.assertEqual(len(reports), 2)
+        for report in reports:
+            self.assertIn('RSS growth by task', report)
+            self.assertIn(f'  {self.task.name}: 2, ', report)
+            self.assertIn('SQLAlchemy: {', report)
+        self.assertIn('after 4 tasks', reports[1])
+
+    def test_postrun_without_prerun_ignored(self):
+        self.run_task('1')
+        profile_task_end(task_id='unknown', task=self.task)
+        self.assertEqual(memory_profiler.get_profiler().tasks, 1)
+        self.assertFalse(os.path.exists(self.report_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from src.utils import metrics
+from src.utils.metrics import Counter, Histogram, MmapValues, collect, \
+    render, archive_exited
+
+TASKS = Counter('test_tasks_total', 'Tasks', ('task',))
+LATENCY = Histogram('test_latency_ms', 'Latency', buckets=(10, float('inf')))
+
+
+def in_child(*observations):
+    """Records in a forked process, which exits like a recycled child"""
+    pid = os.fork()
+    if not pid:
+        for latency in observations:
+            TASKS.inc(task='sms')
+            LATENCY.observe(latency)
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        patcher = mock.patch.multiple(metrics, _directory=self.directory,
+                                      _values=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_children_aggregate_and_survive_recycling(self):
+        in_child(5, 50)
+        in_child(5)
+        TASKS.inc(task='sms')
+        archive_exited(self.directory)
+        # The files of the exited children are folded, the live one is kept
+        self.assertCountEqual(os.listdir(self.directory),
+                              ['archive.db', f'{os.getpid()}.db'])
+        in_child(500)
+        archive_exited(self.directory)
+
+        text = render(collect(self.directory))
+        self.assertIn('# TYPE test_tasks_total counter', text)
+        self.assertIn('test_tasks_total{task="sms"} 5', text)
+        self.assertIn('test_latency_ms_bucket{le="10"} 2', text)
+        self.assertIn('test_latency_ms_bucket{le="+Inf"} 4', text)
+        self.assertIn('test_latency_ms_sum 560', text)
+        self.assertIn('test_latency_ms_count 4', text)
+
+    def test_unobserved_buckets_rendered(self):
+        LATENCY.observe(50)
+        text = render(collect(self.directory))
+        self.assertIn('test_latency_ms_bucket{le="10"} 0', text)
+        self.assertIn('test_latency_ms_bucket{le="+Inf"} 1', text)
+
+    def test_file_grows(self):
+        values = MmapValues(os.path.join(self.directory, 'grow.db'))
+        for number in range(5000):
+            values.add(f'key {number}', number)
+        values.add('key 1', 1)
+        self.assertEqual(len(values.values()), 5000)
+        self.assertEqual(collect(self.directory)['key 1'], 2)
+        values.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import unittest
+from unittest import mock
+
+from src.functionality import micro_batch, sync
+from src.functionality.micro_batch import add_payload, flush_batches, \
+    batch_keys
+from src.utils.circuit_breaker import CircuitOpenError
+from src.utils.constants import FLUSH_CRM_BATCH_TASK_NAME, CHANNEL_BULLHORN
+from tests.utils import start_patches
+from tests.utils import FakeBatchRedis
+
+
+def payload(sms_id):
+    return {'type': 'sms', 'messages': [{'id': sms_id, 'text': 'hi'}]}
+
+
+class TestCrmBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = FakeBatchRedis()
+        start_patches(
+            self,
+            mock.patch.object(micro_batch, 'redis_cache', self.redis),
+            mock.patch.object(micro_batch, 'app'),
+            mock.patch.multiple(micro_batch.config, CRM_BATCH_WINDOW_MS=500,
+                                CRM_BATCH_SIZE=3, CRM_BATCH_MAX_ATTEMPTS=3,
+                                CIRCUIT_RESET_TIMEOUT=30,
+                                CRM_BATCH_CHANNELS={CHANNEL_BULLHORN}))
+        self.send_sync_task = mock.Mock()
+        self.keys = batch_keys('CRM_BATCH', 7, CHANNEL_BULLHORN, 'sms')
+
+    def add(self, *sms_ids):
+        for sms_id in sms_ids:
+            self.assertTrue(add_payload(self.send_sync_task, 7,
+                                        CHANNEL_BULLHORN, payload(sms_id)))
+
+    def sent(self):
+        return [(call[0][2]['messages'], call[1]['sms_ids']) for call in
+                self.send_sync_task.send_with_payload.call_args_list]
+
+    def test_full_batch_sent_at_once(self):
+        self.add(1, 2, 3)
+        micro_batch.app.send_task.assert_called_once_with(
+            FLUSH_CRM_BATCH_TASK_NAME, args=[7, CHANNEL_BULLHORN, 'sms'],
+            countdown=0.5, queue=micro_batch.TASK_MODULE)
+        self.assertEqual(self.sent(), [(
+            [{'id': 1, 'text': 'hi'}, {'id': 2, 'text': 'hi'},
+             {'id': 3, 'text': 'hi'}], [1, 2, 3])])
+        self.assertEqual(self.redis.lists[self.keys[0]], [])
+
+    def test_window_flush_sends_rest(self):
+        self.add(1, 2)
+        self.send_sync_task.send_with_payload.assert_not_called()
+        self.assertEqual(flush_batches(self.send_sync_task, 7,
+                                       CHANNEL_BULLHORN, 'sms'), 2)
+        self.assertEqual([sms_ids for _, sms_ids in self.sent()], [[1, 2]])
+        self.assertEqual(flush_batches(self.send_sync_task, 7,
+                                       CHANNEL_BULLHORN, 'sms'), 0)
+
+    def countdowns(self):
+        return [call[1]['countdown'] for call in
+                micro_batch.app.send_task.call_args_list]
+
+    def test_failed_batch_buffered_again_in_order(self):
+        self.send_sync_task.send_with_payload.side_effect = RuntimeError()
+        self.add(1, 2, 3, 4)
+        self.assertEqual(len(self.redis.lists[self.keys[0]]), 4)
+        # The window of the buffered payloads is flushed again
+        self.assertEqual(self.countdowns(), [0.5, 0.5, 0.5])
+
+        self.send_sync_task.send_with_payload.side_effect = None
+        self.assertEqual(flush_batches(self.send_sync_task, 7,
+                                       CHANNEL_BULLHORN, 'sms'), 4)
+        self.assertEqual([sms_ids for _, sms_ids in self.sent()][-2:],
+                         [[1, 2, 3], [4]])
+        # The attempt count is not sent
+        self.assertEqual(self.sent()[-2][0][0], {'id': 1, 'text': 'hi'})
+        self.assertNotIn(micro_batch.ATTEMPTS_FIELD,
+                         self.send_sync_task.send_with_payload
+                         .call_args_list[-2][0][2])
+
+    def test_payloads_dropped_after_max_attempts(self):
+        self.send_sync_task.send_with_payload.side_effect = RuntimeError()
+        self.add(1, 2, 3)
+        for _ in range(2):
+            with self.assertRaises(RuntimeError):
+                flush_batches(self.send_sync_task, 7, CHANNEL_BULLHORN, 'sms')
+        self.assertEqual(self.redis.lists[self.keys[0]], [])
+        self.assertEqual(self.countdowns(), [0.5, 0.5, 0.5])
+
+    def test_open_circuit_retried_after_reset_timeout(self):
+        self.send_sync_task.send_with_payload.side_effect = \
+            CircuitOpenError('open')
+        self.add(1, 2, 3)
+        for _ in range(3):
+            with self.assertRaises(CircuitOpenError):
+                flush_batches(self.send_sync_task, 7, CHANNEL_BULLHORN, 'sms')
+        # No attempt is used while the circuit is open
+        self.assertEqual(len(self.redis.lists[self.keys[0]]), 3)
+        self.assertEqual(self.countdowns(), [0.5] + [30] * 4)
+
+    def test_payload_sent_alone_when_redis_down(self):
+        self.redis.down = True
+        self.assertFalse(add_payload(self.send_sync_task, 7,
+                                     CHANNEL_BULLHORN, payload(1)))
+
+
+class TestFlushCrmBatch(unittest.TestCase):
+
+    def setUp(self):
+        send_sync_task_class, self.flush_batches, self.db_model = \
+            start_patches(self,
+                          mock.patch.object(sync, 'SendSyncTask'),
+                          mock.patch.object(sync, 'flush_batches',
+                                            return_value=3),
+                          mock.patch.object(sync, 'db_model'))
+        self.send_sync_task = send_sync_task_class.return_value
+        self.send_sync_task.register_tasks.side_effect = \
+            lambda: self.db_model.commit_session.assert_not_called()
+
+    def test_task_ids_committed(self):
+        self.assertEqual(sync.flush_crm_batch(7, CHANNEL_BULLHORN, 'sms'), 3)
+        self.send_sync_task.register_tasks.assert_called_once()
+        self.db_model.commit_session.assert_called_once()
+        self.db_model.rollback_session.assert_not_called()
+
+    def test_sent_batches_committed_when_one_fails(self):
+        self.flush_batches.side_effect = RuntimeError()
+        with self.assertRaises(RuntimeError):
+            sync.flush_crm_batch(7, CHANNEL_BULLHORN, 'sms')
+        self.db_model.commit_session.assert_called_once()
+        self.db_model.rollback_session.assert_called_once()
+
+    def test_rolled_back_when_registering_fails(self):
+        self.send_sync_task.register_tasks.side_effect = RuntimeError()
+        with self.assertRaises(RuntimeError):
+            sync.flush_crm_batch(7, CHANNEL_BULLHORN, 'sms')
+        self.db_model.commit_session.assert_not_called()
+        self.db_model.rollback_session.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
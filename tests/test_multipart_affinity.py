@@ -0,0 +1,126 @@
+import unittest
+from unittest import mock
+
+from src.functionality import multipart_affinity, multipart_deadline
+from src.functionality.multipart_affinity import PartBuffer, add_part, \
+    pop_buffered_message
+from tests.utils import start_patches
+
+
+def part(part_number, total_parts=3, reference_id=1):
+    return {'accountId': 7, 'shortCode': '14242387011',
+            'mobilenumber': '99220', 'referenceId': reference_id,
+            'partOrderNumber': part_number, 'totalParts': total_parts,
+            'message': f'part{part_number} '}
+
+
+class TestPartBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.time, = start_patches(
+            self,
+            mock.patch.object(multipart_affinity, 'time', return_value=1000))
+        self.buffer = PartBuffer(2, 100)
+
+    def add_at(self, now, key, part_number=1):
+        self.time.return_value = now
+        return self.buffer.add(key, part_number, 'text')
+
+    def test_trusted_once_ttl_seen_since_start(self):
+        self.assertFalse(self.add_at(1099, 'a')['trusted'])
+        self.assertTrue(self.add_at(1100, 'b')['trusted'])
+        # Parts of a message share its group
+        self.assertFalse(self.add_at(1150, 'a', 2)['trusted'])
+        self.assertEqual(len(self.buffer.groups['a']['parts']), 2)
+
+    def test_eviction_distrusts_new_messages_for_ttl(self):
+        self.add_at(1100, 'a')
+        self.add_at(1100, 'b')
+        self.assertTrue(self.add_at(1110, 'c')['trusted'])
+        self.assertNotIn('a', self.buffer.groups)
+        self.assertFalse(self.add_at(1200, 'd')['trusted'])
+        self.assertTrue(self.add_at(1210, 'e')['trusted'])
+
+    def test_groups_expire_after_ttl(self):
+        self.add_at(1100, 'a')
+        self.add_at(1200, 'b')
+        self.assertEqual(list(self.buffer.groups), ['b'])
+
+    def test_longer_ttl_distrusts_until_buffer_holds_it(self):
+        self.time.return_value = 5000
+        self.buffer.set_ttl(1000)
+        # Only the last 100 seconds are known to be in the buffer
+        self.assertFalse(self.add_at(5899, 'a')['trusted'])
+        self.assertTrue(self.add_at(5900, 'b')['trusted'])
+
+
+class TestAddPart(unittest.TestCase):
+
+    def setUp(self):
+        # Started long enough ago to trust the buffer
+        buffer = PartBuffer(10, 3600)
+        buffer.complete_since = -10000
+        self.redis = mock.Mock()
+        self.redis.get.return_value = None
+        self.time, self.db_model = start_patches(
+            self,
+            mock.patch.object(multipart_affinity, 'time', return_value=1000),
+            mock.patch.object(multipart_affinity, 'db_model'),
+            mock.patch.object(multipart_affinity, 'part_buffer', buffer),
+            mock.patch.object(multipart_deadline, 'redis_cache', self.redis),
+            mock.patch.object(multipart_deadline, '_sweeper_seen',
+                              {'running': False, 'checked_at': None}),
+            mock.patch.multiple(multipart_affinity.config,
+                                MULTIPART_DEADLINE=900,
+                                MULTIPART_SWEEP_INTERVAL=60,
+                                PARTS_WINDOW=3600))[:2]
+        self.db_model.get_part_key.side_effect = \
+            lambda *key: ':'.join(str(item) for item in key)
+        self.db_model.get_part_number.side_effect = \
+            lambda params: params['partOrderNumber']
+        self.db_model.get_parts_count_from_db.return_value = 2
+
+    def add_at(self, now, params):
+        self.time.return_value = now
+        return add_part(params)
+
+    def test_message_counted_and_assembled_from_buffer(self):
+        self.assertEqual(self.add_at(1000, part(2)), 1)
+        self.assertEqual(self.add_at(1001, part(3)), 2)
+        self.assertEqual(self.add_at(1002, part(1)), 3)
+        self.db_model.get_parts_count_from_db.assert_not_called()
+        self.assertEqual(pop_buffered_message(part(1)),
+                         b'part1 part2 part3 ')
+        self.assertIsNone(pop_buffered_message(part(1)))
+
+    def test_untrusted_message_counted_from_db(self):
+        multipart_affinity.part_buffer.complete_since = 1000
+        self.assertEqual(self.add_at(1000, part(1)), 2)
+        self.assertEqual(self.add_at(1001, part(2)), 2)
+        self.db_model.get_parts_count_from_db.assert_called_with(
+            1, '14242387011', 7, '99220')
+        # Read back from database
+        self.assertIsNone(pop_buffered_message(part(1)))
+
+    def test_incomplete_buffer_assembled_from_db(self):
+        self.add_at(1000, part(1))
+        self.add_at(1001, part(2))
+        self.assertIsNone(pop_buffered_message(part(2)))
+
+    def test_late_part_counted_without_sweeper(self):
+        # Sweeping is configured, but the sweeper does not run
+        self.add_at(1000, part(1, total_parts=2))
+        self.assertEqual(self.add_at(2000, part(2, total_parts=2)), 2)
+        self.assertEqual(pop_buffered_message(part(2, total_parts=2)),
+                         b'part1 part2 ')
+
+    def test_buffer_kept_until_deadline_sweep_while_sweeper_runs(self):
+        self.redis.get.return_value = '1'
+        self.add_at(1000, part(1, total_parts=2))
+        self.assertEqual(multipart_affinity.part_buffer.ttl, 960)
+        # Delivered by the sweeper; the late part is a message of its own
+        self.assertEqual(self.add_at(1960, part(2, total_parts=2)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
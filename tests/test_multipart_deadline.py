@@ -0,0 +1,171 @@
+import json
+import unittest
+from unittest import mock
+
+from src.functionality import multipart_deadline
+from src.functionality.multipart_deadline import CLAIM_SCRIPT, POP_SCRIPT, \
+    DEADLINES_KEY, schedule_deadline, cancel_deadline, sweep_expired_groups
+from tests.utils import start_patches
+
+
+class FakeRedis(object):
+    """Strings, the deadlines sorted set and the deadline scripts"""
+
+    def __init__(self):
+        self.values = {}
+        self.deadlines = {}
+        self.down = False
+        self.pops = 0
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+        return True
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+    def zadd(self, key, **mapping):
+        self.deadlines.update(mapping)
+
+    def zrem(self, key, member):
+        self.deadlines.pop(member, None)
+
+    def eval(self, script, numkeys, key, *args):
+        if self.down:
+            return None
+        if script == CLAIM_SCRIPT:
+            owner = self.values.setdefault(key, args[0])
+            return int(owner == args[0])
+        assert script == POP_SCRIPT and key == DEADLINES_KEY
+        self.pops += 1
+        now, limit = args
+        groups = sorted((score, group) for group, score in
+                        self.deadlines.items() if score <= now)[:limit]
+        for _, group in groups:
+            del self.deadlines[group]
+        return [group for _, group in groups]
+
+
+def part(reference_id, entry_id=None):
+    return {'providerId': 1, 'messageId': f'm{reference_id}',
+            'mobilenumber': '99220', 'shortCode': '14242387011',
+            'referenceId': reference_id, 'totalParts': 2, 'accountId': 7,
+            'message': 'part', 'entry_id': entry_id}
+
+
+class TestMultipartDeadline(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.time, self.deliver, _, _ = start_patches(
+            self,
+            mock.patch.object(multipart_deadline, 'time', return_value=1000),
+            mock.patch.object(multipart_deadline, '_deliver_partial_message'),
+            mock.patch.object(multipart_deadline, 'redis_cache', self.redis),
+            mock.patch.multiple(multipart_deadline.config,
+                                MULTIPART_SWEEP_INTERVAL=60,
+                                MULTIPART_DEADLINE=900,
+                                MULTIPART_DEADLINE_ACTION='deliver',
+                                MULTIPART_SWEEP_BATCH=2))
+
+    def sweep_at(self, now):
+        self.time.return_value = now
+        return sweep_expired_groups()
+
+    def test_disabled_without_sweep_interval(self):
+        with mock.patch.object(multipart_deadline.config,
+                               'MULTIPART_SWEEP_INTERVAL', 0):
+            schedule_deadline(part(1))
+            self.assertTrue(cancel_deadline(part(1)))
+        self.assertEqual(self.redis.deadlines, {})
+        self.assertEqual(self.redis.values, {})
+
+    def test_incomplete_message_delivered_at_deadline(self):
+        schedule_deadline(part(1))
+        self.assertEqual(self.sweep_at(1899), 0)
+        self.assertEqual(self.sweep_at(1900), 1)
+        delivered = self.deliver.call_args[0][0]
+        self.assertEqual((delivered['referenceId'], delivered['accountId']),
+                         (1, 7))
+        self.assertNotIn('message', delivered)
+
+    def test_last_part_not_delivered_after_sweeper(self):
+        schedule_deadline(part(1))
+        self.sweep_at(1900)
+        self.assertFalse(cancel_deadline(part(1, entry_id='e2')))
+        self.deliver.assert_called_once()
+
+    def test_sweeper_skips_group_claimed_by_last_part(self):
+        schedule_deadline(part(1))
+        # The last part claims the group as it is popped by the sweeper
+        group_key = next(iter(self.redis.deadlines))
+        self.redis.eval(CLAIM_SCRIPT, 1, f'{group_key}:CLAIMED', 'e2', 60)
+        self.assertEqual(self.sweep_at(1900), 1)
+        self.deliver.assert_not_called()
+        # Its retry still owns the group
+        self.assertTrue(cancel_deadline(part(1, entry_id='e2')))
+
+    def test_completed_message_removed_from_deadlines(self):
+        schedule_deadline(part(1))
+        self.assertTrue(cancel_deadline(part(1, entry_id='e2')))
+        self.assertEqual(self.redis.deadlines, {})
+        self.assertEqual(self.sweep_at(1900), 0)
+        self.deliver.assert_not_called()
+
+    def test_last_part_delivered_when_redis_down(self):
+        schedule_deadline(part(1))
+        self.redis.down = True
+        self.assertTrue(cancel_deadline(part(1, entry_id='e2')))
+
+    def test_sweep_pops_expired_groups_in_batches(self):
+        for reference_id in range(5):
+            schedule_deadline(part(reference_id))
+        self.time.return_value = 2000
+        schedule_deadline(part(5))
+
+        self.assertEqual(self.sweep_at(1900), 5)
+        # Two full batches, then a short one ends the sweep
+        self.assertEqual(self.redis.pops, 3)
+        self.assertEqual(self.deliver.call_count, 5)
+        self.assertEqual(len(self.redis.deadlines), 1)
+
+    def test_failed_group_does_not_stop_sweep(self):
+        for reference_id in range(3):
+            schedule_deadline(part(reference_id))
+        self.deliver.side_effect = [RuntimeError(), None, None]
+        self.assertEqual(self.sweep_at(1900), 3)
+        self.assertEqual(self.deliver.call_count, 3)
+
+    def test_expire_action_expires_parts(self):
+        schedule_deadline(part(1))
+        with mock.patch.object(multipart_deadline, 'db_model') as db_model, \
+                mock.patch.object(multipart_deadline.config,
+                                  'MULTIPART_DEADLINE_ACTION', 'expire'):
+            db_model.get_part_key.side_effect = lambda *key: ':'.join(
+                str(part) for part in key)
+            self.assertEqual(self.sweep_at(1900), 1)
+        self.deliver.assert_not_called()
+        db_model.expire_parts_of_sms.assert_called_once_with(
+            1, '14242387011', 7, '99220')
+
+    @mock.patch.object(multipart_deadline, 'SWEEPER_CHECK_INTERVAL', 0)
+    @mock.patch.object(multipart_deadline, '_sweeper_seen',
+                       {'running': False, 'checked_at': None})
+    def test_sweep_marks_sweeper_running(self):
+        self.assertFalse(multipart_deadline.is_sweeper_running())
+        self.sweep_at(1900)
+        self.assertTrue(multipart_deadline.is_sweeper_running())
+
+    def test_group_params_kept_for_delivery(self):
+        schedule_deadline(part(1))
+        params = [json.loads(value) for key, value in self.redis.values.items()
+                  if key.endswith(':DEADLINE')]
+        self.assertEqual(params[0]['messageId'], 'm1')
+        self.assertNotIn('entry_id', params[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
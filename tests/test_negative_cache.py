@@ -0,0 +1,111 @@
+import unittest
+from unittest import mock
+
+from src.models import database, incoming_sms
+from src.models.incoming_sms import NegativelyCachedError, \
+    get_incoming_config, reject_celery_task
+from src.utils.constants import INCOMING_CONFIG_NOT_FOUND, \
+    CELERY_TASK_STATUS_FAILED
+from src.utils.query_budget import query_budget
+from tests.utils import start_patches, sqlite_session, CeleryTask
+
+
+class FakeRedis(object):
+    """Redis strings with expiry on a clock"""
+
+    def __init__(self):
+        self.values = {}
+        self.now = 0
+
+    def get(self, key):
+        value, expires_at = self.values.get(key, (None, None))
+        if expires_at is not None and expires_at <= self.now:
+            del self.values[key]
+            return None
+        return value
+
+    def set(self, key, value, ex=None):
+        self.values[key] = (value, None if ex is None else self.now + ex)
+        return True
+
+    def incr(self, key):
+        value = int(self.get(key) or 0) + 1
+        self.values[key] = (value, self.values.get(key, (0, None))[1])
+        return value
+
+    def expire(self, key, seconds):
+        self.values[key] = (self.values[key][0], self.now + seconds)
+
+
+class TestNegativeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        _, self.db_model, _ = start_patches(
+            self,
+            mock.patch.object(incoming_sms, 'redis_cache', self.redis),
+            mock.patch.object(incoming_sms, 'db_model'),
+            mock.patch.object(incoming_sms.config, 'NEGATIVE_CACHE_EXPIRY',
+                              60))
+        self.lookup = self.db_model.get_incoming_config_by_shortcode
+        self.lookup.return_value = None
+
+    def test_cached_miss_skips_database(self):
+        with self.assertRaisesRegex(ValueError, INCOMING_CONFIG_NOT_FOUND):
+            get_incoming_config('14242387011', keyword='sms')
+        with self.assertRaises(NegativelyCachedError):
+            get_incoming_config('14242387011', keyword='sms')
+        self.lookup.assert_called_once()
+
+    def test_miss_cached_per_keyword(self):
+        with self.assertRaises(ValueError):
+            get_incoming_config('14242387011', keyword='sms')
+        with self.assertRaises(ValueError) as raised:
+            get_incoming_config('14242387011', keyword='mms')
+        self.assertNotIsInstance(raised.exception, NegativelyCachedError)
+        self.assertEqual(self.lookup.call_count, 2)
+
+    def test_cached_miss_expires(self):
+        with self.assertRaises(ValueError):
+            get_incoming_config('14242387011', keyword='sms')
+        self.redis.now += 60
+        with self.assertRaises(ValueError) as raised:
+            get_incoming_config('14242387011', keyword='sms')
+        self.assertNotIsInstance(raised.exception, NegativelyCachedError)
+        self.assertEqual(self.lookup.call_count, 2)
+
+    def test_not_cached_when_disabled(self):
+        with mock.patch.object(incoming_sms.config, 'NEGATIVE_CACHE_EXPIRY',
+                               0):
+            for _ in range(2):
+                with self.assertRaises(ValueError) as raised:
+                    get_incoming_config('14242387011', keyword='sms')
+                self.assertNotIsInstance(raised.exception,
+                                         NegativelyCachedError)
+        self.assertEqual(self.lookup.call_count, 2)
+
+
+class TestRejectCeleryTask(unittest.TestCase):
+
+    def setUp(self):
+        self.session = sqlite_session(self, CeleryTask)
+        start_patches(self,
+                      mock.patch.object(database, 'session', self.session),
+                      mock.patch.object(database, 'CeleryTask', CeleryTask))
+        self.session.add(CeleryTask(entry_id=5, task_status='PENDING'))
+        self.session.commit()
+
+    def test_rejected_with_one_update(self):
+        with query_budget(statements=1) as stats:
+            self.assertEqual(reject_celery_task(
+                entry_id=5, error=INCOMING_CONFIG_NOT_FOUND), 1)
+        self.assertEqual(stats.statements, 1)
+        task = self.session.query(CeleryTask).one()
+        self.assertEqual((task.task_status, task.error_message),
+                         (CELERY_TASK_STATUS_FAILED,
+                          INCOMING_CONFIG_NOT_FOUND))
+        self.assertIsNotNone(task.finished_on)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+import datetime
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import mysql
+from sqlalchemy.orm import Session
+
+from src.functionality import outbox_relay
+from src.models import database
+from src.models.database import db_model
+from src.models.outbox import IncomingSmsOutbox, OUTBOX_ARG_PAYLOAD, \
+    OUTBOX_STATUS_SENT
+from src.utils.circuit_breaker import CircuitOpenError
+from tests.utils import start_patches
+
+
+def entry(entry_id, attempts=0, next_attempt_at=None):
+    return {'id': entry_id, 'incoming_sms_id': entry_id, 'account_id': 1,
+            'worker': 'worker', 'arg': OUTBOX_ARG_PAYLOAD,
+            'payload': '{"entry_id": 1}', 'attempts': attempts,
+            'next_attempt_at': next_attempt_at,
+            'created_on': datetime.datetime.utcnow()}
+
+
+class TestOutboxEntries(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        IncomingSmsOutbox.__table__.create(engine)
+        self.session = Session(bind=engine)
+        patcher = mock.patch.object(database, 'session', self.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        db_model.add_outbox_entries([entry(1), entry(2), entry(3, 4)])
+        self.session.commit()
+
+    def statuses(self):
+        sql = self.session.query(IncomingSmsOutbox.id,
+                                 IncomingSmsOutbox.status,
+                                 IncomingSmsOutbox.attempts)
+        return {row.id: (row.status, row.attempts) for row in sql}
+
+    def test_claim_returns_due_pending_entries_in_order(self):
+        later = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        db_model.add_outbox_entries([entry(4, next_attempt_at=later)])
+        db_model.mark_outbox_entries([1], [], 5)
+        claimed = db_model.claim_outbox_entries(10)
+        self.assertEqual([item['id'] for item in claimed], [2, 3])
+        self.assertEqual(len(db_model.claim_outbox_entries(1)), 1)
+        self.assertEqual(self.statuses()[1], (OUTBOX_STATUS_SENT, 0))
+
+
+class TestMarkOutboxEntries(unittest.TestCase):
+
+    def setUp(self):
+        self.session, _ = start_patches(
+            self,
+            mock.patch.object(database, 'session'),
+            mock.patch.multiple(database.config, OUTBOX_RETRY_BACKOFF=30,
+                                OUTBOX_RETRY_MAX_BACKOFF=3600,
+                                CIRCUIT_RESET_TIMEOUT=60))
+        self.update = self.session.query.return_value.filter.return_value \
+            .update
+
+    def values(self):
+        values = self.update.call_args[0][0]
+        if isinstance(values, dict):
+            values = values.items()
+        return [(column.name, str(value.compile(
+            dialect=mysql.dialect(), compile_kwargs={'literal_binds': True})))
+            for column, value in values]
+
+    def test_failed_entries_backed_off_on_previous_attempts(self):
+        db_model.mark_outbox_entries([], [2, 3], 5)
+        # Status and backoff are set before attempts changes
+        self.assertEqual(self.values(), [
+            ('status', "CASE WHEN (incoming_sms_outbox.attempts + 1 >= 5) "
+                       "THEN 'failed' ELSE 'pending' END"),
+            ('next_attempt_at', 'date_add(now(), INTERVAL '
+                                'LEAST(30 * POW(2, attempts), 3600) SECOND)'),
+            ('attempts', 'incoming_sms_outbox.attempts + 1')])
+        self.session.commit.assert_called_once()
+
+    def test_deferred_entries_keep_their_attempts(self):
+        db_model.mark_outbox_entries([], [], 5, deferred_ids=[2])
+        self.assertEqual(self.values(), [
+            ('next_attempt_at', 'date_add(now(), INTERVAL 60 SECOND)')])
+
+
+class TestOutboxRelay(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(outbox_relay, 'db_model')
+        self.db_model = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.send_sync_task = mock.Mock()
+
+    def test_batch_marks_sent_failed_and_deferred_entries(self):
+        self.db_model.claim_outbox_entries.return_value = [
+            entry(1), entry(2), entry(3)]
+        self.send_sync_task.send_with_payload.side_effect = [
+            None, ValueError('bad payload'), CircuitOpenError('open')]
+
+        self.assertEqual(outbox_relay.relay_batch(self.send_sync_task), 2)
+        self.send_sync_task.register_tasks.assert_called_once()
+        # The entry refused by the circuit is put off without an attempt
+        self.db_model.mark_outbox_entries.assert_called_once_with(
+            [1], [2], outbox_relay.config.OUTBOX_MAX_ATTEMPTS,
+            deferred_ids=[3])
+
+    def test_batch_of_open_circuit_not_counted(self):
+        self.db_model.claim_outbox_entries.return_value = [
+            entry(entry_id) for entry_id in range(3)]
+        self.send_sync_task.send_with_payload.side_effect = \
+            CircuitOpenError('open')
+        self.assertEqual(outbox_relay.relay_batch(self.send_sync_task), 0)
+
+    def test_entries_marked_before_registering(self):
+        self.db_model.claim_outbox_entries.return_value = [entry(1)]
+        self.send_sync_task.register_tasks.side_effect = \
+            lambda: self.db_model.mark_outbox_entries.assert_called_once()
+        outbox_relay.relay_batch(self.send_sync_task)
+        self.send_sync_task.register_tasks.assert_called_once()
+        self.db_model.commit_session.assert_called_once()
+
+    def test_empty_claim_ends_transaction(self):
+        self.db_model.claim_outbox_entries.return_value = []
+        self.assertEqual(outbox_relay.relay_batch(self.send_sync_task), 0)
+        self.db_model.commit_session.assert_called_once()
+        self.db_model.mark_outbox_entries.assert_not_called()
+
+    def test_prune_deletes_sent_entries_past_retention(self):
+        self.db_model.delete_sent_outbox_entries.return_value = 10
+        self.assertEqual(outbox_relay.prune_sent_entries(), 10)
+        self.db_model.delete_sent_outbox_entries.assert_called_once_with(
+            outbox_relay.config.OUTBOX_RETENTION,
+            outbox_relay.PRUNE_CHUNK_SIZE)
+
+
+class TestConcurrentRelays(unittest.TestCase):
+
+    def setUp(self):
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        engine = create_engine(f'sqlite:///{path}')
+        IncomingSmsOutbox.__table__.create(engine)
+        self.first, self.second = Session(bind=engine), Session(bind=engine)
+        self.addCleanup(self.first.close)
+        self.addCleanup(self.second.close)
+        with mock.patch.object(database, 'session', self.first):
+            db_model.add_outbox_entries([entry(1), entry(2)])
+            self.first.commit()
+
+    def test_entries_not_published_again_while_registering(self):
+        second_relay = mock.Mock()
+
+        def register_tasks():
+            # Task ids are registered by committing; another relay polls
+            database.session.commit()
+            with mock.patch.object(database, 'session', self.second):
+                outbox_relay.relay_batch(second_relay)
+
+        first_relay = mock.Mock()
+        first_relay.register_tasks.side_effect = register_tasks
+        with mock.patch.object(database, 'session', self.first):
+            self.assertEqual(outbox_relay.relay_batch(first_relay), 2)
+
+        self.assertEqual(first_relay.send_with_payload.call_count, 2)
+        second_relay.send_with_payload.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
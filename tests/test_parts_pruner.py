@@ -0,0 +1,72 @@
+import unittest
+from unittest import mock
+
+from src.functionality import parts_pruner
+from src.models import database
+from src.models.database import db_model, RELEASE_LOCK_SCRIPT, \
+    PARTS_PRUNE_LOCK_KEY, PARTS_WATERMARK_SEED_KEY
+from tests.utils import start_patches
+
+
+class FakeRedis(object):
+    """Strings and the lock release script"""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        return True
+
+    def eval(self, script, numkeys, key, token):
+        assert script == RELEASE_LOCK_SCRIPT
+        if self.values.get(key) != token:
+            return 0
+        del self.values[key]
+        return 1
+
+
+class TestPruneLock(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        start_patches(
+            self,
+            mock.patch.object(database, 'redis_cache', self.redis),
+            mock.patch.object(database.Model, 'refresh_part_watermark',
+                              return_value=100))
+
+    def test_lock_of_another_owner_not_released(self):
+        self.redis.values[PARTS_PRUNE_LOCK_KEY] = 'pruner'
+        self.assertEqual(db_model.get_part_cached_id(), 100)
+        self.assertEqual(self.redis.values[PARTS_PRUNE_LOCK_KEY], 'pruner')
+
+        self.redis.values[PARTS_WATERMARK_SEED_KEY] = '90'
+        self.assertEqual(db_model.get_part_cached_id(), 90)
+
+    def test_own_lock_released_after_refresh(self):
+        self.assertEqual(db_model.get_part_cached_id(), 100)
+        self.assertNotIn(PARTS_PRUNE_LOCK_KEY, self.redis.values)
+
+    def test_expired_lock_taken_over_is_kept_by_pruner(self):
+        def take_over(*args, **kwargs):
+            # Lock expired during the run and was taken by a refresh
+            self.redis.values[PARTS_PRUNE_LOCK_KEY] = 'other'
+            return 0
+
+        with mock.patch.multiple(parts_pruner.config,
+                                 PARTS_ARCHIVE_TABLE='parts_archive'), \
+                mock.patch.object(parts_pruner.db_model,
+                                  'refresh_part_watermark',
+                                  side_effect=take_over):
+            parts_pruner.prune_stale_parts()
+        self.assertEqual(self.redis.values[PARTS_PRUNE_LOCK_KEY], 'other')
+
+
+if __name__ == '__main__':
+    unittest.main()
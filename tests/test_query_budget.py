@@ -0,0 +1,60 @@
+import unittest
+from unittest import mock
+
+from sqlalchemy import create_engine
+
+from src.utils import query_budget
+from src.utils.query_budget import QueryBudgetExceeded, query_budget as budget
+
+
+def load_parts(engine, part_numbers):
+    """One query per part: the N+1 pattern the budget should catch"""
+    return [engine.execute('SELECT message FROM parts WHERE part_number = ?',
+                           number).scalar() for number in part_numbers]
+
+
+class TestQueryBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        self.engine.execute('CREATE TABLE parts (part_number INTEGER, '
+                            'message TEXT)')
+        for number in range(1, 5):
+            self.engine.execute('INSERT INTO parts VALUES (?, ?)', number,
+                                f'part {number}')
+
+    def test_scenario_within_budget(self):
+        with budget(statements=1) as stats:
+            rows = self.engine.execute('SELECT message FROM parts').fetchall()
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(stats.statements, 1)
+        self.assertGreater(stats.db_time, 0)
+
+    def test_scenario_over_budget_fails(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            with budget(statements=2):
+                load_parts(self.engine, [1, 2, 3])
+
+    def test_repeated_statement_fails(self):
+        with self.assertRaisesRegex(QueryBudgetExceeded, 'repeated'):
+            with budget(statements=10, repeats=2):
+                load_parts(self.engine, [1, 2, 3])
+
+    def test_task_stats_logged_with_repeats_flagged(self):
+        task = mock.Mock()
+        task.name = 'incoming_sms_processor.handle_incoming_sms'
+        with mock.patch.multiple(query_budget.config, SQL_INSTRUMENTATION=1,
+                                 SQL_REPEAT_THRESHOLD=3), \
+                mock.patch.object(query_budget, 'log_json') as log_json:
+            query_budget.start_task_stats(task_id='1')
+            load_parts(self.engine, [1, 2, 3, 4])
+            query_budget.log_task_stats(task_id='1', task=task)
+
+        extra = log_json.warning.call_args[1]['extra']
+        self.assertEqual(extra['sql_statements'], 4)
+        self.assertEqual(extra['sql_repeated'][0]['count'], 4)
+        self.assertFalse(query_budget._collectors)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from redis import Connection
+from redis.exceptions import TimeoutError
+
+from src.utils import metrics, redis_cache
+from src.utils.redis_cache import RedisCache, DeadlineConnection, \
+    command_deadline
+
+
+def time_left():
+    return redis_cache._command.expires_at - redis_cache.monotonic()
+
+
+class FlakyRedis(object):
+
+    def __init__(self):
+        self.down = False
+        self.calls = []
+        self.time_left = None
+
+    def get(self, key):
+        self.calls.append(('get', key))
+        self.time_left = time_left()
+        if self.down:
+            raise TimeoutError('Timeout reading from socket')
+        return 'value'
+
+    def ping(self):
+        self.calls.append(('ping',))
+        self.time_left = time_left()
+        if self.down:
+            raise TimeoutError('Timeout reading from socket')
+        return True
+
+
+class TestRedisCache(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FlakyRedis()
+        patcher = mock.patch.multiple(
+            redis_cache.config, REDIS_DEADLINE_MS=1000,
+            REDIS_COMMAND_DEADLINES={'get': 50}, REDIS_FAST_FAIL_THRESHOLD=2,
+            REDIS_FAST_FAIL_SECONDS=5)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = RedisCache(connect=self.connect)
+
+    def connect(self):
+        return self.client
+
+    def test_command_bounded_by_its_deadline(self):
+        self.assertEqual(self.cache.get('key'), 'value')
+        self.assertTrue(0 < self.client.time_left <= 0.05)
+        self.assertTrue(self.cache.ping())
+        self.assertTrue(0.05 < self.client.time_left <= 1)
+        self.assertIsNone(redis_cache._command.expires_at)
+
+    def test_fails_fast_until_health_check_succeeds(self):
+        self.cache.get('key')
+        client = self.client
+        client.down = True
+        self.assertIsNone(self.cache.get('key'))
+        self.assertIsNone(self.cache.get('key'))
+        calls = len(client.calls)
+        # Failing fast: Redis is not called
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(len(client.calls), calls)
+
+        client.down = False
+        with mock.patch.object(redis_cache, 'monotonic',
+                               return_value=self.cache.fast_fail
+                               .failing_until):
+            self.assertEqual(self.cache.get('key'), 'value')
+        self.assertEqual(client.calls[calls:], [('ping',), ('get', 'key')])
+        self.assertEqual(self.cache.fast_fail.failures, 0)
+
+    def test_clients_fail_fast_together(self):
+        store_client = FlakyRedis()
+        store = RedisCache(connect=lambda: store_client,
+                           fast_fail=self.cache.fast_fail)
+        self.client.down = True
+        self.cache.get('key')
+        self.cache.get('key')
+        # Redis is known to be failing, the other client does not call it
+        self.assertIsNone(store.get('key'))
+        self.assertEqual(store_client.calls, [])
+
+    def test_latency_recorded_per_command(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with mock.patch.multiple(metrics, _directory=directory, _values=None):
+            self.cache.get('key')
+            self.client.down = True
+            self.cache.get('key')
+            text = metrics.render(metrics.collect(directory))
+        self.assertIn(
+            'incoming_redis_command_latency_ms_count{command="get"} 2', text)
+        self.assertIn(
+            'incoming_redis_command_errors_total{command="get"} 1', text)
+
+
+class TestDeadlineConnection(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = DeadlineConnection(socket_timeout=10)
+        self.connection._sock = mock.Mock()
+        patcher = mock.patch.object(Connection, 'send_packed_command')
+        self.send = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_socket_timeout_is_time_left(self):
+        with command_deadline(50):
+            self.connection.send_packed_command(b'GET key')
+        timeout = self.connection._sock.settimeout.call_args[0][0]
+        self.assertTrue(0 < timeout <= 0.05)
+        self.send.assert_called_once_with(b'GET key')
+
+    def test_retry_past_deadline_not_sent(self):
+        with command_deadline(50):
+            with mock.patch.object(redis_cache, 'monotonic',
+                                   return_value=redis_cache.monotonic() + 1):
+                with self.assertRaises(TimeoutError):
+                    self.connection.send_packed_command(b'GET key')
+        self.send.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
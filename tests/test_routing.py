@@ -0,0 +1,111 @@
+import unittest
+from unittest import mock
+
+from src.functionality import routing
+from src.functionality.routing import compile_routing_plan, \
+    get_routing_plan
+from src.utils.constants import IS_PUSH_ENABLED_ACCOUNT_TAG_FLAG_NAME, \
+    IS_CONVERSE_DESK_ENABLED_ACCOUNT_TAG_FLAG_NAME
+from tests.utils import start_patches
+
+PUSH = IS_PUSH_ENABLED_ACCOUNT_TAG_FLAG_NAME
+CONVERSE_DESK = IS_CONVERSE_DESK_ENABLED_ACCOUNT_TAG_FLAG_NAME
+AUTO_REPLY = 'push_to_auto_reply_business_hour'
+
+# tags, incoming config, channels pushed to, as the per channel checks did
+PLANS = [
+    ({}, {}, (AUTO_REPLY,)),
+    ({PUSH: 1}, {}, ('push_to_mobile', AUTO_REPLY)),
+    ({PUSH: 0}, {}, (AUTO_REPLY,)),
+    ({}, {'bot_status': 1}, ('push_to_bot', AUTO_REPLY)),
+    ({'subscription_management': 1}, {},
+     ('push_to_subscription', AUTO_REPLY)),
+    # Converse Desk takes over bot, subscription and auto reply
+    ({CONVERSE_DESK: 1, 'subscription_management': 1}, {'bot_status': 1},
+     ('push_to_converse_desk',)),
+    ({PUSH: 1, CONVERSE_DESK: 1}, {}, ('push_to_mobile',
+                                       'push_to_converse_desk')),
+    ({}, {'push_to_sf': 1, 'push_to_zoho': 1, 'push_to_bullhorn': 1,
+          'push_to_url': 1, 'push_to_email': 1},
+     (AUTO_REPLY, 'push_to_salesforce', 'push_to_zoho', 'push_to_bullhorn',
+      'push_to_url', 'push_to_email')),
+    ({}, {'push_to_sf': 0, 'push_to_email': None}, (AUTO_REPLY,)),
+    # Live chat needs its tag as well
+    ({}, {'push_to_live_chat': 1}, (AUTO_REPLY,)),
+    ({'isLiveChatEnabled': 1}, {'push_to_live_chat': 1},
+     (AUTO_REPLY, 'push_to_live_chat')),
+    ({'isLiveChatEnabled': 1}, {}, (AUTO_REPLY,)),
+]
+
+
+class TestCompileRoutingPlan(unittest.TestCase):
+
+    def test_channels_match_account_checks(self):
+        for tags, account_config, channels in PLANS:
+            with self.subTest(tags=tags, account_config=account_config):
+                self.assertEqual(compile_routing_plan(
+                    tags, account_config).channels, channels)
+
+    def test_converse_desk(self):
+        self.assertTrue(compile_routing_plan(
+            {CONVERSE_DESK: 1}, {}).is_converse_desk)
+        self.assertFalse(compile_routing_plan(
+            {CONVERSE_DESK: 0}, {}).is_converse_desk)
+
+    def test_push_url_fallback_by_tag(self):
+        self.assertTrue(compile_routing_plan(
+            {'push_incoming_to_url': 1}, {'push_to_url': 1}).push_url_fallback)
+        self.assertFalse(compile_routing_plan(
+            {}, {'push_to_url': 1}).push_url_fallback)
+
+
+class TestGetRoutingPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.tags = {PUSH: 1}
+        self.get_account_tags, self.compile = start_patches(
+            self,
+            mock.patch.object(routing, 'get_account_tags',
+                              side_effect=lambda account_id: self.tags),
+            mock.patch.object(routing, 'compile_routing_plan',
+                              wraps=compile_routing_plan),
+            mock.patch.object(routing, '_plans', {}))[:2]
+        self.account_config = {'id': 3, 'bot_status': 0}
+
+    def plan(self, account_id=7):
+        return get_routing_plan(account_id, self.account_config)
+
+    def test_plan_compiled_once(self):
+        self.assertEqual(self.plan(), self.plan())
+        self.assertEqual(self.compile.call_count, 1)
+        # Tags are still read for every message
+        self.assertEqual(self.get_account_tags.call_count, 2)
+
+    def test_changed_tag_recompiles(self):
+        self.assertIn('push_to_mobile', self.plan().channels)
+        self.tags = {PUSH: 0}
+        self.assertNotIn('push_to_mobile', self.plan().channels)
+        self.assertEqual(self.compile.call_count, 2)
+
+    def test_changed_config_recompiles(self):
+        self.assertNotIn('push_to_bot', self.plan().channels)
+        self.account_config = dict(self.account_config, bot_status=1)
+        self.assertIn('push_to_bot', self.plan().channels)
+        self.assertEqual(self.compile.call_count, 2)
+
+    def test_unrelated_tag_does_not_recompile(self):
+        self.plan()
+        self.tags = dict(self.tags, hipaa_compliant=1)
+        self.plan()
+        self.assertEqual(self.compile.call_count, 1)
+
+    def test_plan_per_account_and_config(self):
+        self.plan(7)
+        self.plan(8)
+        self.account_config = dict(self.account_config, id=4)
+        self.plan(7)
+        self.assertEqual(self.compile.call_count, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import json
+import sys
+import unittest
+from unittest import mock
+
+from src.utils.serializer import CacheSerializer, HEADER_MAGIC
+
+account = {'id': 123456789, 'company_name': 'SMS_Magic', 'contact_name': 'PK',
+           'email_id': 'cicd1@screen-magic.com', 'api_key': 'abc-123',
+           'created_on': '2022-10-19T10:00:00', 'is_deleted': 0}
+
+
+class TestCacheSerializer(unittest.TestCase):
+
+    def test_legacy_json_is_written_without_header(self):
+        data = CacheSerializer('json').dumps(account)
+        self.assertEqual(json.loads(data), account)
+        self.assertFalse(data.startswith(HEADER_MAGIC))
+
+    def test_legacy_json_entry_is_readable(self):
+        serializer = CacheSerializer('orjson', compress_threshold=1)
+        self.assertEqual(serializer.loads(json.dumps(account)), account)
+        self.assertEqual(serializer.loads(json.dumps(account).encode()),
+                         account)
+
+    def test_round_trip_with_compression(self):
+        value = {f'tag_{i}': i % 2 for i in range(500)}
+        serializer = CacheSerializer('orjson', compress_threshold=64)
+        data = serializer.dumps(value)
+        self.assertTrue(data.startswith(HEADER_MAGIC))
+        self.assertEqual(data[4:5], b'z')
+        self.assertEqual(serializer.loads(data), value)
+
+    def test_small_values_are_not_compressed(self):
+        serializer = CacheSerializer('orjson', compress_threshold=4096)
+        data = serializer.dumps(account)
+        self.assertEqual(data[4:5], b'-')
+        self.assertEqual(serializer.loads(data), account)
+
+    def test_unknown_codec_is_rejected(self):
+        with self.assertRaises(ValueError):
+            CacheSerializer('unknown')
+
+    def test_missing_codec_library_is_not_hidden(self):
+        with mock.patch.dict(sys.modules, {'msgpack': None}):
+            with self.assertRaises(ImportError):
+                CacheSerializer('msgpack')
+
+    def test_unsupported_version_is_rejected(self):
+        with self.assertRaises(ValueError):
+            CacheSerializer().loads(HEADER_MAGIC + b'9o-{}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import unittest
+from unittest import mock
+
+from src.utils import stage_journal
+from src.utils.stage_journal import StageJournal, STAGE_CHANNELS
+
+
+class TestStageJournal(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(stage_journal, 'redis_cache')
+        self.redis_cache = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_dispatches_written_with_their_stage(self):
+        journal = StageJournal('entry-1')
+        for channel in ('sf', 'email', 'url'):
+            journal.record_dispatch(channel)
+        self.redis_cache.hmset.assert_not_called()
+
+        journal.record(STAGE_CHANNELS, flush=True)
+        self.redis_cache.hmset.assert_called_once()
+        fields = self.redis_cache.hmset.call_args[0][1]
+        self.assertEqual(set(fields), {'channel:sf', 'channel:email',
+                                       'channel:url', STAGE_CHANNELS})
+
+    def test_message_without_ids_is_not_journaled(self):
+        journal = StageJournal(None)
+        journal.record_dispatch('sf')
+        journal.record(STAGE_CHANNELS, flush=True)
+        self.assertTrue(journal.is_dispatched('sf'))
+        self.redis_cache.hmset.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
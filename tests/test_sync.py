@@ -0,0 +1,123 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from kombu.exceptions import OperationalError
+
+from src.functionality import sync
+from src.models import database
+from src.models.database import db_model
+from src.functionality.sync import IncomingSMSSync
+from src.utils import circuit_breaker
+from src.utils.circuit_breaker import CircuitBreaker, CircuitOpenError
+from src.utils.constants import CHANNEL_MOBILE, CHANNEL_SUBSCRIPTION
+from src.utils.stage_journal import StageJournal
+from tests.utils import start_patches, sqlite_session, CeleryTask, \
+    IncomingSMSSyncAudit
+
+MESSAGE = {'sms_id': 11, 'accountId': 7, 'message': 'hi',
+           'mobilenumber': '99220', 'shortCode': '14242387011'}
+
+
+class TestIncomingSMSSync(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(sync, 'db_model')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.journal = StageJournal(None)
+        self.sync = IncomingSMSSync.__new__(IncomingSMSSync)
+        self.sync.message = MESSAGE
+        self.sync.account_config = {}
+        self.sync.account_id = 7
+        self.sync.journal = self.journal
+        self.sync.outbox = False
+        self.sync._subscription_payload = None
+        self.sync.circuit_open = []
+        self.sync.send_sync_task = mock.Mock()
+        self.sync.routing_plan = SimpleNamespace(
+            channels=['push_to_mobile', 'push_to_subscription'])
+
+    def test_open_circuit_fails_push_after_other_channels(self):
+        def send(account_id, worker, payload):
+            if worker == CHANNEL_MOBILE:
+                raise CircuitOpenError('Circuit exchange:mobile is open')
+            return True
+
+        self.sync.send_sync_task.send_with_payload.side_effect = send
+        with self.assertRaises(CircuitOpenError):
+            self.sync.push()
+        # The open channel is left to the retried task, the other is done
+        self.assertFalse(self.journal.is_dispatched(CHANNEL_MOBILE))
+        self.assertTrue(self.journal.is_dispatched(CHANNEL_SUBSCRIPTION))
+        self.sync.send_sync_task.register_tasks.assert_called_once()
+
+    def test_push_without_open_circuit(self):
+        self.sync.push()
+        self.assertTrue(self.journal.is_dispatched(CHANNEL_MOBILE))
+        self.assertEqual(self.sync.circuit_open, [])
+
+
+class TestSendSyncTask(unittest.TestCase):
+
+    def setUp(self):
+        start_patches(
+            self,
+            mock.patch.object(circuit_breaker, '_breakers', {}),
+            mock.patch.object(CircuitBreaker, 'allow', return_value=True),
+            mock.patch.object(CircuitBreaker, 'success'),
+            mock.patch.object(sync, 'get_worker_config',
+                              return_value={'exchange': 'mobile'}))
+        self.send_sync_task = sync.SendSyncTask.__new__(sync.SendSyncTask)
+        self.send_sync_task.send_task_obj = mock.Mock()
+        self.send = self.send_sync_task.send_task_obj.generic_send_task
+
+    @mock.patch.object(CircuitBreaker, 'failure')
+    def test_broker_errors_count_against_exchange(self, failure):
+        self.send.side_effect = OperationalError('connection refused')
+        with self.assertRaises(OperationalError):
+            self.send_sync_task.send_with_payload(7, CHANNEL_MOBILE, {})
+        failure.assert_called_once()
+
+    @mock.patch.object(CircuitBreaker, 'failure')
+    def test_other_errors_do_not_open_circuit(self, failure):
+        self.send.side_effect = TypeError('payload not serializable')
+        for _ in range(10):
+            with self.assertRaises(TypeError):
+                self.send_sync_task.send_with_payload(7, CHANNEL_MOBILE, {})
+        failure.assert_not_called()
+
+
+class TestRegisterTasks(unittest.TestCase):
+
+    def setUp(self):
+        self.session = sqlite_session(self, CeleryTask, IncomingSMSSyncAudit)
+        start_patches(
+            self,
+            mock.patch.object(database, 'session', self.session),
+            mock.patch.object(database, 'CeleryTask', CeleryTask),
+            mock.patch.object(database, 'IncomingSMSSyncAudit',
+                              IncomingSMSSyncAudit))
+        self.session.add_all([CeleryTask(entry_id=1, payload_data='{}'),
+                              CeleryTask(entry_id=2, payload_data='{}')])
+        self.session.commit()
+        self.send_sync_task = sync.SendSyncTask.__new__(sync.SendSyncTask)
+
+    def test_registered_ids_survive_rollback_of_message(self):
+        db_model.audit_sync(7, 11, CHANNEL_MOBILE)
+        self.send_sync_task.task_ids = {False: {1: 'task-1'},
+                                        True: {2: 'task-2'}}
+        self.send_sync_task.register_tasks()
+        # A later stage of the message fails
+        db_model.rollback_session()
+
+        rows = self.session.query(CeleryTask.entry_id, CeleryTask.task_id,
+                                  CeleryTask.payload_data)
+        self.assertEqual(sorted(rows), [
+            (1, 'task-1', '{}'),
+            (2, 'task-2', '<< payload removed due to hipaa >>')])
+        self.assertEqual(self.session.query(IncomingSMSSyncAudit).count(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
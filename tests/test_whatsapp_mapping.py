@@ -0,0 +1,46 @@
+import json
+import unittest
+from unittest import mock
+
+from src.models import database
+from src.models.database import db_model
+from tests.utils import start_patches
+
+
+class TestKeywordWhatsappMapping(unittest.TestCase):
+
+    def setUp(self):
+        self.redis_cache, self.session, _ = start_patches(
+            self,
+            mock.patch.object(database, 'redis_cache'),
+            mock.patch.object(database, 'session'),
+            mock.patch.multiple(database.config, WA_MAPPING_CACHE_EXPIRY=3600,
+                                NEGATIVE_CACHE_EXPIRY=60))
+        self.query = self.session.query.return_value.filter_by.return_value \
+            .order_by.return_value
+        self.key = db_model.get_whatsapp_mapping_key('14242387011', '99220')
+
+    def test_absent_mapping_cached_briefly(self):
+        self.redis_cache.get.return_value = None
+        self.query.first.return_value = None
+        self.assertEqual(db_model.get_keyword_whatsapp_mapping(
+            '14242387011', '99220'), (None, None))
+        self.redis_cache.set.assert_called_once_with(
+            self.key, json.dumps([None, None]), ex=60, nx=True)
+
+    def test_cached_absence_skips_database(self):
+        self.redis_cache.get.return_value = json.dumps([None, None])
+        self.assertEqual(db_model.get_keyword_whatsapp_mapping(
+            '14242387011', '99220'), (None, None))
+        self.session.query.assert_not_called()
+
+    def test_new_mapping_written_through(self):
+        db_model.insert_keyword_whatsapp_mapping(
+            shortCode='14242387011', mobileNumber='99220', keyword='sms',
+            subKeyword='magic')
+        self.redis_cache.set.assert_called_once_with(
+            self.key, json.dumps(['sms', 'magic']), ex=3600)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+from sqlalchemy import create_engine, Column, BigInteger, Integer, String, \
+    Text, DateTime
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session
+
+from src.functionality.micro_batch import ADD_SCRIPT, TAKE_SCRIPT, \
+    RESTORE_SCRIPT
+
+# Tables of sm_models used by the tests, with the columns they touch
+Base = declarative_base()
+
+
+class CeleryTask(Base):
+    __tablename__ = 'celery_task'
+
+    id = Column(Integer, primary_key=True)
+    entry_id = Column(Integer)
+    task_id = Column(String(64))
+    task_status = Column(String(16))
+    payload_data = Column(Text)
+    error_message = Column(Text)
+    finished_on = Column(DateTime)
+
+
+class IncomingSMSSyncAudit(Base):
+    __tablename__ = 'incoming_sms_sync_audit'
+
+    id = Column(Integer, primary_key=True)
+    account_id = Column(Integer)
+    incoming_sms_id = Column(BigInteger)
+    sync_type = Column(String(64))
+
+
+def start_patches(test_case, *patchers):
+    """
+    Starts the patchers for the duration of the test and returns what each
+    one patched in, in order.
+    """
+    patched = []
+    for patcher in patchers:
+        patched.append(patcher.start())
+        test_case.addCleanup(patcher.stop)
+    return patched
+
+
+def sqlite_session(test_case, *orm_classes):
+    """Session on an in-memory database with the tables of the classes"""
+    engine = create_engine('sqlite://')
+    for orm_class in orm_classes:
+        orm_class.__table__.create(engine)
+    session = Session(bind=engine)
+    test_case.addCleanup(session.close)
+    return session
+
+
+class FakeBatchRedis(object):
+    """The micro batch scripts on a dict of lists"""
+
+    def __init__(self):
+        self.lists = {}
+        self.markers = set()
+        self.down = False
+
+    def eval(self, script, numkeys, key, marker, *args):
+        if self.down:
+            return None
+        items = self.lists.setdefault(key, [])
+        if script == ADD_SCRIPT:
+            items.append(args[0])
+            schedule = int(marker not in self.markers)
+            self.markers.add(marker)
+            return [len(items), schedule]
+        if script == RESTORE_SCRIPT:
+            items[:0] = args[1:]
+            self.markers.add(marker)
+            return 1
+        assert script == TAKE_SCRIPT
+        limit = int(args[0]) or len(items)
+        taken, self.lists[key] = items[:limit], items[limit:]
+        if not self.lists[key]:
+            self.markers.discard(marker)
+        return taken
+
+    def delete(self, key):
+        self.markers.discard(key)